@@ -0,0 +1,250 @@
+from _context import sparse
+from sparse import util
+import tensors
+from sparse import sort
+
+import torch
+
+from argparse import ArgumentParser
+
+import time
+
+"""
+Micro-benchmarks for the core operations of the sparse layers.
+"""
+
+def timeit(fn, reps):
+    """
+    Average wall clock time of a function, in seconds.
+    """
+    fn() # warm up
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    t0 = time.time()
+    for _ in range(reps):
+        fn()
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    return (time.time() - t0) / reps
+
+def peak_memory(fn, cuda):
+    """
+    Peak memory use of a function, in bytes. On the GPU, this is the peak allocated memory. On the CPU, we use the
+    profiler to find the largest amount of memory allocated by a single operation (which is usually the intermediate
+    we're interested in).
+    """
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+
+        fn()
+
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - base
+
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        fn()
+
+    return max(evt.cpu_memory_usage for evt in prof.function_events)
+
+def densities(arg):
+    """
+    Compare the time and memory use of the different methods for computing the densities of sampled integer index tuples
+    under the MVNs.
+    """
+    dv = 'cuda' if arg.cuda else 'cpu'
+
+    b, c, k, i, r = arg.batch, arg.chunks, arg.k, arg.k * (2 ** arg.rank + arg.additional), arg.rank
+
+    means  = torch.rand(b, c, k, r, device=dv, requires_grad=True)
+    sigmas = torch.rand(b, c, k, r, device=dv) + 0.1
+    points = torch.rand(b, c, i, r, device=dv)
+
+    print(f'points {tuple(points.size())}, means {tuple(means.size())}')
+
+    for method, chunk in [('bmm', None), ('direct', None), ('direct', arg.chunk), ('expanded', None), ('expanded', arg.chunk)]:
+
+        def fn():
+            sparse.densities(points, means, sigmas, method=method, chunk=chunk).sum().backward()
+
+        seconds = timeit(fn, arg.reps)
+        memory = peak_memory(fn, arg.cuda)
+
+        print(f'{method:>8}, chunk {str(chunk):>4}: {seconds * 1000:8.2f} ms, peak memory {memory / 1e6:10.2f} Mb')
+
+def legacy_duplicates(tuples):
+    """
+    The original duplicate detection: Cantor-pairing keys, and a sort plus an inverse-permutation sort.
+    """
+    b, k, r = tuples.size()
+
+    unique = util.nunique(tuples)
+
+    sorted, sort_idx = torch.sort(unique, dim=1)
+    _, unsort_idx = torch.sort(sort_idx, dim=1)
+
+    mask = sorted[:, 1:] == sorted[:, :-1]
+    mask = torch.cat([torch.zeros(b, 1, dtype=torch.bool, device=util.d(tuples)), mask], dim=1)
+
+    return torch.gather(mask, 1, unsort_idx)
+
+def duplicates(arg):
+    """
+    Compare the legacy duplicate detection to the mixed-radix keys, with the bounds given and with the bounds taken
+    from the data.
+    """
+    dv = 'cuda' if arg.cuda else 'cpu'
+    bound = 64
+
+    for rank in range(1, 7):
+        k = 1000
+        while k <= arg.max_k:
+
+            tuples = torch.randint(bound, size=(arg.batch, k, rank), device=dv)
+
+            legacy  = timeit(lambda : legacy_duplicates(tuples), arg.reps)
+            bounded = timeit(lambda : util.duplicates(tuples, rng=(bound,) * rank), arg.reps)
+            data    = timeit(lambda : util.duplicates(tuples), arg.reps)
+
+            print(f'rank {rank}, k {k:>8}: legacy {legacy * 1000:9.2f} ms, bounds given {bounded * 1000:9.2f} ms, bounds from data {data * 1000:9.2f} ms')
+
+            k *= 10
+
+def logsoftmax(arg):
+    """
+    Compare the matmul-based and the segment-based row sums, and the iterative approximation of the row max to the
+    exact row-wise logsumexp, on sparse attention-like matrices (arg.k entries in each row of a square matrix).
+    """
+    dv = 'cuda' if arg.cuda else 'cpu'
+    b, t, k = arg.batch, arg.size, arg.k
+
+    size = (t, t)
+    rows = torch.arange(t, device=dv)[None, :, None].expand(b, t, k)
+    cols = torch.randint(t, size=(b, t, k), device=dv)
+    indices = torch.stack([rows, cols], dim=-1).view(b, t * k, 2)
+
+    values = torch.randn(b, t * k, device=dv, requires_grad=True)
+
+    fns = {
+        'sum (mm)'       : lambda : tensors.sum(indices, values, size, method='mm'),
+        'sum (segment)'  : lambda : tensors.sum(indices, values, size, method='segment'),
+        'iteration'      : lambda : tensors.logsoftmax(indices, values, size, method='iteration'),
+        'exact'          : lambda : tensors.logsoftmax(indices, values, size, method='exact'),
+    }
+
+    for name, fn in fns.items():
+        seconds = timeit(lambda : fn().sum().backward(), arg.reps)
+
+        print(f'{name:>16}: {seconds * 1000:8.2f} ms')
+
+    # deviation of the iterative approximation from the exact softmax
+    with torch.no_grad():
+        error = (fns['iteration']().exp() - fns['exact']().exp()).abs().max()
+
+    print(f'iteration: max softmax error {error.item():.4}')
+
+def sorting(arg):
+    """
+    Time a forward and backward pass of the SortLayer, with the pivots computed by selection and by sorting, for
+    sizes from 16 to 4096.
+    """
+    dv = 'cuda' if arg.cuda else 'cpu'
+
+    size = 16
+    while size <= 4096:
+
+        x = torch.randn(arg.batch, size, 1, device=dv, requires_grad=True)
+        keys = torch.randn(arg.batch, size, device=dv, requires_grad=True)
+
+        times = {}
+        for pivot_method in ['sort', 'select']:
+            layer = sort.SortLayer(size, additional=arg.additional, pivot_method=pivot_method).to(dv)
+
+            def fn():
+                y, k = layer(x, keys)
+                (y.sum() + k.sum()).backward()
+
+            times[pivot_method] = timeit(fn, arg.reps)
+
+        print(f'size {size:>5}: sorted pivots {times["sort"] * 1000:9.2f} ms, selected pivots {times["select"] * 1000:9.2f} ms')
+
+        size *= 2
+
+if __name__ == "__main__":
+
+    ## Parse the command line options
+    parser = ArgumentParser()
+
+    parser.add_argument("-t", "--task",
+                        dest="task",
+                        help="Which operation to benchmark (densities, duplicates, logsoftmax, sort).",
+                        default='densities', type=str)
+
+    parser.add_argument("-b", "--batch-size",
+                        dest="batch",
+                        help="The batch size.",
+                        default=16, type=int)
+
+    parser.add_argument("-k", "--num-points",
+                        dest="k",
+                        help="Number of continuous index tuples per chunk.",
+                        default=32, type=int)
+
+    parser.add_argument("-s", "--size",
+                        dest="size",
+                        help="Size of the (square) sparse matrices (for the logsoftmax task).",
+                        default=1024, type=int)
+
+    parser.add_argument("--chunks",
+                        dest="chunks",
+                        help="Number of chunks (the c dimension of the index tuples).",
+                        default=64, type=int)
+
+    parser.add_argument("--chunk",
+                        dest="chunk",
+                        help="Number of chunks to process at once (for the chunked methods).",
+                        default=8, type=int)
+
+    parser.add_argument("-r", "--rank",
+                        dest="rank",
+                        help="Rank of the index tuples.",
+                        default=3, type=int)
+
+    parser.add_argument("-a", "--additional",
+                        dest="additional",
+                        help="Number of additional points sampled per continuous index tuple.",
+                        default=4, type=int)
+
+    parser.add_argument("--max-k",
+                        dest="max_k",
+                        help="Largest number of tuples per batch row (for the duplicates task).",
+                        default=1_000_000, type=int)
+
+    parser.add_argument("--reps",
+                        dest="reps",
+                        help="Number of repetitions to average the timings over.",
+                        default=10, type=int)
+
+    parser.add_argument("-c", "--cuda", dest="cuda",
+                        help="Whether to use cuda.",
+                        action="store_true")
+
+    options = parser.parse_args()
+
+    print('OPTIONS ', options)
+
+    if options.task == 'densities':
+        densities(options)
+    elif options.task == 'duplicates':
+        duplicates(options)
+    elif options.task == 'logsoftmax':
+        logsoftmax(options)
+    elif options.task == 'sort':
+        sorting(options)
+    else:
+        raise Exception(f'Task {options.task} not recognized.')
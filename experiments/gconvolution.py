@@ -899,7 +899,7 @@ def test():
     x.grad = None
     values.grad = None
 
-    mul = util.SparseMultCPU.apply(indices.t(), values, size, x)
+    mul = util.sparsemult()(indices.t(), values, size, x)
     loss = mul.norm()
     loss.backward()
 
@@ -913,10 +913,10 @@ def test():
             nvalues = values.clone()
             nvalues[i] = nvalues[i] + h
 
-            mul = util.SparseMultCPU.apply(indices.t(), values, size, x)
+            mul = util.sparsemult()(indices.t(), values, size, x)
             loss0 = mul.norm()
 
-            mul = util.SparseMultCPU.apply(indices.t(), nvalues, size, x)
+            mul = util.sparsemult()(indices.t(), nvalues, size, x)
             loss1 = mul.norm()
 
             grad[i] = (loss1-loss0)/h
@@ -931,10 +931,10 @@ def test():
                 nx = x.clone()
                 nx[i, j] = x[i, j] + h
 
-                mul = util.SparseMultCPU.apply(indices.t(), values, size, x)
+                mul = util.sparsemult()(indices.t(), values, size, x)
                 loss0 = mul.norm()
 
-                mul = util.SparseMultCPU.apply(indices.t(), values, size, nx)
+                mul = util.sparsemult()(indices.t(), values, size, nx)
                 loss1 = mul.norm()
 
                 grad[i, j] = (loss1-loss0)/h
@@ -167,14 +167,8 @@ def go(arg):
                     # multiple forward/backward passes, accumulate gradient
                     seed = (torch.rand(1) * 100000).long().item()
 
-                    for fr in range(0, arg.size, arg.subbatch):
-                        to = min(fr + arg.subbatch, arg.size)
+                    loss = model.accumulate(x, lambda y : F.mse_loss(y, x), arg.subbatch, seed=seed)
 
-                        y = model(x, mrange=(fr, to), seed=seed)
-
-                        loss = F.mse_loss(y, x)
-
-                        loss.backward()
                     optimizer.step()
 
             else:
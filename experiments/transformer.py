@@ -1,5 +1,6 @@
 from _context import sparse
 from sparse import util
+from sparse import MSparseSelfAttention, ASH2DSelfAttention, ASH1DSelfAttention, StridedSparseSelfAttention
 
 import torch
 from torch import nn
@@ -12,7 +13,8 @@ import numpy as np
 from argparse import ArgumentParser
 from torch.utils.tensorboard import SummaryWriter
 
-import random, tqdm, sys, math
+import random, tqdm, sys, math, os
+import threading, queue
 
 import matplotlib as mpl
 mpl.use('Agg')
@@ -57,702 +59,6 @@ def mask_(matrices, maskval=0.0, mask_diagonal=True):
     indices = torch.triu_indices(h, w, offset=0 if mask_diagonal else 1)
     matrices[:, indices[0], indices[1]] = maskval
 
-class MSparseSelfAttention(nn.Module):
-    """
-    Masked sparse self attention (two degrees of freedom)
-    """
-    def __init__(self, emb, k, gadditional, radditional, region, heads=8, mask=False, min_sigma=0.05, sigma_scale=1.0):
-        """
-
-        :param emb:
-        :param k: Number of connections to the input in total
-        :param gadditional:
-        :param radditional:
-        :param region:
-        :param heads:
-        :param mask:
-        """
-
-        super().__init__()
-
-        self.emb, self.heads, self.mask, self.min_sigma, self.sigma_scale = emb, heads, mask, min_sigma, sigma_scale
-
-        self.tokeys = nn.Linear(emb, emb * heads, bias=False)
-        self.toqueries = nn.Linear(emb, emb * heads, bias=False)
-        self.tovalues = nn.Linear(emb, emb * heads, bias=False)
-
-        self.unifyheads = nn.Linear(heads * emb, emb)
-
-        self.gadditional = gadditional
-        self.radditional = radditional
-        self.region = region
-        self.k = k
-
-        self.means  = nn.Parameter(torch.randn((k, 2)))
-        self.sigmas = nn.Parameter(torch.randn((k, )))
-        self.register_buffer('mvalues', torch.ones((k, )))
-
-    def hyper(self, x):
-
-        b, t, e = x.size()
-        h, k, reg = self.heads, self.k, self.region
-
-        # generate the continuous parameters
-        means = self.means[None, None, :, :].expand(b, 1, k, 2)
-        sigmas = self.sigmas[None, None, :].expand(b, 1, k)
-        values = self.mvalues[None, None, :].expand(b, 1, k)
-
-        means = util.flip(means.contiguous())  # flip everything to below the diagonal of the matrix
-
-        s = (t, t)
-        means, sigmas = sparse.transform_means(means, s), \
-                        sparse.transform_sigmas(sigmas, s, min_sigma=self.min_sigma) * self.sigma_scale
-
-        return means, sigmas, values
-
-    def forward(self, x):
-
-        b, t, e = x.size()
-        h, k, reg = self.heads, self.k, self.region
-        s = (t, t)
-
-        assert e == self.emb, f'Input embedding dim ({e}) should match layer embedding dim ({self.emb})'
-
-        means, sigmas, mvalues = self.hyper(x)
-
-        # sample integer indices and values
-        indices = sparse.ngenerate(means, self.gadditional, self.radditional, rng=(t, t),
-                                   relative_range=(self.region, self.region), cuda=x.is_cuda)
-        indices = util.flip(indices)
-
-        indfl = indices.float()
-
-        vs = k * (4 + self.radditional + self.gadditional)
-        assert indices.size() == (b, 1, vs, 2), f'{indices.size()}, {(b, 1, vs, 2)}'
-
-        # Mask for duplicate indices
-        dups = util.nduplicates(indices).to(torch.bool)
-
-        # compute (unnormalized) densities under the given MVNs (proportions)
-        props = sparse.densities(indfl, means, sigmas).clone()
-        props[dups, :] = 0
-        props = props / props.sum(dim=2, keepdim=True)  # normalize over all points of a given index tuple
-
-        # weight the values by the proportions
-        weights = mvalues[:, :, None, :].expand_as(props)
-        # - add a dim for the MVNs
-
-        weights = props * weights
-        weights = weights.sum(dim=3) # - sum out the MVNs
-
-        assert indices.size() == (b, 1, vs, 2), f'{indices.size()}, {(b, 1, vs, 2)}'
-        assert weights.size() == (b, 1, vs), f'{weights.size()},  {(b, 1, vs)}'
-
-        # expand for heads, fold heads into batch
-        indices = indices[:, None, :, :, :].expand(b, h, 1, vs, 2).contiguous().view(b*h, vs, 2)
-        weights = weights[:, None, :, :].expand(b, h, 1, vs).contiguous().view(b*h, vs)
-
-        # compute keys, queries, values
-        keys    = self.tokeys(x)   .view(b, t, h, e)
-        queries = self.toqueries(x).view(b, t, h, e)
-        values  = self.tovalues(x) .view(b, t, h, e)
-        # - fold heads into the batch dimension
-        keys = keys.transpose(1, 2).contiguous().view(b * h, t, e)
-        queries = queries.transpose(1, 2).contiguous().view(b * h, t, e)
-        values = values.transpose(1, 2).contiguous().view(b * h, t, e)
-
-        queries = queries / (e ** (1/4)) # b*h, t, e
-        keys    = keys    / (e ** (1/4))
-
-        # get dot product of queries and keys
-        # - this will be a sparse matrix with the indices we've just computed, and values
-        #   defined by the dot product
-
-        # select the queries
-        indflat = indices.view(b*h*vs, 2)
-        ar = torch.arange(b*h, dtype=torch.long, device=d(x))[:, None].expand(b*h, vs).contiguous().view(b*h*vs)
-        squeries = queries[ar, indflat[:, 0], :]
-        skeys    = keys   [ar, indflat[:, 1], :]
-
-        dot = torch.bmm(squeries[:, None, :], skeys[:, :, None]).view(b*h, vs)
-        dot = sparse.logsoftmax(indices, weights * dot, s)
-        # - dot now has row-wise self-attention probabilities
-
-        # apply the self attention to the values
-        out = sparse.batchmm(indices, dot, size=(t, t), xmatrix=values)
-
-        # swap h, t back, unify heads
-        out = out.transpose(1, 2).contiguous().view(b, t, h * e)
-        return self.unifyheads(out)
-
-
-class ASH2DSelfAttention(nn.Module):
-    """
-    Masked sparse self attention. One degree of freedom, the receptive field is adaptive, based on the incoming
-    embedding vector, position embedding and coordinate.
-    """
-    def __init__(self, emb, k, gadditional, radditional, region, heads=8, mask=False, min_sigma=0.05,
-                 sigma_scale=0.1, mmult = 1.0):
-        """
-        :param emb:
-        :param k: Number of connections to the input for each output
-        :param gadditional:
-        :param radditional:
-        :param region:
-        :param heads:
-        :param mask:
-        """
-
-        super().__init__()
-
-        self.emb, self.heads, self.mask, self.min_sigma, self.sigma_scale = emb, heads, mask, min_sigma, sigma_scale
-        self.mmult = mmult
-
-        self.tokeys = nn.Linear(emb, emb * heads, bias=False)
-        self.toqueries = nn.Linear(emb, emb * heads, bias=False)
-        self.tovalues = nn.Linear(emb, emb * heads, bias=False)
-
-        self.unifyheads = nn.Linear(heads * emb, emb)
-
-        self.gadditional = gadditional
-        self.radditional = radditional
-        self.region = region
-        self.k = k
-
-        self.register_buffer('mvalues', torch.ones((k, )))
-
-        # network that generates the coordinates and sigmas
-        hidden = emb * 4
-        self.toparams = nn.Sequential(
-            nn.Linear(emb + 1, hidden), nn.ReLU(),
-            nn.Linear(hidden, k * 3) # two means, one sigma
-        )
-
-    def hyper(self, x):
-
-        b, t, e = x.size()
-        h, k, reg = self.heads, self.k, self.region
-
-        # Generate coords
-        coords = torch.arange(t, dtype=torch.float, device=d(x)) / t
-        coords = coords[None, :, None,].expand(b, t, 1)
-
-        input = torch.cat([x, coords], dim=2)
-        params = self.toparams(input) # (b, t, k*3)
-
-        assert not util.contains_nan(params),  \
-            f'params contain NaN\n intput {input.min()} {input.max()} \n {list(self.toparams.parameters())}'
-
-        # Generate the logits that correspond to the diagonals of the matrix
-        diags = torch.arange(t, dtype=torch.float, device=d(x))
-        diags = util.inv(diags, mx=t)
-
-        diags = diags[None, :, None, None].expand(b, t, k, 2)
-
-        means =  params[:, :, :k*2].view(b, t, k, 2)
-        sigmas = params[:, :, k*2:].view(b, t, k)
-        values = self.mvalues[None, None, :].expand(b, t, k)
-
-        means = diags + self.mmult * means
-        means = util.flip(means)
-
-        # means = util.flip(means.contiguous())  # flip everything to below the diagonal of the matrix
-
-        s = (t, t)
-        means, sigmas = sparse.transform_means(means, s), \
-                        sparse.transform_sigmas(sigmas, s, min_sigma=self.min_sigma) * self.sigma_scale
-
-        return means, sigmas, values
-
-    def forward(self, x):
-
-        b, t, e = x.size()
-        h, k, reg = self.heads, self.k, self.region
-        s = (t, t)
-
-        assert e == self.emb, f'Input embedding dim ({e}) should match layer embedding dim ({self.emb})'
-
-        means, sigmas, mvalues = self.hyper(x)
-
-        # sample integer indices and values
-        indices = sparse.ngenerate(means, self.gadditional, self.radditional, rng=(t, t),
-                                   relative_range=(self.region, self.region), cuda=x.is_cuda)
-
-        indices = util.flip(indices)
-
-        indfl = indices.float()
-
-        vs = k * (4 + self.radditional + self.gadditional)
-        assert indices.size() == (b, t, vs, 2), f'{indices.size()}, {(b, t, vs, 2)}'
-
-        # Mask for duplicate indices
-        dups = util.nduplicates(indices).to(torch.bool)
-
-        # compute (unnormalized) densities under the given MVNs (proportions)
-        props = sparse.densities(indfl, means, sigmas).clone()
-        props[dups, :] = 0
-        props = props / props.sum(dim=2, keepdim=True)  # normalize over all points of a given index tuple
-
-        # weight the values by the proportions
-        weights = mvalues[:, :, None, :].expand_as(props)
-        # - add a dim for the MVNs
-
-        weights = props * weights
-        weights = weights.sum(dim=3) # - sum out the MVNs
-
-        assert indices.size() == (b, t, vs, 2), f'{indices.size()}, {(b, t, vs, 2)}'
-        assert weights.size() == (b, t, vs), f'{weights.size()},  {(b, t, vs)}'
-
-        # expand for heads, fold heads into batch
-        indices = indices[:, None, :, :, :].expand(b, h, t, vs, 2).contiguous().view(b*h, t*vs, 2)
-        weights = weights[:, None, :, :].expand(b, h, t, vs).contiguous().view(b*h, t*vs)
-
-        # compute keys, queries, values
-        keys    = self.tokeys(x)   .view(b, t, h, e)
-        queries = self.toqueries(x).view(b, t, h, e)
-        values  = self.tovalues(x) .view(b, t, h, e)
-        # - fold heads into the batch dimension
-        keys = keys.transpose(1, 2).contiguous().view(b * h, t, e)
-        queries = queries.transpose(1, 2).contiguous().view(b * h, t, e)
-        values = values.transpose(1, 2).contiguous().view(b * h, t, e)
-
-        queries = queries / (e ** (1/4)) # b*h, t, e
-        keys    = keys    / (e ** (1/4))
-
-        # get dot product of queries and keys
-        # - this will be a sparse matrix with the indices we've just computed, and values
-        #   defined by the dot product
-
-        # select the queries
-        indflat = indices.view(b*h*t*vs, 2)
-        ar = torch.arange(b*h, dtype=torch.long, device=d(x))[:, None].expand(b*h, t*vs).contiguous().view(b*h*t*vs)
-        squeries = queries[ar, indflat[:, 0], :]
-        skeys    = keys   [ar, indflat[:, 1], :]
-
-        dot = torch.bmm(squeries[:, None, :], skeys[:, :, None]).view(b*h,t*vs)
-
-        #print(f'dot before {dot.min()}, {dot.mean()}, {dot.max()}')
-        assert not util.contains_nan(dot), f'dot contains nan (before softmax) {dot.min()}, {dot.mean()}, {dot.max()}'
-
-        #print(f'dot after  {dot.min()}, {dot.mean()}, {dot.max()}\n')
-        dot = sparse.logsoftmax(indices, weights * dot, s).exp()
-        # - dot now has row-wise self-attention probabilities
-
-        assert not util.contains_nan(dot), f'dot contains nan (after softmax) {dot.min()}, {dot.mean()}, {dot.max()}'
-
-        # apply the self attention to the values
-        out = sparse.batchmm(indices, dot, size=(t, t), xmatrix=values)
-
-        # swap h, t back, unify heads
-        out = out.transpose(1, 2).contiguous().view(b, t, h * e)
-        out = self.unifyheads(out)
-
-        assert not util.contains_nan(out), f'output contains nan {out}'
-
-        return out
-
-
-class ASH1DSelfAttention(nn.Module):
-    """
-    Masked sparse self attention. One degree of freedom, the receptive field is adaptive, based on the incoming
-    embedding vector, position embedding and coordinate.
-    """
-    def __init__(self, emb, k, gadditional, radditional, region, heads=8, mask=False, min_sigma=0.05, sigma_scale=0.1,
-                 mmult = 1.0, norm_method='softmax', outputs=-1,  clamp=True):
-        """
-        :param emb:
-        :param k: Number of connections to the input for each output
-        :param gadditional:
-        :param radditional:
-        :param region:
-        :param heads:
-        :param outputs: The number of units (at the end of the sequence) to compute new vectors for.
-        :param mask:
-        """
-
-        super().__init__()
-
-        self.emb, self.heads, self.mask, self.min_sigma, self.sigma_scale = emb, heads, mask, min_sigma, sigma_scale
-        self.mmult, self.norm_method, self.clamp = mmult, norm_method, clamp
-
-        if clamp:
-            self.mmult *= 3.0
-
-        self.outputs = outputs
-
-        self.tokeys = nn.Linear(emb, emb * heads, bias=False)
-        self.toqueries = nn.Linear(emb, emb * heads, bias=False)
-        self.tovalues = nn.Linear(emb, emb * heads, bias=False)
-
-        self.unifyheads = nn.Linear(heads * emb, emb)
-
-        self.gadditional = gadditional
-        self.radditional = radditional
-        self.region = region
-        self.k = k
-
-        self.register_buffer('mvalues', torch.ones((k, )))
-
-        # network that generates the coordinates and sigmas
-        hidden = emb * 4
-        self.toparams = nn.Sequential(
-            nn.Linear(emb + 1, hidden), nn.ReLU(),
-            nn.Linear(hidden, k * 2) # one mean, one sigma
-        )
-
-    def hyper(self, x):
-
-        b, t, e = x.size()
-        h, k, reg = self.heads, self.k, self.region
-
-        o = t if self.outputs < -1 else self.outputs
-
-        # Generate coords
-        coords = torch.arange(t, dtype=torch.float, device=d(x)) / t
-        coords = coords[None, :, None,].expand(b, t, 1)
-
-        input = torch.cat([x, coords], dim=2)
-        params = self.toparams(input) # (b, o, k*2)
-
-        assert not util.contains_nan(params),  \
-            f'params contain NaN\n intput {input.min()} {input.max()} \n {list(self.toparams.parameters())}'
-
-        # Generate the logits that correspond to the horizontal coordinate of the current word
-        diags = torch.arange(t, dtype=torch.float, device=d(x))
-        if not self.clamp:
-            diags = util.inv(diags, mx=t)
-
-        diags = diags[None, :, None, None].expand(b, t, k, 1)
-
-        means =  params[:, :, :k].view(b, t, k, 1)
-        sigmas = params[:, :, k:].view(b, t, k)
-        values = self.mvalues[None, None, :].expand(b, t, k)
-
-        means = diags - self.mmult * F.softplus(means)
-
-        s = (t,)
-        means, sigmas = sparse.transform_means(means, s, method='clamp' if self.clamp else 'sigmoid'), \
-                        sparse.transform_sigmas(sigmas, s, min_sigma=self.min_sigma) * self.sigma_scale
-
-        return means, sigmas, values
-
-    def forward(self, x):
-
-        b, t, e = x.size()
-        h, k, reg = self.heads, self.k, self.region
-        s = (t, t)
-
-        assert e == self.emb, f'Input embedding dim ({e}) should match layer embedding dim ({self.emb})'
-
-        means, sigmas, mvalues = self.hyper(x)
-
-        # sample integer indices and values
-        indices = sparse.ngenerate(means, self.gadditional, self.radditional, rng=(t,),
-                                   relative_range=(self.region, ), cuda=x.is_cuda)
-        indfl = indices.float()
-
-        vs = k * (2 + self.radditional + self.gadditional)
-        assert indices.size() == (b, t, vs, 1), f'{indices.size()}, {(b, t, vs, 1)}'
-
-        m = torch.arange(t, dtype=torch.long, device=d(indices))[None, :, None, None].expand(b, t, vs, k)
-
-        props = sparse.densities(indfl, means, sigmas).clone() # (b, t, vs, k)
-
-        # Mask for duplicate indices
-        dups = util.nduplicates(indices).to(torch.bool)
-
-        # compute (unnormalized) densities under the given MVNs (proportions)
-        props[dups, :] = 0
-        props[indices > m] = 0
-
-        props = props / props.sum(dim=2, keepdim=True)  # normalize over all points of a given index tuple
-
-        # weight the values by the proportions
-        weights = mvalues[:, :, None, :].expand_as(props)
-        # - add a dim for the MVNs
-
-        weights = props * weights
-        weights = weights.sum(dim=3) # - sum out the MVNs
-
-        out = torch.arange(t, device=d(indices))[None, :, None, None].expand(b, t, vs, 1)
-        indices = torch.cat([out, indices], dim=3)
-
-        assert indices.size() == (b, t, vs, 2), f'{indices.size()}, {(b, t, vs, 2)}'
-        assert weights.size() == (b, t, vs), f'{weights.size()},  {(b, t, vs)}'
-
-        # expand for heads, fold heads into batch
-        indices = indices[:, None, :, :, :].expand(b, h, t, vs, 2).contiguous().view(b*h, t*vs, 2)
-        weights = weights[:, None, :, :].expand(b, h, t, vs).contiguous().view(b*h, t*vs)
-
-        # compute keys, queries, values
-        keys    = self.tokeys(x)   .view(b, t, h, e)
-        queries = self.toqueries(x).view(b, t, h, e)
-        values  = self.tovalues(x) .view(b, t, h, e)
-        # - fold heads into the batch dimension
-        keys = keys.transpose(1, 2).contiguous().view(b * h, t, e)
-        queries = queries.transpose(1, 2).contiguous().view(b * h, t, e)
-        values = values.transpose(1, 2).contiguous().view(b * h, t, e)
-
-        queries = queries / (e ** (1/4)) # b*h, t, e
-        keys    = keys    / (e ** (1/4))
-
-        # get dot product of queries and keys
-        # - this will be a sparse matrix with the indices we've just computed, and values
-        #   defined by the dot product
-
-        # select the queries
-        indflat = indices.view(b*h*t*vs, 2)
-        ar = torch.arange(b*h, dtype=torch.long, device=d(x))[:, None].expand(b*h, t*vs).contiguous().view(b*h*t*vs)
-        squeries = queries[ar, indflat[:, 0], :]
-        skeys    = keys   [ar, indflat[:, 1], :]
-
-        dot = torch.bmm(squeries[:, None, :], skeys[:, :, None]).view(b*h,t*vs)
-
-        assert not util.contains_inf(dot), f'dot contains inf (before softmax) {dot.min()}, {dot.mean()}, {dot.max()}'
-        assert not util.contains_nan(dot), f'dot contains nan (before softmax) {dot.min()}, {dot.mean()}, {dot.max()}'
-
-        if self.norm_method == 'softmax':
-            dot = sparse.logsoftmax(indices, weights * dot, s).exp()
-        else:
-            dot = sparse.simple_normalize(indices, weights * dot, s, method=self.norm_method)
-        # - dot now has row-wise self-attention probabilities
-
-        assert not util.contains_inf(dot), f'dot contains inf (after softmax) {dot.min()}, {dot.mean()}, {dot.max()}'
-        assert not util.contains_nan(dot), f'dot contains nan (after softmax) {dot.min()}, {dot.mean()}, {dot.max()}'
-
-        # apply the self attention to the values
-        out = sparse.batchmm(indices, dot, size=(t, t), xmatrix=values)
-
-        # swap h, t back, unify heads
-        out = out.transpose(1, 2).contiguous().view(b, t, h * e)
-        out = self.unifyheads(out)
-
-        assert not util.contains_nan(out), f'output contains nan {out}, dot min/max: {dot.min()}/{dot.max()}'
-
-        return out
-
-
-class StridedSparseSelfAttention(nn.Module):
-    """
-    Masked sparse self attention. One degree of freedom, the receptive field is adaptive, based on the incoming
-    embedding vector, position embedding and coordinate.
-    """
-    def __init__(self, emb, k, gadditional, radditional, region, heads=8, stride=32, mask=False, min_sigma=0.05, sigma_scale=0.1,
-                 mmult = 1.0, norm_method='softmax',  clamp=True, **kwargs):
-        """
-        :param emb:
-        :param k: Number of connections to the input for each output
-        :param gadditional:
-        :param radditional:
-        :param region:
-        :param heads:
-        :param outputs: The number of units (at the end of the sequence) to compute new vectors for.
-        :param mask:
-        """
-
-        super().__init__()
-
-        self.emb, self.heads, self.mask, self.min_sigma, self.sigma_scale = emb, heads, mask, min_sigma, sigma_scale
-        self.mmult, self.norm_method, self.clamp = mmult, norm_method, clamp
-        self.stride = stride
-
-        if clamp:
-            self.mmult *= 3.0
-
-        s = emb // heads
-
-        self.tokeys =    nn.Linear(s, s, bias=False)
-        self.toqueries = nn.Linear(s, s, bias=False)
-        self.tovalues =  nn.Linear(s, s, bias=False)
-
-        self.unifyheads = nn.Linear(s * heads, emb)
-
-        self.gadditional = gadditional
-        self.radditional = radditional
-        self.region = region
-        self.k = k
-
-        self.register_buffer('mvalues', torch.ones((k, )))
-
-        # network that generates the coordinates and sigmas
-        hidden = emb * 4
-        self.toparams = nn.Sequential(
-            nn.Linear(2 * emb + 1, hidden), nn.ReLU(),
-            nn.Linear(hidden, k * 2) # one mean, one sigma
-        )
-        # -- input is the current token's embedding vector, the sum of preceding embedding vectors, and the coordinate.
-
-    def hyper(self, x):
-
-        b, t, e = x.size()
-        h, k, reg = self.heads, self.k, self.region
-        r = self.stride
-        s = (t,)
-
-        # Generate input selection
-        selection = torch.arange(t//r, dtype=torch.long, device=d(x))
-        selection = (selection + 1) * r - 1
-        tp = selection.size(0)
-
-        # Generate coords
-        coords = torch.arange(tp, dtype=torch.float, device=d(x)) / tp
-        coords = coords[None, :, None,].expand(b, tp, 1)
-
-        summed = (x.cumsum(dim=1) - x) / torch.arange(start=1, end=t+1, device=d(), dtype=torch.float)[None, :, None]
-
-        input = torch.cat([x[:, selection, :], coords, summed[:, selection, :]], dim=2)
-        params = self.toparams(input) # (b, tp, k*2)
-
-        assert not util.contains_nan(params),  \
-            f'params contain NaN\n input {input.min()} {input.max()} \n {list(self.toparams.parameters())}'
-        assert not util.contains_inf(params),  \
-            f'params contain inf\n input {input.min()} {input.max()} \n {list(self.toparams.parameters())}'
-
-        # Generate the logits/coordinates that correspond to the horizontal coordinate of the current word
-        diags = selection.to(torch.float)
-        if not self.clamp:
-            diags = util.inv(diags, mx=t)
-
-        diags = diags[None, :, None, None].expand(b, tp, k, 1)
-
-        means =  params[:, :, :k].view(b, tp, k, 1)
-        sigmas = params[:, :, k:].view(b, tp, k)
-        values = self.mvalues[None, None, :].expand(b, tp, k) # all ones atm
-
-        means = diags - self.mmult * F.softplus(means)
-
-        means, sigmas = sparse.transform_means(means, s, method='clamp' if self.clamp else 'sigmoid'), \
-                        sparse.transform_sigmas(sigmas, s, min_sigma=self.min_sigma) * self.sigma_scale
-
-        return means, sigmas, values
-
-    def forward(self, x):
-
-        b, t, e = x.size()
-        h, k, reg = self.heads, self.k, self.region
-        r = self.stride
-
-        # Generate input selection (the fixed output indices, which are 'stride' units apart)
-        selection = torch.arange(t//r, dtype=torch.long, device=d(x))
-        selection = (selection + 1) * r - 1
-        tp = selection.size(0)
-
-        size = (t, t)
-
-        means, sigmas, mvalues = self.hyper(x)
-
-        s = e // h
-        x = x.view(b, t, h, s)
-
-        # sample integer indices and values
-        indices = sparse.ngenerate(means, self.gadditional, self.radditional, rng=(t,),
-                                   relative_range=(self.region, ), cuda=x.is_cuda, epsilon=10e-5)
-        indfl = indices.float()
-
-        vs = k * (2 + self.radditional + self.gadditional) # number of sampled integer index tuples
-        assert indices.size() == (b, tp, vs, 1), f'{indices.size()}, {(b, tp, vs, 1)}'
-
-        m = selection[None, :, None, None].expand(b, tp, vs, k)
-
-        props = sparse.densities(indfl, means, sigmas).clone() # (b, tp, vs, k)
-
-        # Mask for duplicate indices
-        dups = util.nduplicates(indices).to(torch.bool)
-
-        # compute (unnormalized) densities under the given MVNs (proportions)
-        props[dups, :] = 0
-        props[indices > m] = 0 # mask out any forward connections
-        # -- note that while all the continuous index tuples are guaranteed to point backwards, the sampled discrete
-        #    index tuples might point forward, so they still need to be zeroed out here.
-
-        props = props / props.sum(dim=2, keepdim=True)  # normalize over all remaining points of a given index tuple
-
-        # weight the values by the proportions
-        weights = mvalues[:, :, None, :].expand_as(props)
-        # - add a dim for the MVNs
-
-        weights = props * weights
-        weights = weights.sum(dim=3) # - sum out the MVNs
-
-        out = selection[None, :, None, None].expand(b, tp, vs, 1) # output indices
-        indices = torch.cat([out, indices], dim=3)
-
-        assert indices.size() == (b, tp, vs, 2), f'{indices.size()}, {(b, tp, vs, 2)}'
-        assert weights.size() == (b, tp, vs), f'{weights.size()},  {(b, tp, vs)}'
-
-        assert not util.contains_inf(weights), f'weights contains inf (before norm) {weights.min()}, {weights.mean()}, {weights.max()}'
-        assert not util.contains_nan(weights), f'weights contains nan (before norm) {weights.min()}, {weights.mean()}, {weights.max()}'
-
-        # expand for heads, fold heads into batch
-        indices = indices[:, None, :, :, :].expand(b, h, tp, vs, 2).contiguous().view(b*h, tp*vs, 2)
-        weights = weights[:, None, :, :].expand(b, h, tp, vs).contiguous().view(b*h, tp*vs)
-
-        # compute keys, queries, values
-        keys    = self.tokeys(x)    # note: t not tp, we compute _all_ queries, keys and values
-        queries = self.toqueries(x)
-        values  = self.tovalues(x)
-        # - fold heads into the batch dimension
-        keys    = keys.transpose(1, 2).contiguous()   .view(b * h, t, s)
-        queries = queries.transpose(1, 2).contiguous().view(b * h, t, s)
-        values  = values.transpose(1, 2).contiguous() .view(b * h, t, s)
-        # -- We could actually select first, and _then_ transform to kqv's. May be better for very large contexts and
-        #    small batches
-
-        queries = queries / (e ** (1/4)) # b*h, t, e
-        keys    = keys    / (e ** (1/4))
-
-        # get dot product of queries and keys
-        # - this will be a sparse matrix with the indices we've just computed, and values
-        #   defined by the dot product
-
-        # select the queries
-        indflat = indices.view(b*h*tp*vs, 2)
-        ar = torch.arange(b*h, dtype=torch.long, device=d(x))[:, None].expand(b*h, tp*vs).contiguous().view(b*h*tp*vs)
-        squeries = queries[ar, indflat[:, 0], :]
-        skeys    = keys   [ar, indflat[:, 1], :]
-
-        dot = torch.bmm(squeries[:, None, :], skeys[:, :, None]).view(b*h,tp*vs)
-        dot_logits = dot.data.clone()
-
-        assert not util.contains_inf(dot), f'dot contains inf (before norm) {dot.min()}, {dot.mean()}, {dot.max()}'
-        assert not util.contains_nan(dot), f'dot contains nan (before norm) {dot.min()}, {dot.mean()}, {dot.max()}'
-
-        if self.norm_method == 'softmax':
-            dot = sparse.logsoftmax(indices, weights * dot, size).exp()
-        else:
-            dot = sparse.simple_normalize(indices, weights * dot, size, method=self.norm_method)
-        # - dot now has row-wise self-attention probabilities
-
-        assert not util.contains_inf(dot), f'dot contains inf (after norm) {dot.min()}, {dot.mean()}, {dot.max()}'
-
-        try:
-            assert not util.contains_nan(dot), f'dot contains nan (after norm) {dot.min()}, {dot.mean()}, {dot.max()}'
-        except AssertionError:
-
-            print(dot.sum(dim=1))
-            print('\n\n\n')
-            for i in range(b*h):
-                print(f'*** {i}')
-                print(indices[i])
-                print(dot_logits[i])
-                print((weights * dot_logits)[i])
-
-
-                print('\n\n\n')
-
-            sys.exit()
-
-        # apply the self attention to the values
-        out = sparse.batchmm(indices, dot, size=size, xmatrix=values)
-
-        # swap h, t back, unify heads
-        out = out.transpose(1, 2).contiguous().view(b, t, h * s)
-        out = self.unifyheads(out)
-
-        assert not util.contains_nan(out), f'output contains nan {out}, dot min/max: {dot.min()}/{dot.max()}'
-
-        return out
-
 class ConvSelfAttention(nn.Module):
     """
     Self-attention with a hardwired convolutional sparsity pattern. That is, each node depends on the k
@@ -811,10 +117,10 @@ class ConvSelfAttention(nn.Module):
         keys    = self.tokeys(xp)
         values  = self.tovalues(xp)
 
-        # - fold heads into the batch dimension
-        queries = queries.transpose(1, 2) .contiguous().view(b * h, t, s)
-        keys    = keys.transpose(1, 2)    .contiguous().view(b * h, tp, s)
-        values  = values.transpose(1, 2)  .contiguous().view(b * h, tp, s)
+        # - move the heads in front of the time dimension
+        queries = queries.transpose(1, 2)
+        keys    = keys.transpose(1, 2)
+        values  = values.transpose(1, 2)
 
         queries = queries / (e ** (1/4)) # shoudl this be s?
         keys    = keys    / (e ** (1/4))
@@ -823,46 +129,79 @@ class ConvSelfAttention(nn.Module):
         # - this will be a sparse matrix with the indices we've just computed, and values
         #   defined by the dot product
 
-        # generate the indices (t*k pairs of integers per attention head)
+        # generate the indices (t*k pairs of integers, shared by all instances and heads)
         indices = torch.arange(t, dtype=torch.long, device=d(x))[:, None, None].expand(t, k, 2).contiguous()
         deltas  = torch.arange(k, dtype=torch.long, device=d(x))[None, :, None].expand(t, k, 1)
         indices[:, :, 1:] += deltas
-        indices = indices[None, None, :, :, :].expand(b, h, t, k, 2).contiguous()
-
-        indflat = indices.view(b*h*t*k, 2)
+        indices = indices.view(1, t*k, 2).expand(b, t*k, 2)
 
-        # select the queries and the keys (left and right column of index matrix) and take their dot
-        # product (note that they are already scaled)
-        ar = torch.arange(b*h, dtype=torch.long, device=d(x))[:, None].expand(b*h, t*k).contiguous().view(b*h*t*k)
-        squeries = queries[ar, indflat[:, 0], :]
-        skeys    = keys   [ar, indflat[:, 1], :]
-
-        dot = torch.bmm(squeries[:, None, :], skeys[:, :, None]).view(b*h,t*k)
-        indices = indices.view(b*h, t*k, 2)
+        # take the dot product of the selected queries and keys (left and right column of index matrix), note that
+        # they are already scaled
+        dot = sparse.sddmm(queries, keys, indices)
 
         # assert not util.contains_inf(dot), f'dot contains inf (before softmax) {dot.min()}, {dot.mean()}, {dot.max()}'
         # assert not util.contains_nan(dot), f'dot contains nan (before softmax) {dot.min()}, {dot.mean()}, {dot.max()}'
 
-        if self.norm_method == 'softmax':
-            dot = sparse.logsoftmax(indices, dot, size).exp()
-        else:
-            dot = sparse.simple_normalize(indices, dot, size, method=self.norm_method)
+        dot = sparse.attention.normalize(indices, dot, size, method=self.norm_method)
         # - dot now has row-wise self-attention probabilities
 
         # assert not util.contains_inf(dot), f'dot contains inf (after softmax) {dot.min()}, {dot.mean()}, {dot.max()}'
         # assert not util.contains_nan(dot), f'dot contains nan (after softmax) {dot.min()}, {dot.mean()}, {dot.max()}'
 
         # apply the self attention to the values
-        out = sparse.batchmm(indices, dot, size=size, xmatrix=values)
+        out = sparse.spmm(indices, dot, values, t)
 
         # swap h, t back, unify heads
-        out = out.transpose(1, 2).contiguous().view(b, t, h * s)
+        out = out.transpose(1, 2).reshape(b, t, h * s)
         out = self.unifyheads(out)
 
         assert not util.contains_nan(out), f'output contains nan {out}, dot min/max: {dot.min()}/{dot.max()}'
 
         return out
 
+    def init_cache(self, b, size, device):
+        """
+        Creates the cache for incremental decoding with step(): the keys and values so far, after the zero padding.
+        """
+        h, k, s = self.heads, self.k, self.emb // self.heads
+
+        return {
+            'pos' : 0, 'size' : size,
+            'keys' : torch.zeros(b, h, size + k - 1, s, device=device),
+            'values' : torch.zeros(b, h, size + k - 1, s, device=device)
+        }
+
+    def step(self, x, cache):
+        """
+        Computes the output at the next position from the cached keys and values of the k positions before it.
+
+        :param x: (b, e) input at the next position
+        :return: (b, e) output
+        """
+        b, e = x.size()
+        h, k, p, size = self.heads, self.k, cache['pos'], cache['size']
+        s = e // h
+
+        cache['pos'] = p + 1
+
+        x = x.view(b, h, s)
+
+        queries = self.toqueries(x) / (e ** (1/4))
+        cache['keys'][:, :, p + k - 1, :] = self.tokeys(x) / (e ** (1/4))
+        cache['values'][:, :, p + k - 1, :] = self.tovalues(x)
+
+        keys, values = cache['keys'][:, :, p:p + k, :], cache['values'][:, :, p:p + k, :]
+
+        indices = torch.tensor([p], device=d(x))[None, :, None].expand(b, k, 1)
+        indices = torch.cat([indices, torch.arange(p, p + k, device=d(x))[None, :, None].expand(b, k, 1)], dim=2)
+
+        dot = (queries[:, :, None, :] * keys).sum(dim=3)
+        dot = sparse.attention.normalize(indices, dot, (size, size + k - 1), method=self.norm_method)
+
+        out = (dot[:, :, :, None] * values).sum(dim=2)
+
+        return self.unifyheads(out.view(b, h * s))
+
 class SelfAttention(nn.Module):
     """
     Plain, dense self attention
@@ -935,6 +274,42 @@ class SelfAttention(nn.Module):
 
         return self.unifyheads(out)
 
+    def init_cache(self, b, size, device):
+        """
+        Creates the cache for incremental decoding with step(): the keys and values so far.
+        """
+        h, e = self.heads, self.emb
+
+        return {
+            'pos' : 0,
+            'keys' : torch.zeros(b, h, size, e, device=device),
+            'values' : torch.zeros(b, h, size, e, device=device)
+        }
+
+    def step(self, x, cache):
+        """
+        Computes the output at the next position, attending to the cached keys and values of all positions so far.
+
+        :param x: (b, e) input at the next position
+        :return: (b, e) output
+        """
+        b, e = x.size()
+        h, p = self.heads, cache['pos']
+
+        cache['pos'] = p + 1
+
+        cache['keys'][:, :, p, :] = self.tokeys(x).view(b, h, e) / (e ** (1/4))
+        cache['values'][:, :, p, :] = self.tovalues(x).view(b, h, e)
+
+        queries = self.toqueries(x).view(b, h, e) / (e ** (1/4))
+
+        dot = (queries[:, :, None, :] * cache['keys'][:, :, :p+1, :]).sum(dim=3)
+        dot = F.softmax(dot, dim=2)
+
+        out = (dot[:, :, :, None] * cache['values'][:, :, :p+1, :]).sum(dim=2)
+
+        return self.unifyheads(out.view(b, h * e))
+
 class TransformerBlock(nn.Module):
 
     def __init__(self, emb, heads, mask, ff_hidden_mult=4, dropout=0.0, type='dense', oned=True, **kwargs):
@@ -999,6 +374,37 @@ class TransformerBlock(nn.Module):
 
         return x
 
+    def init_cache(self, b, size, device):
+
+        if type(self.attention) is nn.Sequential:
+            return [layer.init_cache(b, size, device) for layer in self.attention]
+
+        return self.attention.init_cache(b, size, device)
+
+    def step(self, x, cache):
+        """
+        Incremental version of forward() for a single position (see GTransformer.step()).
+
+        :param x: (b, e) input at the next position
+        :return: (b, e) output
+        """
+        if type(self.attention) is nn.Sequential:
+            attended = x
+            for layer, lcache in zip(self.attention, cache):
+                attended = layer.step(attended, lcache)
+        else:
+            attended = self.attention.step(x, cache)
+
+        x = self.norm1(attended + x)
+        x = self.do(x)
+
+        fedforward = self.ff(x)
+
+        x = self.norm2(fedforward + x)
+        x = self.do(x)
+
+        return x
+
 class GTransformer(nn.Module):
     """
     Transformer for generating text (character by character).
@@ -1018,7 +424,7 @@ class GTransformer(nn.Module):
 
         super().__init__()
 
-        self.num_tokens = num_tokens
+        self.num_tokens, self.seq_length = num_tokens, seq_length
         self.token_embedding = nn.Embedding(embedding_dim=emb, num_embeddings=num_tokens)
         self.pos_embedding = nn.Embedding(embedding_dim=emb, num_embeddings=seq_length)
 
@@ -1048,6 +454,43 @@ class GTransformer(nn.Module):
 
         return F.log_softmax(x, dim=2)
 
+    def init_cache(self, b, device):
+        """
+        Creates the cache for incremental decoding with step(): per layer, the keys and values (and for the sparse layers
+        the index tuples) so far. The cache holds up to seq_length positions.
+
+        :param b: Batch size
+        :return: The cache, which step() updates in place.
+        """
+        return {
+            'pos' : 0,
+            'blocks' : [tblock.init_cache(b, self.seq_length, device) for tblock in self.tblocks]
+        }
+
+    def step(self, x, cache):
+        """
+        Incremental decoding: computes the predicted log-probabilities for the token after x, reusing the cached keys and
+        values of the preceding tokens, so the cost per token does not depend on the length of the context (apart from
+        a scan over the cached index tuples in the input-dependent sparse layers of rank 2). The result is the same as
+        that of forward() in eval mode at the same position (of a sequence of length seq_length). The model should be
+        in eval mode.
+
+        :param x: (b) tokens at the next position
+        :param cache: As returned by init_cache().
+        :return: (b, num_tokens) log-probabilities
+        """
+        p = cache['pos']
+        assert p < self.seq_length, f'The cache is full ({self.seq_length} positions)'
+
+        cache['pos'] = p + 1
+
+        x = self.token_embedding(x) + self.pos_embedding(torch.tensor(p, device=d(x)))[None, :]
+
+        for tblock, bcache in zip(self.tblocks, cache['blocks']):
+            x = tblock.step(x, bcache)
+
+        return F.log_softmax(self.toprobs(x), dim=1)
+
     def forward_for_plot(self, x):
         """
         :param x: A batch by sequence length integer tensor of token indices.
@@ -1081,19 +524,186 @@ class GTransformer(nn.Module):
 
         return means, sigmas, values
 
+def prime(model, input):
+    """
+    Feeds a context to a GTransformer token by token, to start incremental decoding.
+
+    :param input: (t) tensor of tokens
+    :return: The cache, and the (1, num_tokens) log-probabilities for the next token.
+    """
+    cache = model.init_cache(1, d(input))
+
+    for c in input:
+        output = model.step(c[None], cache)
+
+    return cache, output
+
+def evaluate(model, data, context, batch_size, min_context=None, cuda=False):
+    """
+    Computes the bits per byte of a model on the given data (see character_bits()).
+
+    :return: The bits per byte.
+    """
+    return character_bits(model, data, context, batch_size, min_context=min_context, cuda=cuda).sum() / data.size(0)
+
+def character_bits(model, data, context, batch_size, min_context=None, cuda=False):
+    """
+    Scores each character of the data under the model. The data is cut into overlapping windows of the context
+    length, with zero padding before the start, and in each window we score all positions that see at least
+    min_context characters (whatever precedes them in the window). Every character is scored once.
+
+    Scoring several positions per window is only correct if the output at a position does not depend on later inputs
+    (the targets of the earlier positions). The sparse attention layers only guarantee this in eval mode, so the
+    model is put in eval mode while scoring (and returned to its previous mode afterwards).
+
+    :param min_context: The minimum context of a scored position. The windows are context - min_context + 1 apart. If
+        None, this is the full context, which scores only the last position of each window (one forward per
+        character).
+    :return: An (n) tensor containing the number of bits for each character.
+    """
+    n = data.size(0)
+    m = context if min_context is None else min_context
+    stride = context - m + 1
+
+    assert 1 <= m <= context, f'The minimum context ({m}) should be between 1 and the context ({context})'
+
+    # - the last position of window j predicts character j * stride, so we need enough windows to reach the last
+    #   character. We pad the start, so that the first character is scored in a window of padding, and the end, so that
+    #   the last window is complete.
+    nwindows = math.ceil((n - 1) / stride) + 1
+    after = (nwindows - 1) * stride + 1 - n
+
+    padded = torch.cat([torch.zeros(context, dtype=torch.long), data.to(torch.long), torch.zeros(after, dtype=torch.long)], dim=0)
+    windows = padded.unfold(0, context + 1, stride) # (nwindows, context + 1) view
+
+    # index in the data of the target at each position of the first window
+    offsets = torch.arange(1, context + 1) - context
+    scored = torch.arange(context) >= m - 1
+
+    bits = torch.zeros(n, device='cuda' if cuda else 'cpu')
+    tot = 0
+
+    training = model.training
+    model.train(False)
+
+    try:
+        for fr in range(0, windows.size(0), batch_size):
+
+            batch = windows[fr:fr + batch_size]
+            b = batch.size(0)
+
+            # - which positions to score (and which targets are not padding)
+            targets = torch.arange(fr, fr + b)[:, None] * stride + offsets[None, :]
+            mask = scored[None, :] & (targets >= 0) & (targets < n)
+
+            if cuda:
+                batch, mask, targets = batch.cuda(), mask.cuda(), targets.cuda()
+
+            source, target = batch[:, :-1], batch[:, 1:]
+
+            output = model(source)
+
+            lnprobs = output.gather(2, target[:, :, None])[:, :, 0]
+            log2probs = lnprobs * LOG2E
+
+            bits[targets[mask]] = - log2probs[mask]
+            tot += int(mask.sum())
+    finally:
+        model.train(training)
+
+    assert tot == n, f'{tot} characters scored, expected {n}'
+
+    return bits
+
 def enwik8(path, n_train=int(90e6), n_valid=int(5e6), n_test=int(5e6)):
     """
     From https://github.com/openai/blocksparse/blob/master/examples/transformer/enwik8.py
+
+    The file is memory-mapped (copy-on-write), and the splits are views on the map, so nothing is read until it's used.
+
     :param path:
     :param n_train:
     :param n_valid:
     :param n_test:
-    :return:
+    :return: Three uint8 tensors.
     """
-    X = np.fromstring(open(path).read(n_train + n_valid + n_test), dtype=np.uint8)
+    n = min(n_train + n_valid + n_test, os.path.getsize(path))
+
+    X = np.memmap(path, dtype=np.uint8, mode='c', shape=(n, ))
     trX, vaX, teX = np.split(X, [n_train, n_train + n_valid])
     return torch.from_numpy(trX), torch.from_numpy(vaX), torch.from_numpy(teX)
 
+def batch(data, starts, context):
+    """
+    Selects a batch of subsequences from the data, with a single gather.
+
+    :param data: (n) tensor of tokens
+    :param starts: (b) LongTensor of start indices
+    :param context: The length of the subsequences
+    :return: (b, context) LongTensors of the source and target (source shifted by one) sequences.
+    """
+    seqs = data[starts[:, None] + torch.arange(context + 1)[None, :]].to(torch.long)
+
+    return seqs[:, :-1], seqs[:, 1:]
+
+def sample_batch(data, batch_size, context, generator=None):
+    """
+    Samples a batch of random subsequences from the data (see batch()).
+    """
+    starts = torch.randint(size=(batch_size, ), low=0, high=data.size(0) - context - 1, generator=generator)
+
+    return batch(data, starts, context)
+
+class Prefetcher:
+    """
+    Samples training batches ahead of time in a background thread, and keeps them in a bounded buffer. Optionally, the
+    batches are put in pinned memory, so they can be copied to the GPU asynchronously.
+
+    The start indices are drawn from a generator seeded from the global RNG, so the batches are reproducible.
+    """
+
+    def __init__(self, data, batch_size, context, buffer=4, pin=False):
+        """
+        :param buffer: The maximum number of batches to sample ahead.
+        :param pin: Whether to put the batches in pinned memory.
+        """
+        self.data, self.batch_size, self.context, self.pin = data, batch_size, context, pin
+
+        self.generator = torch.Generator()
+        self.generator.manual_seed(int(torch.randint(2**62, size=(1, ))))
+
+        self.queue, self.stop = queue.Queue(maxsize=buffer), threading.Event()
+
+        thread = threading.Thread(target=self.produce, daemon=True)
+        thread.start()
+
+    def produce(self):
+
+        while not self.stop.is_set():
+            source, target = sample_batch(self.data, self.batch_size, self.context, generator=self.generator)
+
+            if self.pin:
+                source, target = source.pin_memory(), target.pin_memory()
+
+            while not self.stop.is_set():
+                try:
+                    self.queue.put((source, target), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self):
+        """
+        :return: The next batch of source and target sequences.
+        """
+        return self.queue.get()
+
+    def close(self):
+        """
+        Stops the producer thread.
+        """
+        self.stop.set()
+
 def go(arg):
 
     util.makedirs('./transformer-plots/')
@@ -1117,12 +727,14 @@ def go(arg):
         model = GTransformer(emb=arg.embedding_size, heads=arg.num_heads, depth=arg.depth, seq_length=arg.context,
                              num_tokens=NUM_TOKENS, sparse=True, gadditional=arg.gadditional, radditional=arg.radditional,
                              region=arg.region, k=arg.k, min_sigma=arg.min_sigma, sigma_scale=arg.sigma_mult,
-                             oned=(arg.model == 'sparse1d'), norm_method=arg.norm_method, clamp=arg.clamp)
+                             oned=(arg.model == 'sparse1d'), norm_method=arg.norm_method, clamp=arg.clamp,
+                             presample=arg.presample)
     elif arg.model == 'strided':
         model = GTransformer(emb=arg.embedding_size, heads=arg.num_heads, depth=arg.depth, seq_length=arg.context,
                              num_tokens=NUM_TOKENS, gadditional=arg.gadditional, radditional=arg.radditional,
                              region=arg.region, k=arg.k, min_sigma=arg.min_sigma, sigma_scale=arg.sigma_mult,
-                             norm_method=arg.norm_method, clamp=arg.clamp, stride=arg.stride, type='strided')
+                             norm_method=arg.norm_method, clamp=arg.clamp, stride=arg.stride, type='strided',
+                             presample=arg.presample)
     elif arg.model == 'conv':
         model = GTransformer(emb=arg.embedding_size, heads=arg.num_heads, depth=arg.depth, seq_length=arg.context, k=arg.kconv,
                              num_tokens=NUM_TOKENS, type='conv', norm_method=arg.norm_method)
@@ -1133,7 +745,7 @@ def go(arg):
         model = GTransformer(emb=arg.embedding_size, heads=arg.num_heads, depth=arg.depth, seq_length=arg.context,
                              num_tokens=NUM_TOKENS, gadditional=arg.gadditional, radditional=arg.radditional,
                              region=arg.region, k=arg.k, min_sigma=arg.min_sigma, sigma_scale=arg.sigma_mult,
-                             norm_method=arg.norm_method, clamp=arg.clamp, stride=arg.stride, type='mixed',
+                             norm_method=arg.norm_method, clamp=arg.clamp, stride=arg.stride, type='mixed', presample=arg.presample,
                              kconv=arg.kconv, mixture=arg.mixture)
 
     else:
@@ -1144,6 +756,8 @@ def go(arg):
 
     opt = torch.optim.Adam(lr=arg.lr, params=model.parameters())
 
+    prefetcher = Prefetcher(data_train, arg.batch_size, arg.context, buffer=arg.prefetch, pin=arg.cuda) if arg.prefetch > 0 else None
+
     # training loop
     for i in tqdm.trange(arg.num_batches):
 
@@ -1154,14 +768,13 @@ def go(arg):
         opt.zero_grad()
 
         # sample batches
-        starts = torch.randint(size=(arg.batch_size, ), low=0, high=data_train.size(0) - arg.context - 1)
-        seqs_source = [data_train[start  :start+arg.context  ] for start in starts]
-        seqs_target = [data_train[start+1:start+arg.context+1] for start in starts]
-        source = torch.cat([s[None, :] for s in seqs_source ], dim=0).to(torch.long)
-        target = torch.cat([s[None, :] for s in seqs_target ], dim=0).to(torch.long)
+        if prefetcher is None:
+            source, target = sample_batch(data_train, arg.batch_size, arg.context)
+        else:
+            source, target = prefetcher.get()
 
         if arg.cuda:
-            source, target = source.cuda(), target.cuda()
+            source, target = source.cuda(non_blocking=True), target.cuda(non_blocking=True)
 
         source, target = Variable(source), Variable(target)
 
@@ -1226,48 +839,8 @@ def go(arg):
             data_sub = data_test[:upto]
 
             with torch.no_grad():
-                bits, tot = 0.0, 0
-                batch = []
-
-                for current in range(data_sub.size(0)):
-
-                    fr = max(0, current - arg.context)
-                    to = current + 1
-
-                    context = data_sub[fr:to].to(torch.long)
-                    if context.size(0) < arg.context + 1:
-                        pad = torch.zeros(size=(arg.context + 1 - context.size(0),), dtype=torch.long)
-                        context = torch.cat([pad, context], dim=0)
-
-                        assert context.size(0) == arg.context + 1
-
-                    if arg.cuda:
-                        context = context.cuda()
-
-                    batch.append(context[None, :])
-
-                    if len(batch) == arg.test_batchsize or current == data_sub.size(0) - 1:
 
-                        b = len(batch)
-
-                        tot += b
-
-                        all = torch.cat(batch, dim=0)
-                        source = all[:, :-1]
-                        target = all[:, -1]
-
-                        output = model(source)
-
-                        lnprobs = output[torch.arange(b, device=dv), -1, target]
-                        log2probs = lnprobs * LOG2E
-
-                        bits += - log2probs.sum()
-
-                        batch = []
-
-                assert tot == data_sub.size(0)
-
-                bits_per_byte = bits / data_sub.size(0)
+                bits_per_byte = evaluate(model, data_sub, arg.context, arg.test_batchsize, min_context=arg.test_min_context, cuda=arg.cuda)
 
                 print(f'epoch{i}: {bits_per_byte:.4} bits per byte')
                 # print(f'epoch{i}: {bits:.4} total bits')
@@ -1290,15 +863,29 @@ def go(arg):
                     print(str(chr(c)), end='', flush=True)
                 print(']', end='', flush=True)
 
+                # - we decode incrementally, from cached keys and values, so the model should be in eval mode
+                model.eval()
+                cache, output = prime(model, input)
+
                 for _ in range(GENSIZE):
-                    output = model(input[None, :])
-                    c = sample(output[0, -1, :], TEMP)
+                    c = sample(output[0, :], TEMP)
                     print(str(chr(max(32, c))), end='', flush=True)
 
                     input = torch.cat([input[1:], c[None]], dim=0)
 
+                    if cache['pos'] == arg.context:
+                        # the cache is full, restart from the most recent half of the context
+                        cache, output = prime(model, input[-(arg.context // 2):])
+                    else:
+                        output = model.step(c[None], cache)
+
+                model.train()
+
                 print()
 
+    if prefetcher is not None:
+        prefetcher.close()
+
 if __name__ == "__main__":
 
     ## Parse the command line options
@@ -1321,7 +908,7 @@ if __name__ == "__main__":
 
     parser.add_argument("--norm",
                         dest="norm_method",
-                        help="How to normalize the attention matrix (softmax, softplus, abs).",
+                        help="How to normalize the attention matrix (softmax, exact, softplus, abs). For the sparse attention, softmax and exact are the same: both subtract the exact row maxima.",
                         default='softmax', type=str)
 
     parser.add_argument("-b", "--batch-size",
@@ -1426,6 +1013,13 @@ if __name__ == "__main__":
                         help="A subset for the validation tests.",
                         default=100000, type=int)
 
+    parser.add_argument("--test-min-context",
+                        dest="test_min_context",
+                        help="Minimum context for the characters scored in the evaluation. Every forward over a window scores all characters "
+                             "with at least this much context, so smaller values need fewer forwards. Defaults to the full context "
+                             "(one forward per character).",
+                        default=None, type=int)
+
     parser.add_argument("--test-batchsize",
                         dest="test_batchsize",
                         help="Batch size for computing the validation loss.",
@@ -1445,6 +1039,16 @@ if __name__ == "__main__":
                         help="Use the clamp operation to fit the parameters to the space of index tuples.",
                         action="store_true")
 
+    parser.add_argument("--prefetch",
+                        dest="prefetch",
+                        help="Sample the training batches ahead of time in a background thread, buffering this many (0 to sample them when needed).",
+                        default=0, type=int)
+
+    parser.add_argument("--presample",
+                        dest="presample",
+                        help="Draw the random numbers for the sparse attention ahead of time in a background thread, buffering this many (sparse1d, strided and mixed models).",
+                        default=None, type=int)
+
 
     options = parser.parse_args()
 
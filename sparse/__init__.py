@@ -1,8 +1,11 @@
 from .sort import Split, SortLayer
 
-from .layers import SparseLayer, NASLayer, Convolution, transform_means, transform_sigmas
+from .layers import SparseLayer, NASLayer, Convolution, SampleRNG, Presampler, transform_means, transform_sigmas
 from .layers import ngenerate, transform_means, densities
 
 from .tensors import contract, logsoftmax, batchmm, simple_normalize
 
+from .attention import sddmm, spmm, SparseSelfAttention
+from .attention import MSparseSelfAttention, ASH2DSelfAttention, ASH1DSelfAttention, StridedSparseSelfAttention
+
 # from .tensors import flatten_indices_mat
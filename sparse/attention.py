@@ -0,0 +1,737 @@
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+import tensors
+
+from sparse import util
+from sparse.util import d
+from sparse.layers import ngenerate, densities, transform_means, transform_sigmas, SampleRNG, Presampler, EPSILON
+
+"""
+Sparse self-attention.
+
+```sddmm()``` computes the dot products of queries and keys for a sparse set of index tuples, ```normalize()``` turns
+these into attention weights, and ```spmm()``` applies the weights to the values. All three take one set of index
+tuples, shared by all heads.
+
+```SparseSelfAttention``` samples the index tuples (once per layer) and chains these together. The variants at the
+bottom of this file only define how the continuous index tuples are computed.
+"""
+
+# Maximum number of elements in the gathered queries/keys/values of a single tile
+TILE_ELEMENTS = 2 ** 22
+
+def expand(indices, h, e, transpose=False):
+    """
+    Expands a batch of index tuples, shared by all heads, to gather/scatter index tensors for rows and columns. The
+    results are views, nothing is copied.
+
+    :param indices: (b, n, 2) LongTensor
+    :param transpose: Swap the roles of rows and columns.
+    :return: Two (b, h, n, e) LongTensors
+    """
+    b, n, _ = indices.size()
+
+    rows = indices[:, None, :, 0:1].expand(b, h, n, e)
+    cols = indices[:, None, :, 1:2].expand(b, h, n, e)
+
+    return (cols, rows) if transpose else (rows, cols)
+
+def tiles(n, tile):
+    for fr in range(0, n, tile):
+        yield fr, min(fr + tile, n)
+
+def tile_size(b, h, e):
+    return max(1, TILE_ELEMENTS // (b * h * e))
+
+def _sddmm(queries, keys, indices, tile):
+
+    b, h, _, e = queries.size()
+    n = indices.size(1)
+
+    result = queries.new_empty(b, h, n)
+
+    for fr, to in tiles(n, tile):
+        rows, cols = expand(indices[:, fr:to], h, e)
+        result[:, :, fr:to] = (queries.gather(2, rows) * keys.gather(2, cols)).sum(dim=3)
+
+    return result
+
+def _spmm(indices, weights, values, height, tile, transpose=False):
+
+    b, h, _, e = values.size()
+    n = indices.size(1)
+
+    result = values.new_zeros(b, h, height, e)
+
+    for fr, to in tiles(n, tile):
+        rows, cols = expand(indices[:, fr:to], h, e, transpose)
+        result.scatter_add_(2, rows, weights[:, :, fr:to, None] * values.gather(2, cols))
+
+    return result
+
+class SDDMM(torch.autograd.Function):
+    """
+    Sampled dense-dense matrix multiplication: computes the dot products of the queries and keys for a sparse set of
+    index tuples, shared by all heads.
+
+    The gathered queries and keys are only materialized for one tile of index tuples at a time, both in the forward and
+    in the backward pass. Only the queries, the keys and the index tuples are stored for the backward.
+    """
+
+    @staticmethod
+    def forward(ctx, queries, keys, indices, tile):
+        """
+        :param queries: (b, h, tq, e) tensor
+        :param keys: (b, h, tk, e) tensor
+        :param indices: (b, n, 2) LongTensor of (query, key) index tuples
+        :param tile: The number of index tuples per tile
+        :return: (b, h, n) tensor of dot products
+        """
+        ctx.save_for_backward(queries, keys, indices)
+        ctx.tile = tile
+
+        return _sddmm(queries, keys, indices, tile)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        queries, keys, indices = ctx.saved_tensors
+
+        # - the gradient for the queries multiplies the sparse matrix of output gradients by the keys, and the gradient
+        #   for the keys multiplies its transpose by the queries
+        grad_queries = _spmm(indices, grad_output, keys, queries.size(2), ctx.tile)
+        grad_keys = _spmm(indices, grad_output, queries, keys.size(2), ctx.tile, transpose=True)
+
+        return grad_queries, grad_keys, None, None
+
+class SpMM(torch.autograd.Function):
+    """
+    Multiplies a batch of sparse matrices, with index tuples shared by all heads, by a batch of dense matrices, one tile
+    of index tuples at a time. Only the weights, the values and the index tuples are stored for the backward.
+    """
+
+    @staticmethod
+    def forward(ctx, indices, weights, values, height, tile):
+        """
+        :param indices: (b, n, 2) LongTensor of (row, column) index tuples
+        :param weights: (b, h, n) tensor of weights
+        :param values: (b, h, w, e) tensor
+        :param height: The height of the sparse matrices
+        :param tile: The number of index tuples per tile
+        :return: (b, h, height, e) tensor
+        """
+        ctx.save_for_backward(indices, weights, values)
+        ctx.tile = tile
+
+        return _spmm(indices, weights, values, height, tile)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        indices, weights, values = ctx.saved_tensors
+
+        grad_weights = grad_values = None
+
+        if ctx.needs_input_grad[1]:
+            grad_weights = _sddmm(grad_output, values, indices, ctx.tile)
+        if ctx.needs_input_grad[2]:
+            grad_values = _spmm(indices, weights, grad_output, values.size(2), ctx.tile, transpose=True)
+
+        return None, grad_weights, grad_values, None, None
+
+def sddmm(queries, keys, indices, tile=None):
+    """
+    Computes the dot products of queries and keys for a sparse set of index tuples.
+
+    :param queries: (b, h, tq, e) tensor of queries (for b instances and h heads)
+    :param keys: (b, h, tk, e) tensor of keys
+    :param indices: (b, n, 2) LongTensor of (query, key) index tuples, shared by all heads. This may be an expanded view.
+    :param tile: The number of index tuples to process at once. If None, this is chosen so that a tile of gathered
+        queries has at most TILE_ELEMENTS elements.
+    :return: (b, h, n) tensor of dot products
+    """
+    b, h, _, e = queries.size()
+
+    return SDDMM.apply(queries, keys, indices, tile_size(b, h, e) if tile is None else tile)
+
+def spmm(indices, weights, values, height, tile=None):
+    """
+    Multiplies a batch of sparse matrices by a batch of dense matrices. The sparse matrices of all heads share their
+    index tuples.
+
+    :param indices: (b, n, 2) LongTensor of (row, column) index tuples. This may be an expanded view.
+    :param weights: (b, h, n) tensor of weights
+    :param values: (b, h, w, e) tensor
+    :param height: The height of the sparse matrices
+    :param tile: The number of index tuples to process at once (see sddmm()).
+    :return: (b, h, height, e) tensor
+    """
+    b, h, _, e = values.size()
+
+    return SpMM.apply(indices, weights, values, height, tile_size(b, h, e) if tile is None else tile)
+
+def normalize(indices, dot, size, method='softmax', mask=None):
+    """
+    Normalizes the rows of a batch of sparse attention matrices. The matrices of all heads share their index tuples.
+
+    :param indices: (b, n, 2) LongTensor of index tuples
+    :param dot: (b, h, n) tensor of (weighted) dot products
+    :param size: The size of the attention matrices
+    :param method: 'softmax' (or 'exact') for the softmax, or 'softplus', 'abs' or 'relu' to normalize the rows after
+        applying the given function (see tensors.simple_normalize()). Unlike tensors.logsoftmax(), where 'softmax'
+        approximates the row maxima iteratively, both softmax options here subtract the exact row maxima (found with a
+        single segment reduction). Since the maxima only serve for numerical stability, the results are the same.
+    :param mask: Optional (b, n) bool tensor. The index tuples where it is True are left out: they get weight zero,
+        and do not count towards the normalization of their row.
+    :return: (b, h, n) tensor of attention weights
+    """
+    b, h, n = dot.size()
+
+    ids, nsegments = tensors.segments(indices, size)
+    values = dot.transpose(1, 2) # - the heads are reduced separately, as a trailing dimension
+
+    if mask is not None:
+        mask = mask[:, :, None].expand(b, n, h)
+
+    epsilon = 1e-7
+
+    if method in ('softmax', 'exact'):
+        # - the max is a constant for the purposes of the gradient
+        detached = values.detach() if mask is None else values.detach().masked_fill(mask, float('-inf'))
+        maxes = tensors.segment_max(detached, ids, nsegments)[ids].view(b, n, h)
+
+        values = values - maxes
+        if mask is not None: # - masked before the exp, since the max of a fully masked row is -inf
+            values = values.masked_fill(mask, float('-inf'))
+        values = values.exp()
+
+        epsilon = 0.0
+    elif method == 'softplus':
+        values = F.softplus(values)
+    elif method == 'abs':
+        values = values.abs()
+    elif method == 'relu':
+        values = F.relu(values)
+    else:
+        raise Exception(f'Method {method} not recognized')
+
+    if mask is not None:
+        values = values.masked_fill(mask, 0.0)
+
+    sums = tensors.segment_sum(values, ids, nsegments)[ids].view(b, n, h)
+
+    if mask is not None: # - avoids 0/0 for the masked tuples of a fully masked row
+        sums = sums.masked_fill(mask, 1.0)
+
+    return (values / (sums + epsilon)).transpose(1, 2)
+
+class SparseSelfAttention(nn.Module):
+    """
+    Sparse self attention, with a small number of index tuples sampled around continuous index tuples (MVNs) for each
+    output.
+
+    The continuous index tuples come from hyper(), which subclasses implement. With rank 2, these are points in the
+    attention matrix (flipped to below the diagonal). With rank 1, they are the input coordinates, and each set of MVNs
+    belongs to one output row, given by rows().
+
+    The index tuples are sampled once per forward, and shared by all heads.
+    """
+    def __init__(self, emb, k, gadditional, radditional, region, heads=8, rank=1, split_heads=False, min_sigma=0.05,
+                 sigma_scale=0.1, norm_method='softmax', presample=None, epsilon=EPSILON, **kwargs):
+        """
+        :param emb:
+        :param k: Number of MVNs per set of continuous index tuples
+        :param gadditional: Number of index tuples to sample uniformly from the whole matrix, per MVN
+        :param radditional: Number of index tuples to sample from the region around each MVN
+        :param region:
+        :param heads:
+        :param rank: The number of sampled coordinates per index tuple (see above)
+        :param split_heads: If True, each head gets a slice of emb/heads dimensions of the input. If False, each head
+            projects the whole input to emb dimensions.
+        :param norm_method: How to normalize the attention weights (see normalize()).
+        :param presample: Size of the buffer of random numbers drawn ahead of time in a background thread. None to
+            draw them when needed.
+        :param epsilon: Passed to ngenerate().
+        :param kwargs: Ignored.
+        """
+        super().__init__()
+
+        self.rng = SampleRNG() # per-layer RNG for the sampling
+        self.presampler = None if presample is None else Presampler(self.rng, presample)
+
+        self.emb, self.heads, self.rank, self.split_heads = emb, heads, rank, split_heads
+        self.min_sigma, self.sigma_scale, self.norm_method, self.epsilon = min_sigma, sigma_scale, norm_method, epsilon
+
+        self.gadditional = gadditional
+        self.radditional = radditional
+        self.region = region
+        self.k = k
+
+        s = emb // heads if split_heads else emb
+        i, o = (s, s) if split_heads else (emb, emb * heads)
+
+        self.tokeys    = nn.Linear(i, o, bias=False)
+        self.toqueries = nn.Linear(i, o, bias=False)
+        self.tovalues  = nn.Linear(i, o, bias=False)
+
+        self.unifyheads = nn.Linear(s * heads, emb)
+
+        self.register_buffer('mvalues', torch.ones((k, )))
+
+    # Whether the continuous index tuples are independent of the input (see step())
+    static = False
+
+    def hyper(self, x):
+        """
+        Computes the continuous index tuples. The default computes them with hyper_at(), for the rows given by rows().
+
+        :param x: (b, t, e) input
+        :return: (b, r, k, rank) means, (b, r, k) sigmas, and (b, r, k) values.
+        """
+        b, t, e = x.size()
+        rows = self.rows(t, d(x))
+
+        return self.hyper_at(x[:, rows, :], rows, t)
+
+    def hyper_at(self, x, rows, t, summed=None):
+        """
+        Computes the continuous index tuples of the given rows only. For rank 1, these are the output rows. For an
+        input-dependent layer of rank 2, these are the positions whose inputs generate the sets of MVNs.
+
+        :param x: (b, r, e) inputs at the given rows
+        :param rows: (r) LongTensor of row indices
+        :param t: The length of the whole sequence
+        :param summed: (b, r, e) means of the inputs preceding each row
+        :return: (b, r, k, rank) means, (b, r, k) sigmas, and (b, r, k) values.
+        """
+        raise NotImplementedError()
+
+    def rows(self, t, device):
+        """
+        For rank 1, the output rows of the r sets of MVNs returned by hyper().
+
+        :return: (r) LongTensor
+        """
+        return torch.arange(t, dtype=torch.long, device=device)
+
+    def sample(self, x):
+        """
+        Samples the index tuples of the attention matrices, and computes their weights.
+
+        In eval mode, the index tuples are the rounded means. Duplicates within a set of MVNs are left out (in training,
+        they get zero weight).
+
+        In both modes, the index tuples that would make the output at a position depend on later inputs are left out:
+        for rank 1 the sampled index tuples that point forward, and for input-dependent layers of rank 2 the index
+        tuples that the set of position i puts in a row before i. This way the model is trained with the same causal
+        attention that it is evaluated with (and that step() reproduces).
+
+        :param x: (b, t, e) input
+        :return: (b, n, 2) LongTensor of index tuples, (b, n) tensor of weights, and a (b, n) bool tensor marking the
+            index tuples that normalize() should leave out (or None).
+        """
+        b, t, e = x.size()
+        rank = self.rank
+        rng = (t, ) * rank
+
+        means, sigmas, mvalues = self.hyper(x)
+        r = means.size(1)
+
+        if not self.training:
+            # - in eval mode, we use the rounded means, so that the index tuples are deterministic
+            indices = means.round().long()
+
+            if rank == 1:
+                rows = self.rows(t, d(x))[None, :, None, None].expand(b, r, self.k, 1)
+                indices = torch.cat([rows, torch.min(indices, rows)], dim=3)
+
+            # - mask out duplicate index tuples. Unlike in training, a zero weight would still give them a share of
+            #   the softmax.
+            mask = util.nduplicates(indices, rng=(t, t))
+
+            if rank == 2 and not self.static:
+                # - the set of MVNs at position i only contributes to rows i and later
+                mask = mask | (indices[:, :, :, 0] < self.rows(t, d(x))[None, :, None])
+
+            return indices.view(b, r * self.k, 2), mvalues.reshape(b, r * self.k), mask.view(b, r * self.k)
+
+        # sample integer indices
+        indices = ngenerate(means, self.gadditional, self.radditional, rng=rng, relative_range=(self.region, ) * rank,
+                            cuda=x.is_cuda, epsilon=self.epsilon, generator=self.rng.generator(d(x)),
+                            sampler=self.presampler)
+        if rank == 2:
+            indices = util.flip(indices)
+
+        vs = indices.size(2)
+
+        # compute (unnormalized) densities under the given MVNs (proportions)
+        props = densities(indices.float(), means, sigmas).clone() # (b, r, vs, k)
+
+        # - mask out duplicate indices
+        props[util.nduplicates(indices, rng=rng), :] = 0
+
+        # - index tuples that normalize() should leave out. A zero weight would still give them a share of the
+        #   softmax, and through it, let the output depend on later inputs.
+        mask = None
+
+        if rank == 1:
+            rows = self.rows(t, d(x))[None, :, None, None]
+            # - mask out any forward connections. While all the continuous index tuples are guaranteed to point
+            #   backwards, the sampled discrete index tuples might point forward.
+            mask = (indices > rows)[:, :, :, 0]
+            props = props.masked_fill(indices > rows, 0.0)
+
+            indices = torch.cat([rows.expand(b, r, vs, 1), indices], dim=3)
+        elif not self.static:
+            # - the set of MVNs at position i only contributes to rows i and later (as in eval mode)
+            mask = indices[:, :, :, 0] < self.rows(t, d(x))[None, :, None]
+
+        props = props / props.sum(dim=2, keepdim=True) # normalize over all remaining points of a given index tuple
+
+        # weight the values by the proportions, and sum out the MVNs
+        weights = (props * mvalues[:, :, None, :]).sum(dim=3)
+
+        return indices.view(b, r * vs, 2), weights.view(b, r * vs), None if mask is None else mask.reshape(b, r * vs)
+
+    def forward(self, x):
+
+        b, t, e = x.size()
+        h = self.heads
+
+        assert e == self.emb, f'Input embedding dim ({e}) should match layer embedding dim ({self.emb})'
+
+        indices, weights, mask = self.sample(x)
+
+        # compute keys, queries, values, and move the heads in front of the time dimension
+        xh = x.view(b, t, h, e // h) if self.split_heads else x
+        keys, queries, values = [y.view(b, t, h, -1).transpose(1, 2) for y in (self.tokeys(xh), self.toqueries(xh), self.tovalues(xh))]
+
+        queries = queries / (e ** (1/4))
+        keys    = keys    / (e ** (1/4))
+
+        # get dot product of queries and keys
+        dot = sddmm(queries, keys, indices)
+        dot = normalize(indices, weights[:, None, :] * dot, (t, t), method=self.norm_method, mask=mask)
+        # - dot now has row-wise self-attention probabilities
+
+        # apply the self attention to the values
+        out = spmm(indices, dot, values, t)
+
+        # swap h, t back, unify heads
+        out = out.transpose(1, 2).reshape(b, t, -1)
+
+        return self.unifyheads(out)
+
+    def init_cache(self, b, size, device):
+        """
+        Creates the cache for incremental decoding with step().
+
+        :param b: Batch size
+        :param size: The length of the sequence (the forward that step() reproduces).
+        :return: A dictionary, which step() updates in place.
+        """
+        h, e = self.heads, self.emb
+        s = e // h if self.split_heads else e
+
+        cache = {
+            'pos' : 0, 'size' : size,
+            'keys' : torch.zeros(b, h, size, s, device=device),
+            'values' : torch.zeros(b, h, size, s, device=device),
+            'sum' : torch.zeros(b, e, device=device) # sum of the inputs so far
+        }
+
+        if self.rank == 1:
+            cache['rows'] = set(self.rows(size, 'cpu').tolist())
+        elif self.static:
+            # - the index tuples are the same for every input, so we compute them once, and split them by row
+            indices, weights, mask = self.sample(torch.zeros(1, size, e, device=device))
+            rows = [(indices[0, :, 0] == i) & ~ mask[0] for i in range(size)]
+            cache['tuples'] = [(indices[:, row], weights[:, row]) for row in rows]
+        else:
+            # - the index tuples of each position, added as the positions come in
+            cache['tuples'] = torch.zeros(b, size * self.k, 2, dtype=torch.long, device=device)
+            cache['weights'] = torch.zeros(b, size * self.k, device=device)
+            cache['mask'] = torch.ones(b, size * self.k, dtype=torch.bool, device=device)
+
+        return cache
+
+    def step(self, x, cache):
+        """
+        Computes the output at the next position of the cached sequence, attending only to the cached keys and values
+        of the index tuples in its row. This gives the same result as the eval-mode forward over the whole sequence (of
+        the length given to init_cache()).
+
+        For input-dependent layers of rank 2, the index tuples of each position are computed (for the whole sequence
+        length) when it comes in, and cached. The index tuples of a row then come from the positions up to it (see
+        sample()), which have all been seen.
+
+        :param x: (b, e) input at the next position
+        :param cache: As returned by init_cache()
+        :return: (b, e) output at this position
+        """
+        b, e = x.size()
+        h, p, size = self.heads, cache['pos'], cache['size']
+
+        assert not self.training, 'Incremental decoding uses the eval-mode index tuples'
+        assert p < size, f'The cache is full ({size} positions)'
+
+        cache['pos'] = p + 1
+
+        xh = x.view(b, 1, h, e // h) if self.split_heads else x[:, None, :]
+        keys, queries, values = [y.view(b, h, -1) for y in (self.tokeys(xh), self.toqueries(xh), self.tovalues(xh))]
+
+        cache['keys'][:, :, p, :] = keys / (e ** (1/4))
+        cache['values'][:, :, p, :] = values
+        queries = queries / (e ** (1/4))
+
+        summed = cache['sum'] / (p + 1)
+        cache['sum'] += x
+
+        if self.rank == 1:
+            if p not in cache['rows']: # - no attention for this output
+                return self.unifyheads(x.new_zeros(b, h * values.size(-1)))
+
+            means, _, mvalues = self.hyper_at(x[:, None, :], torch.tensor([p], device=d(x)), size, summed[:, None, :])
+
+            cols = means.round().long().view(b, self.k).clamp(max=p)
+            indices = torch.stack([torch.full_like(cols, p), cols], dim=2)
+            weights = mvalues.reshape(b, self.k)
+            mask = util.nduplicates(indices, rng=(size, size))
+        elif self.static:
+            indices, weights = cache['tuples'][p]
+            indices, weights, mask = indices.expand(b, -1, 2), weights.expand(b, -1), None
+        else:
+            k = self.k
+            means, _, mvalues = self.hyper_at(x[:, None, :], torch.tensor([p], device=d(x)), size)
+
+            tuples = means.round().long().view(b, k, 2)
+            fr, to = p * k, (p + 1) * k
+
+            cache['tuples'][:, fr:to] = tuples
+            cache['weights'][:, fr:to] = mvalues.reshape(b, k)
+            cache['mask'][:, fr:to] = util.nduplicates(tuples, rng=(size, size)) | (tuples[:, :, 0] < p)
+
+            # - select the index tuples in row p, and move them to the front
+            select = (cache['tuples'][:, :to, 0] == p) & ~ cache['mask'][:, :to]
+            _, order = select.to(torch.uint8).sort(dim=1, descending=True, stable=True)
+            order = order[:, :int(select.sum(dim=1).max())]
+
+            indices = cache['tuples'].gather(1, order[:, :, None].expand(-1, -1, 2))
+            weights = cache['weights'].gather(1, order)
+            mask = ~ select.gather(1, order) # - for instances with fewer tuples in this row
+
+        n, s = indices.size(1), values.size(-1)
+        cols = indices[:, None, :, 1:].expand(b, h, n, s)
+
+        dot = (queries[:, :, None, :] * cache['keys'].gather(2, cols)).sum(dim=3)
+        dot = normalize(indices, weights[:, None, :] * dot, (size, size), method=self.norm_method, mask=mask)
+
+        out = (dot[:, :, :, None] * cache['values'].gather(2, cols)).sum(dim=2)
+
+        return self.unifyheads(out.reshape(b, -1))
+
+class MSparseSelfAttention(SparseSelfAttention):
+    """
+    Masked sparse self attention (two degrees of freedom). The MVNs are parameters, shared by all outputs.
+    """
+    static = True
+
+    def __init__(self, emb, k, gadditional, radditional, region, heads=8, min_sigma=0.05, sigma_scale=1.0, **kwargs):
+
+        super().__init__(emb, k, gadditional, radditional, region, heads=heads, rank=2, min_sigma=min_sigma,
+                         sigma_scale=sigma_scale, **kwargs)
+
+        self.means  = nn.Parameter(torch.randn((k, 2)))
+        self.sigmas = nn.Parameter(torch.randn((k, )))
+
+    def hyper(self, x):
+
+        b, t, e = x.size()
+        k = self.k
+
+        # generate the continuous parameters
+        means = self.means[None, None, :, :].expand(b, 1, k, 2)
+        sigmas = self.sigmas[None, None, :].expand(b, 1, k)
+        values = self.mvalues[None, None, :].expand(b, 1, k)
+
+        means = util.flip(means.contiguous())  # flip everything to below the diagonal of the matrix
+
+        s = (t, t)
+        means, sigmas = transform_means(means, s), \
+                        transform_sigmas(sigmas, s, min_sigma=self.min_sigma) * self.sigma_scale
+
+        return means, sigmas, values
+
+class ASH2DSelfAttention(SparseSelfAttention):
+    """
+    Masked sparse self attention. Two degrees of freedom, the receptive field is adaptive, based on the incoming
+    embedding vector and coordinate.
+    """
+    def __init__(self, emb, k, gadditional, radditional, region, heads=8, mmult=1.0, **kwargs):
+
+        super().__init__(emb, k, gadditional, radditional, region, heads=heads, rank=2, **kwargs)
+
+        self.mmult = mmult
+
+        # network that generates the coordinates and sigmas
+        hidden = emb * 4
+        self.toparams = nn.Sequential(
+            nn.Linear(emb + 1, hidden), nn.ReLU(),
+            nn.Linear(hidden, k * 3) # two means, one sigma
+        )
+
+    def hyper_at(self, x, rows, t, summed=None):
+
+        b, r, e = x.size()
+        k = self.k
+
+        # Generate coords
+        coords = rows.float() / t
+        coords = coords[None, :, None,].expand(b, r, 1)
+
+        input = torch.cat([x, coords], dim=2)
+        params = self.toparams(input) # (b, r, k*3)
+
+        # Generate the logits that correspond to the diagonals of the matrix
+        diags = util.inv(rows.float(), mx=t)
+        diags = diags[None, :, None, None].expand(b, r, k, 2)
+
+        means =  params[:, :, :k*2].view(b, r, k, 2)
+        sigmas = params[:, :, k*2:].view(b, r, k)
+        values = self.mvalues[None, None, :].expand(b, r, k)
+
+        means = diags + self.mmult * means
+        means = util.flip(means)
+
+        s = (t, t)
+        means, sigmas = transform_means(means, s), \
+                        transform_sigmas(sigmas, s, min_sigma=self.min_sigma) * self.sigma_scale
+
+        return means, sigmas, values
+
+class ASH1DSelfAttention(SparseSelfAttention):
+    """
+    Masked sparse self attention. One degree of freedom, the receptive field is adaptive, based on the incoming
+    embedding vector and coordinate.
+    """
+    def __init__(self, emb, k, gadditional, radditional, region, heads=8, mmult=1.0, clamp=True, outputs=-1, **kwargs):
+        """
+        :param outputs: The number of units (at the end of the sequence) to compute new vectors for.
+        """
+        super().__init__(emb, k, gadditional, radditional, region, heads=heads, rank=1, **kwargs)
+
+        self.mmult, self.clamp, self.outputs = mmult, clamp, outputs
+
+        if clamp:
+            self.mmult *= 3.0
+
+        # network that generates the coordinates and sigmas
+        hidden = emb * 4
+        self.toparams = nn.Sequential(
+            nn.Linear(emb + 1, hidden), nn.ReLU(),
+            nn.Linear(hidden, k * 2) # one mean, one sigma
+        )
+
+    def hyper_at(self, x, rows, t, summed=None):
+
+        b, r, e = x.size()
+        k = self.k
+
+        # Generate coords
+        coords = rows.to(torch.float) / t
+        coords = coords[None, :, None,].expand(b, r, 1)
+
+        input = torch.cat([x, coords], dim=2)
+        params = self.toparams(input) # (b, r, k*2)
+
+        # Generate the logits that correspond to the horizontal coordinate of the current word
+        diags = rows.to(torch.float)
+        if not self.clamp:
+            diags = util.inv(diags, mx=t)
+
+        diags = diags[None, :, None, None].expand(b, r, k, 1)
+
+        means =  params[:, :, :k].view(b, r, k, 1)
+        sigmas = params[:, :, k:].view(b, r, k)
+        values = self.mvalues[None, None, :].expand(b, r, k)
+
+        means = diags - self.mmult * F.softplus(means)
+
+        s = (t,)
+        means, sigmas = transform_means(means, s, method='clamp' if self.clamp else 'sigmoid'), \
+                        transform_sigmas(sigmas, s, min_sigma=self.min_sigma) * self.sigma_scale
+
+        return means, sigmas, values
+
+class StridedSparseSelfAttention(SparseSelfAttention):
+    """
+    Masked sparse self attention. One degree of freedom, the receptive field is adaptive, based on the incoming
+    embedding vector, the preceding embedding vectors and coordinate. Only every stride-th output attends, and each head
+    sees a slice of the embedding.
+    """
+    def __init__(self, emb, k, gadditional, radditional, region, heads=8, stride=32, mmult=1.0, clamp=True, **kwargs):
+
+        super().__init__(emb, k, gadditional, radditional, region, heads=heads, rank=1, split_heads=True,
+                         epsilon=10e-5, **kwargs)
+
+        self.mmult, self.clamp, self.stride = mmult, clamp, stride
+
+        if clamp:
+            self.mmult *= 3.0
+
+        # network that generates the coordinates and sigmas
+        hidden = emb * 4
+        self.toparams = nn.Sequential(
+            nn.Linear(2 * emb + 1, hidden), nn.ReLU(),
+            nn.Linear(hidden, k * 2) # one mean, one sigma
+        )
+        # -- input is the current token's embedding vector, the sum of preceding embedding vectors, and the coordinate.
+
+    def rows(self, t, device):
+        # the fixed output indices, which are 'stride' units apart
+        r = self.stride
+
+        selection = torch.arange(t//r, dtype=torch.long, device=device)
+        return (selection + 1) * r - 1
+
+    def hyper(self, x):
+
+        b, t, e = x.size()
+        selection = self.rows(t, d(x))
+
+        summed = (x.cumsum(dim=1) - x) / torch.arange(start=1, end=t+1, device=d(x), dtype=torch.float)[None, :, None]
+
+        return self.hyper_at(x[:, selection, :], selection, t, summed[:, selection, :])
+
+    def hyper_at(self, x, rows, t, summed=None):
+
+        b, tp, e = x.size()
+        k = self.k
+        s = (t,)
+
+        selection = rows
+
+        # Generate coords (the index of the output among the selection)
+        coords = ((selection + 1) // self.stride - 1).to(torch.float) / (t // self.stride)
+        coords = coords[None, :, None,].expand(b, tp, 1)
+
+        input = torch.cat([x, coords, summed], dim=2)
+        params = self.toparams(input) # (b, tp, k*2)
+
+        # Generate the logits/coordinates that correspond to the horizontal coordinate of the current word
+        diags = selection.to(torch.float)
+        if not self.clamp:
+            diags = util.inv(diags, mx=t)
+
+        diags = diags[None, :, None, None].expand(b, tp, k, 1)
+
+        means =  params[:, :, :k].view(b, tp, k, 1)
+        sigmas = params[:, :, k:].view(b, tp, k)
+        values = self.mvalues[None, None, :].expand(b, tp, k) # all ones atm
+
+        means = diags - self.mmult * F.softplus(means)
+
+        means, sigmas = transform_means(means, s, method='clamp' if self.clamp else 'sigmoid'), \
+                        transform_sigmas(sigmas, s, min_sigma=self.min_sigma) * self.sigma_scale
+
+        return means, sigmas, values
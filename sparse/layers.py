@@ -4,10 +4,11 @@ from torch.autograd import Variable
 from torch.nn import Parameter
 from torch import FloatTensor, LongTensor
 
-import abc, itertools, math, types
+import abc, contextlib, itertools, math, types
 from numpy import prod
 
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 import tensors
 
@@ -16,6 +17,7 @@ from sparse.util import Bias, sparsemult, contains_nan, bmult, nduplicates, d
 
 import sys
 import random
+import threading, queue
 
 import numpy as np
 
@@ -25,13 +27,19 @@ from enum import Enum
 EPSILON = 10e-7
 SIGMA_BOOST = 2.0
 
+# Enables the checks on the sampled index tuples (these require a sync between host and device, so they're off by default)
+DEBUG = False
+
+# Frozen weights (see SparseLayer.freeze()) with at most this many elements are stored as dense matrices
+FROZEN_DENSE = 2 ** 16
+
 
 """
 Core implementation of the sparse (hyper)layer as an abstract class (SparseLayer).
 
 """
 
-def densities(points, means, sigmas):
+def densities(points, means, sigmas, method='expanded', chunk=None):
     """
     Compute the unnormalized probability densities of a given set of points for a
     given set of multivariate normal distrbutions (MVNs)
@@ -41,6 +49,12 @@ def densities(points, means, sigmas):
     :param sigmas: (b, k, l, r) tensor of n vectors of dimension r (in a batch of size b)
         representing the diagonal covariance matrix of n MVNs
     :param points: The points for which to compute the probabilioty densities
+    :param method: How to compute the (squared) Mahalanobis distances. 'expanded' uses ||p||^2 - 2p.m + ||m||^2 (scaled
+        by the diagonal sigmas), which reduces to matrix multiplications and never materializes a tensor with both the
+        points and the MVNs as dimensions (before the result). 'direct' computes the squared distances elementwise and
+        'bmm' is the original implementation, which expands everything to a (..., c, i, k, rank) tensor.
+    :param chunk: If not None, the c dimension is processed in chunks of this size, to limit the size of the
+        intermediate tensors.
     :return: (b, k, n) tensor containing the density of every point under every MVN
     """
 
@@ -57,6 +71,51 @@ def densities(points, means, sigmas):
     pref = points.size()[:-3]
     assert pref == means.size()[:-3]
 
+    if chunk is not None and chunk < c:
+        results = []
+        for fr in range(0, c, chunk):
+            to = min(fr + chunk, c)
+            results.append(densities(points[..., fr:to, :, :], means[..., fr:to, :, :], sigmas[..., fr:to, :, :], method=method))
+
+        return torch.cat(results, dim=-3)
+
+    if method == 'bmm':
+        return bmm_densities(points, means, sigmas)
+
+    # inverse of the diagonal of the covariance matrices
+    isigmas = 1.0/(EPSILON + sigmas)
+
+    if method == 'direct':
+        diffs = points.unsqueeze(-2) - means.unsqueeze(-3)
+        products = (diffs * diffs * isigmas.unsqueeze(-3)).sum(dim=-1)
+
+    elif method == 'expanded':
+        # Subtract a reference point from both the points and the means (this doesn't change the distances). This
+        # keeps the three terms small, which avoids catastrophic cancellation in the sum.
+        ref = means.detach().mean(dim=-2, keepdim=True)
+        points, means = points - ref, means - ref
+
+        pterm = torch.matmul(points * points, isigmas.transpose(-2, -1))                # (..., c, i, k)
+        cterm = torch.matmul(points, (means * isigmas).transpose(-2, -1))               # (..., c, i, k)
+        mterm = (means * means * isigmas).sum(dim=-1)                                   # (..., c, k)
+
+        products = (pterm - 2.0 * cterm + mterm.unsqueeze(-2)).clamp(min=0.0)
+
+    else:
+        raise Exception('Method {} not recognized'.format(method))
+
+    return torch.exp(- 0.5 * products) # the numerator of the Gaussian density
+
+def bmm_densities(points, means, sigmas):
+    """
+    Original implementation of densities(). Expands the points, means and sigmas to a (..., c, i, k, rank) tensor, and
+    computes the squared norms by a batched matrix multiplication.
+    """
+    c, i, rank = points.size()[-3:]
+    c, k, rank = means.size()[-3:]
+
+    pref = points.size()[:-3]
+
     points = points.unsqueeze(-2).expand( *(pref + (c, i, k, rank)) )
     means  = means.unsqueeze(-3).expand_as(points)
     sigmas = sigmas.unsqueeze(-3).expand_as(points)
@@ -143,6 +202,188 @@ def transform_sigmas(sigmas, size, min_sigma=EPSILON):
 
     return sigmas * s
 
+class SampleRNG(nn.Module):
+    """
+    The random number generator for the sampling of a single layer. Layers that own one of these do not draw from (or
+    reseed) the global torch RNG, so the samples of each layer are reproducible by themselves, and different layers can
+    sample concurrently.
+
+    The generator is created lazily on the device where the samples are drawn. Its state is stored in the state dict.
+
+    The generator may be shared with the thread of a Presampler. Any code that uses the generator directly should hold
+    the lock. Reseeding or loading a state increments the epoch, which tells the Presampler to discard its buffer.
+    """
+
+    def __init__(self, seed=None):
+        """
+        :param seed: The initial seed. If None, it is drawn from the global RNG when the generator is first used (so
+            that torch.manual_seed() still determines the samples of a freshly created layer, and creating the layer
+            does not change the global random stream).
+        """
+        super().__init__()
+
+        self.initial = seed
+        self.gen = None
+        self.loaded = None # (device type, state) from a state dict, applied when the generator is created
+
+        self.lock = threading.RLock()
+        self.epoch = 0
+
+    def seed(self, seed):
+        """
+        Reseeds the generator.
+
+        :param seed: The new seed. If None, a fresh one is drawn from the global RNG when the generator is next used.
+        """
+        with self.lock:
+            self.initial = seed
+            self.gen, self.loaded = None, None
+            self.epoch += 1
+
+    def generator(self, device='cpu'):
+        """
+        :param device: The device on which the samples are drawn.
+        :return: A torch.Generator for the given device.
+        """
+        device = torch.device(device)
+
+        with self.lock:
+            if self.gen is None or self.gen.device.type != device.type:
+                self.gen = torch.Generator(device=device)
+
+                if self.loaded is not None and self.loaded[0] == device.type:
+                    self.gen.set_state(self.loaded[1])
+                else:
+                    if self.initial is None:
+                        self.initial = int(torch.randint(2 ** 62, (1, )))
+                    self.gen.manual_seed(self.initial)
+
+                self.loaded = None
+
+            return self.gen
+
+    def get_extra_state(self):
+        with self.lock:
+            if self.gen is not None:
+                return {'seed': self.initial, 'device': self.gen.device.type, 'state': self.gen.get_state()}
+            if self.loaded is not None:
+                return {'seed': self.initial, 'device': self.loaded[0], 'state': self.loaded[1]}
+
+            return {'seed': self.initial, 'device': None, 'state': None}
+
+    def set_extra_state(self, state):
+        with self.lock:
+            self.initial = state['seed']
+            self.gen = None
+            self.loaded = None if state['state'] is None else (state['device'], state['state'])
+            self.epoch += 1
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                                      error_msgs)
+
+        key = prefix + '_extra_state'
+        if key not in state_dict:
+            # checkpoint from before the layers had their own generator: keep a freshly seeded one
+            if key in missing_keys:
+                missing_keys.remove(key)
+            self.seed(None)
+
+    def __getstate__(self):
+        # locks can't be copied or pickled
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.lock = threading.RLock()
+
+class Presampler:
+    """
+    Draws the uniform samples that ngenerate() and generate_integer_tuples() turn into the global and local index tuples
+    ahead of time, in a background thread, and keeps them in a bounded buffer. The training step then only has to scale
+    and shift them, and drawing the random numbers overlaps with the rest of the computation.
+
+    The samples are drawn from the generator of the given SampleRNG, and consumed in the order in which they are drawn,
+    so the results are reproducible. The exception is when the requested sizes change: the buffered samples are then
+    discarded, and how many of them were drawn depends on timing. When the SampleRNG is reseeded or loaded from a state
+    dict, the buffered samples are discarded as well, and drawing resumes from the new state.
+    """
+
+    def __init__(self, rng, buffer=4):
+        """
+        :param rng: The SampleRNG to draw from.
+        :param buffer: The maximum number of pre-drawn samples.
+        """
+        self.rng, self.buffer = rng, buffer
+
+        self.key, self.queue, self.stop = None, None, None
+
+    def draw(self, gsize, lsize, device):
+        """
+        Returns uniform samples in [0, 1) for the global and local index tuples.
+
+        :param gsize: The size of the global samples.
+        :param lsize: The size of the local samples.
+        :param device: The device to draw on.
+        :return: A pair of float tensors of the requested sizes.
+        """
+        key = (tuple(gsize), tuple(lsize), str(device), self.rng.epoch)
+
+        if key != self.key:
+            self.restart(key)
+
+        return self.queue.get()
+
+    def restart(self, key):
+        """
+        Stops the current producer (if any) and starts a new one for the given sizes.
+        """
+        if self.stop is not None:
+            self.stop.set()
+
+        self.key, self.queue, self.stop = key, queue.Queue(maxsize=self.buffer), threading.Event()
+
+        thread = threading.Thread(target=self.produce, args=(key, self.queue, self.stop), daemon=True)
+        thread.start()
+
+    def produce(self, key, buffer, stop):
+        gsize, lsize, device, epoch = key
+
+        while not stop.is_set():
+            with self.rng.lock:
+                if stop.is_set() or self.rng.epoch != epoch: # the generator was reseeded in the meantime
+                    break
+
+                gen = self.rng.generator(device)
+                sample = torch.rand(gsize, generator=gen, device=device), torch.rand(lsize, generator=gen, device=device)
+
+            while not stop.is_set():
+                try:
+                    buffer.put(sample, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def close(self):
+        """
+        Stops the producer thread.
+        """
+        if self.stop is not None:
+            self.stop.set()
+
+        self.key, self.queue, self.stop = None, None, None
+
+    def __getstate__(self):
+        # threads and locks can't be copied or pickled, so we only store the configuration
+        return {'rng': self.rng, 'buffer': self.buffer}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
 class SparseLayer(nn.Module):
     """
     Abstract class for the (templated) hyperlayer. Implement by defining a hypernetwork, and returning it from the
@@ -169,7 +410,10 @@ class SparseLayer(nn.Module):
                  learn_cols=None,
                  chunk_size=None,
                  gadditional=0, radditional=0, region=None,
-                 bias_type=Bias.DENSE):
+                 bias_type=Bias.DENSE,
+                 sample_groups=None,
+                 checkpoint_sampling=False,
+                 presample=None):
         """
         :param in_rank: Nr of dimensions in the input. The specific size may vary between inputs.
         :param out_size: Tuple describing the size of the output.
@@ -185,6 +429,16 @@ class SparseLayer(nn.Module):
         :param region: Tuple describing the size of the region over which the local additional points are sampled (must
             be smaller than the size of the tensor).
         :param bias_type: The type of bias of the sparse layer (none, dense or sparse).
+        :param sample_groups: If not None, the index tuples are sampled for only this many groups of consecutive
+            instances in the batch (or the greatest common divisor of this number and the batch size), and shared within
+            each group.
+            This is only correct if the output of the hypernetwork does not depend on the input (as in NASLayer).
+        :param checkpoint_sampling: If True, the intermediate results of the sampling step (the sampled index tuples,
+            duplicate mask and densities) are not kept for the backward pass, but recomputed from the continuous index
+            tuples (with the same random state). This saves memory at the cost of some extra computation.
+        :param presample: If not None, the random numbers for the sampling are drawn ahead of time in a background
+            thread, and this many are buffered (see Presampler). Not used together with checkpoint_sampling, or when a
+            seed is passed to forward().
         :param subsample:
         """
 
@@ -199,6 +453,11 @@ class SparseLayer(nn.Module):
         self.radditional = radditional
         self.region = region
         self.chunk_size = chunk_size
+        self.sample_groups = sample_groups
+        self.checkpoint_sampling = checkpoint_sampling
+
+        self.rng = SampleRNG()
+        self.presampler = None if presample is None else Presampler(self.rng, presample)
 
         self.bias_type = bias_type
         self.learn_cols = learn_cols if learn_cols is not None else range(rank)
@@ -211,20 +470,223 @@ class SparseLayer(nn.Module):
 
         if self.templated:
             # template for the index matrix containing the hardwired connections
-            # The learned parts can be set to zero; they will be overriden.
+            # The learned parts are overwritten by the sampled indices.
             assert temp_indices.size(1) == in_rank + len(out_size)
 
             self.register_buffer('temp_indices', temp_indices)
 
+        # materialized weight and bias for inference (see freeze())
+        self.register_buffer('frozen_weight', None, persistent=False)
+        self.register_buffer('frozen_bias', None, persistent=False)
+        self.frozen_in_size = None
+
     def is_cuda(self):
         return next(self.parameters()).is_cuda
 
+    def stitch(self, indices):
+        """
+        Stitches the generated index tuples into the template (if the layer is templated).
+
+        :param indices: (b, l, r) LongTensor of index tuples for the learnable columns
+        :return: (b, l, rank) LongTensor of complete index tuples
+        """
+        if not self.templated:
+            return indices
+
+        b, l, r = indices.size()
+        h, w = self.temp_indices.size()
+        template = self.temp_indices[None, :, None, :].expand(b, h, l//h, w)
+        template = template.contiguous().view(b, l, w)
+
+        template[:, :, self.learn_cols] = indices
+
+        return template
+
+    def freeze(self, input, dense=None):
+        """
+        Materializes the weight tensor for inference. The means are rounded (as in eval mode), and the resulting index
+        tuples and values are flattened into a single coalesced matrix, which is shared by all instances in a batch. In
+        eval mode, a frozen layer computes its output with a single matrix multiplication.
+
+        This is only correct if the output of the hypernetwork does not depend on the input (as in NASLayer). This is
+        checked (with an assertion) by evaluating the hypernetwork on a second input. The frozen weight is not updated
+        when the parameters change: call unfreeze() (and freeze() again) after training.
+
+        :param input: An example input. Only its first instance is used, to evaluate the hypernetwork and to determine
+            the input size.
+        :param dense: Whether to store the weight as a dense matrix or as a sparse (CSR) matrix. If None, the weight is
+            stored densely if it has at most FROZEN_DENSE elements.
+        """
+        with torch.no_grad():
+            input = input[:1]
+
+            hyp = self.hyper(input)
+            means, values = hyp[0], hyp[2]
+            bias = hyp[3] if self.bias_type == Bias.DENSE else None
+
+            # check that the hypernetwork ignores the input, by evaluating it on a different one
+            other = self.hyper(input + 1.0)
+            assert torch.equal(means.round(), other[0].round()) and torch.allclose(values, other[2]), \
+                'The output of the hypernetwork depends on the input. Only layers with an input-independent hypernetwork can be frozen.'
+
+            indices = self.stitch(means.round().long())
+            values = values.reshape(-1)
+
+            in_size = tuple(input.size()[1:])
+            plan = tensors.contraction_plan(in_size, self.out_size, d(input))
+
+            mindices = plan.flatten(indices[0])
+
+            weight = torch.sparse_coo_tensor(mindices.t(), values, plan.flat_size).coalesce() # sums duplicates
+
+            if dense is None:
+                dense = prod(plan.flat_size) <= FROZEN_DENSE
+
+            self.frozen_weight = weight.to_dense() if dense else weight.to_sparse_csr()
+            self.frozen_bias = None if bias is None else bias.detach().clone()
+            self.frozen_in_size = in_size
+
+    def unfreeze(self):
+        """
+        Removes the frozen weight (see freeze()).
+        """
+        self.frozen_weight, self.frozen_bias, self.frozen_in_size = None, None, None
+
+    def frozen_forward(self, input):
+        """
+        Computes the output using the frozen weight. In eval mode, this gives the same output as the regular forward
+        (for a layer with an input-independent hypernetwork, see freeze()).
+        """
+        assert tuple(input.size()[1:]) == self.frozen_in_size, \
+            'Input size ({}) does not match the size of the input used to freeze the layer ({}).'.format(tuple(input.size()[1:]), self.frozen_in_size)
+
+        b = input.size(0)
+
+        output = torch.mm(self.frozen_weight, input.reshape(b, -1).t()) # (out, b)
+        output = output.t().reshape(b, *self.out_size)
+
+        if self.frozen_bias is not None:
+            return output + self.frozen_bias
+        return output
+
+    def sample(self, means, sigmas, values, rng, seed=None, presample=True):
+        """
+        Samples integer index tuples around the given continuous index tuples, and distributes the values over them in
+        proportion to their densities.
+
+        :param means: (b, c, k, r) tensor of continuous index tuples
+        :param sigmas: (b, c, k, r) tensor of standard deviations
+        :param values: (b, c, k) tensor of values
+        :param rng: The bounds of the (learnable part of the) index tuples
+        :param seed: Optional seed for the random sampling
+        :param presample: Whether to use the presampler (if the layer has one).
+        :return: A pair (indices, values): a (b, c, i, r) LongTensor of integer index tuples, and a (b, c, i) tensor of
+            their values.
+        """
+        if seed is not None:
+            self.rng.seed(seed) # - also discards the samples buffered by the presampler
+
+        sampler = self.presampler if presample and seed is None else None
+
+        # If we draw from the generator here, it must not be advanced by the presampler thread at the same time
+        with self.rng.lock if sampler is None else contextlib.nullcontext():
+            indices = generate_integer_tuples(means, self.gadditional, self.radditional, rng=rng, relative_range=self.region,
+                                              cuda=self.is_cuda(), fm=self.floor_mask,
+                                              generator=self.rng.generator(d(means)), sampler=sampler)
+        indfl = indices.float()
+
+        # Mask for duplicate indices
+        dups = nduplicates(indices, rng=rng)
+
+        # compute (unnormalized) densities under the given MVNs (proportions)
+        props = densities(indfl, means, sigmas).clone()  # result has size (b, c, i, k), i = indices[2]
+        props[dups, :] = 0
+        props = props / props.sum(dim=2, keepdim=True) # normalize over all points of a given index tuple
+
+        # Weight the values by the proportions
+        values = values[:, :, None, :].expand_as(props)
+
+        values = props * values
+        values = values.sum(dim=3)
+
+        return indices, values
+
+    def accumulate(self, input, loss, subbatch, seed=None, **kwargs):
+        """
+        Computes the gradient of a loss over the output in several passes, to bound memory use. Each pass samples integer
+        index tuples for only a slice of subbatch continuous index tuples (per chunk), and uses the rounded index tuples
+        for the rest (as in eval mode). The gradients of all passes are accumulated in the parameters, so that this
+        replaces a call of loss.backward().
+
+        The hypernetwork is evaluated only once: the gradients with respect to its outputs are accumulated over the
+        passes and then backpropagated through the hypernetwork in one go. The contribution of the rounded index tuples
+        to the output is also computed only once.
+
+        :param input: The input to the layer.
+        :param loss: Function that maps the output of the layer to a scalar loss.
+        :param subbatch: The number of continuous index tuples (per chunk) to sample for in each pass.
+        :param seed: Optional seed for the random sampling
+        :return: The loss, averaged over the passes (detached).
+        """
+        assert not self.templated, "Templating and gradient accumulation do not work together"
+
+        hinput = input if self.sample_groups is None else input[:math.gcd(input.size(0), self.sample_groups)]
+
+        hyp = self.hyper(hinput, **kwargs)
+
+        # detached copies of the outputs of the hypernetwork, to accumulate the gradients in
+        leaves = [h.detach().requires_grad_() for h in hyp]
+        means, sigmas, values = leaves[:3]
+        bias = leaves[3] if self.bias_type == Bias.DENSE else None
+
+        b, n, r = means.size()
+
+        k = self.chunk_size if self.chunk_size is not None else n
+        c = n // k
+
+        means, sigmas, values = means.view(b, c, k, r), sigmas.view(b, c, k, r), values.view(b, c, k)
+
+        size = self.out_size + input.size()[1:]
+        subrange = [size[r] for r in self.learn_cols]
+
+        with torch.no_grad():
+            rounded = means.round().long()
+            base = tensors.contract(rounded.view(b, n, r), values.reshape(b, n), size, input)
+
+        total, passes = 0.0, 0
+        for fr in range(0, k, subbatch):
+            to = min(fr + subbatch, k)
+
+            # replace the contribution of the rounded index tuples in the slice by that of the sampled ones
+            with torch.no_grad():
+                rslice = tensors.contract(rounded[:, :, fr:to].reshape(b, -1, r), values[:, :, fr:to].reshape(b, -1), size, input)
+
+            indices, svalues = self.sample(means[:, :, fr:to], sigmas[:, :, fr:to], values[:, :, fr:to], subrange, seed=seed)
+
+            output = base - rslice + tensors.contract(indices.view(b, -1, r), svalues.view(b, -1), size, input)
+
+            if bias is not None:
+                output = output + bias
+
+            l = loss(output)
+            l.backward()
+
+            total, passes = total + l.detach(), passes + 1
+
+        # backpropagate the accumulated gradients through the hypernetwork
+        pairs = [(h, leaf.grad) for h, leaf in zip(hyp, leaves) if h.requires_grad and leaf.grad is not None]
+        if len(pairs) > 0:
+            torch.autograd.backward(*zip(*pairs))
+
+        return total / passes
+
     def forward(self, input, mrange=None, seed=None, **kwargs):
         """
 
         :param input:
         :param mrange: Specifies a subrange of index tuples to compute the gradient over. This is helpful for gradient
-        accumulation methods. This doesn;t work together with templating.
+        accumulation methods. This doesn;t work together with templating. See accumulate() for a more efficient
+        alternative.
         :param seed:
         :param kwargs:
         :return:
@@ -232,14 +694,20 @@ class SparseLayer(nn.Module):
 
         assert mrange is None or not self.templated, "Templating and gradient accumulation do not work together"
 
+        if not self.training and self.frozen_weight is not None:
+            return self.frozen_forward(input)
+
         ### Compute and unpack output of hypernetwork
 
         bias = None
 
+        # evaluate the hypernetwork only for the first instance of each group
+        hinput = input if self.sample_groups is None else input[:math.gcd(input.size(0), self.sample_groups)]
+
         if self.bias_type == Bias.NONE:
-            means, sigmas, values = self.hyper(input, **kwargs)
+            means, sigmas, values = self.hyper(hinput, **kwargs)
         elif self.bias_type == Bias.DENSE:
-            means, sigmas, values, bias = self.hyper(input, **kwargs)
+            means, sigmas, values, bias = self.hyper(hinput, **kwargs)
         elif self.bias_type == Bias.SPARSE:
             raise Exception('Sparse bias not supported yet.')
         else:
@@ -257,7 +725,7 @@ class SparseLayer(nn.Module):
 
         means, sigmas, values = means.view(b, c, k, r), sigmas.view(b, c, k, r), values.view(b, c, k)
 
-        assert b == input.size(0), 'input batch size ({}) should match parameter batch size ({}).'.format(input.size(0), b)
+        assert b == hinput.size(0), 'input batch size ({}) should match parameter batch size ({}).'.format(hinput.size(0), b)
 
         # max values allowed for each column in the index matrix
         fullrange = self.out_size + input.size()[1:]
@@ -282,22 +750,32 @@ class SparseLayer(nn.Module):
                 # (their gradient will be computed in other passes)
                 means_out, sigmas_out, values_out = means_out.detach(), sigmas_out.detach(), values_out.detach()
 
-            indices = generate_integer_tuples(means, self.gadditional, self.radditional, rng=subrange, relative_range=self.region, seed=seed, cuda=self.is_cuda())
-            indfl = indices.float()
+            if self.checkpoint_sampling:
+                # checkpoint only preserves the global RNG state, so we restore the state of the layer's generator
+                # ourselves to make the recomputation sample the same index tuples
+                if seed is not None:
+                    self.rng.seed(seed)
 
-            # Mask for duplicate indices
-            dups = nduplicates(indices)
+                with self.rng.lock:
+                    gen = self.rng.generator(d(means))
+                    state, calls = gen.get_state(), []
 
-            # compute (unnormalized) densities under the given MVNs (proportions)
-            props = densities(indfl, means, sigmas).clone()  # result has size (b, c, i, k), i = indices[2]
-            props[dups, :] = 0
-            props = props / props.sum(dim=2, keepdim=True) # normalize over all points of a given index tuple
+                def sample(means, sigmas, values):
+                    with self.rng.lock: # the generator may be shared with the presampler thread
+                        current = gen.get_state()
+                        gen.set_state(state)
 
-            # Weight the values by the proportions
-            values = values[:, :, None, :].expand_as(props)
+                        result = self.sample(means, sigmas, values, subrange, presample=False)
 
-            values = props * values
-            values = values.sum(dim=3)
+                        if len(calls) > 0: # recomputation: leave the generator where it was
+                            gen.set_state(current)
+                        calls.append(True)
+
+                    return result
+
+                indices, values = checkpoint(sample, means, sigmas, values, use_reentrant=False)
+            else:
+                indices, values = self.sample(means, sigmas, values, subrange, seed=seed)
 
             if mrange is not None:
                 indices_out = means_out.data.round().long()
@@ -312,22 +790,17 @@ class SparseLayer(nn.Module):
             # remove the chunk dimensions
             indices, values = indices.view(b, -1 , r), values.view(b, -1)
 
-        if self.templated:
-            # stitch the generated indices into the template
-            b, l, r = indices.size()
-            h, w = self.temp_indices.size()
-            template = self.temp_indices[None, :, None, :].expand(b, h, l//h, w)
-            template = template.contiguous().view(b, l, w)
-
-            template[:, :, self.learn_cols] = indices
-            indices = template
-
-            # if self.is_cuda():
-            #     indices = indices.cuda()
-
         size = self.out_size + input.size()[1:]
 
-        output = tensors.contract(indices, values, size, input)
+        if self.templated:
+            # the generated indices are stitched into the template inside the contraction. The contraction adds them to
+            # the template, so we zero the learned columns of (a copy of) the template first.
+            template = self.temp_indices.clone()
+            template[:, list(self.learn_cols)] = 0
+
+            output = tensors.contract(indices, values, size, input, template=template, learn_cols=self.learn_cols)
+        else:
+            output = tensors.contract(indices, values, size, input)
 
         if self.bias_type == Bias.DENSE:
             return output + bias
@@ -347,7 +820,10 @@ class NASLayer(SparseLayer):
                  radditional=None,
                  template=None,
                  learn_cols=None,
-                 chunk_size=None):
+                 chunk_size=None,
+                 sample_groups=None,
+                 checkpoint_sampling=False,
+                 presample=None):
         """
 
         :param in_size:
@@ -364,6 +840,12 @@ class NASLayer(SparseLayer):
         :param template: LongTensor Template for the matrix of index tuples. Learnable columns are updated through backprop
             other values are taken from the template.
         :param learn_cols: tuple of integers. Learnable columns of the template.
+        :param sample_groups: Number of groups of instances in the batch that share the same sampled index tuples (see
+            SparseLayer). None to sample separately for each instance.
+        :param checkpoint_sampling: Recompute the sampling step in the backward pass instead of storing its intermediate
+            results (see SparseLayer).
+        :param presample: Size of the buffer of random numbers drawn ahead of time in a background thread (see
+            SparseLayer). None to draw them when needed.
 
         """
 
@@ -375,7 +857,10 @@ class NASLayer(SparseLayer):
                          region=region,
                          temp_indices=template,
                          learn_cols=learn_cols,
-                         chunk_size=chunk_size)
+                         chunk_size=chunk_size,
+                         sample_groups=sample_groups,
+                         checkpoint_sampling=checkpoint_sampling,
+                         presample=presample)
 
         self.k = k
         self.in_size = in_size
@@ -446,7 +931,10 @@ class Convolution(nn.Module):
                  min_sigma=0.0,
                  sigma_scale=0.1,
                  fix_values=False,
-                 has_bias=True):
+                 has_bias=True,
+                 sample_groups=None,
+                 method='gather',
+                 presample=None):
         """
         :param in_size: Channels and resolution of the input
         :param out_size: Tuple describing the size of the output.
@@ -457,6 +945,14 @@ class Convolution(nn.Module):
         :param radditional: Number of points to sample locally per index tuple
         :param rprop: Describes the region over which the local samples are taken, as a proportion of the channels
         :param bias_type: The type of bias of the sparse layer (none, dense or sparse).
+        :param sample_groups: If not None, the index tuples are sampled for only this many groups of consecutive
+            instances in the batch (or the greatest common divisor of this number and the batch size), and shared within
+            each group.
+        :param method: How to apply the sampled kernels. 'gather' selects the input values for each sampled (c, dy, dx)
+            offset directly from the padded input, and sums them weighted by the values. 'contract' builds the rank-6
+            index tuples of the full weight tensor and applies it with tensors.contract().
+        :param presample: If not None, the random numbers for the sampling are drawn ahead of time in a background
+            thread, and this many are buffered (see Presampler).
         :param subsample:
         """
 
@@ -475,6 +971,11 @@ class Convolution(nn.Module):
         self.sigma_scale = sigma_scale
 
         self.has_bias = has_bias
+        self.sample_groups = sample_groups
+        self.method = method
+
+        self.rng = SampleRNG()
+        self.presampler = None if presample is None else Presampler(self.rng, presample)
 
         self.pad = nn.ZeroPad2d(kernel_size // 2)
 
@@ -486,9 +987,11 @@ class Convolution(nn.Module):
         # out_indices = torch.LongTensor(list(np.ndindex( (in_size[1:]) )))
         # self.register_buffer('out_indices', out_indices)
 
+        # The template contains the fixed part (o, y, x, 0, y, x) of the index tuples. The sampled (c, dy, dx) are added
+        # to its last three columns.
         template = torch.LongTensor(list(np.ndindex( (out_channels, in_size[1], in_size[2]) )))
         assert template.size() == (prod((out_channels, in_size[1], in_size[2])), 3)
-        template = F.pad(template, (0, 3))
+        template = torch.cat([template, torch.zeros_like(template[:, :1]), template[:, 1:]], dim=1)
         self.register_buffer('template', template)
 
         if self.has_bias:
@@ -520,8 +1023,8 @@ class Convolution(nn.Module):
     def forward(self, x):
         dv = 'cuda' if self.template.is_cuda else 'cpu'
 
-        # get continuous parameters
-        means, sigmas, values = self.hyper(x)
+        # get continuous parameters (only for the first instance of each group)
+        means, sigmas, values = self.hyper(x if self.sample_groups is None else x[:math.gcd(x.size(0), self.sample_groups)])
 
         # zero pad
         x = self.pad(x)
@@ -550,7 +1053,7 @@ class Convolution(nn.Module):
                                 self.gadditional, self.radditional,
                                 relative_range=self.region,
                                 rng=(self.in_size[0], self.kernel_size, self.kernel_size),
-                                cuda=means.is_cuda)
+                                cuda=means.is_cuda, generator=self.rng.generator(d(means)), sampler=self.presampler)
 
             # for i in range(indices.contiguous().view(-1, 3).size(0)):
             #     print(indices.contiguous().view(-1, 3)[i, :])
@@ -564,7 +1067,7 @@ class Convolution(nn.Module):
             assert nk == self.in_size[1] * self.in_size[2]
 
             # mask for duplicate indices
-            dups = nduplicates(indices)
+            dups = nduplicates(indices, rng=(self.in_size[0], self.kernel_size, self.kernel_size))
 
             # compute unnormalized densities (proportions) under the given MVNs
             props = densities(indfl, means, sigmas).clone()  # result has size (..., c, i, k), i = indices[2]
@@ -585,33 +1088,59 @@ class Convolution(nn.Module):
             values = props * values
             values = values.sum(dim=4)
 
-        template = self.template[None, :, None, :].expand(b, self.out_size[0]*self.in_size[1]*self.in_size[2], l, 6)
-        template = template.view(b, self.out_size[0], nk, l, 6)
-
-        template[:, :, :, :, 3:] = indices
-
-        indices = template.contiguous().view(b, self.out_size[0] * nk * l, 6)
-        offsets = indices[:, :, 1:3]
+        if DEBUG:
+            krange = torch.tensor((self.in_size[0], self.kernel_size, self.kernel_size), device=dv)
+            assert (indices.reshape(-1, 3).max(dim=0)[0] >= krange).sum() == 0, "Max values of indices ({}) out of bounds ({})".format(indices.reshape(-1, 3).max(dim=0)[0], krange)
 
-        # for i in range(indices.view(-1, 6).size(0)):
-        #     print(indices.view(-1, 6)[i, :], values.view(-1)[i].data)
-        # sys.exit()
+        if self.method == 'gather':
+            output = self.gather(x, indices, values)
 
-        indices[:, :, 4:] = indices[:, :, 4:] + offsets
+        elif self.method == 'contract':
+            indices = indices.contiguous().view(b, self.out_size[0] * nk * l, 3)
+            values = values.contiguous().view(b, self.out_size[0] * nk * l)
 
-        values = values.contiguous().view(b, self.out_size[0] * nk * l)
+            # apply tensor
+            size = self.out_size + x.size()[1:]
 
-        # apply tensor
-        size = self.out_size + x.size()[1:]
+            # the sampled (c, dy, dx) are added to the template rows (o, y, x, 0, y, x) inside the contraction
+            output = tensors.contract(indices, values, size, x, template=self.template, learn_cols=(3, 4, 5))
 
-        assert (indices.view(-1, 6).max(dim=0)[0] >= torch.tensor(size, device=dv)).sum() == 0, "Max values of indices ({}) out of bounds ({})".format(indices.view(-1, 6).max(dim=0)[0], size)
-
-        output = tensors.contract(indices, values, size, x)
+        else:
+            raise Exception('Method {} not recognized'.format(self.method))
 
         if self.has_bias:
             return output + self.bias
         return output
 
+    def gather(self, x, indices, values):
+        """
+        Applies the sampled kernels by gathering the input values at the sampled offsets. Every kernel instance uses
+        the same relative offsets, so an offset (c, dy, dx) of the instance at (y, x) selects the padded input at
+        (c, y + dy, x + dx).
+
+        :param x: (B, C, Hp, Wp) padded input. B should be a multiple of b.
+        :param indices: (b, o, nk, l, 3) LongTensor of sampled (c, dy, dx) offsets
+        :param values: (b, o, nk, l) tensor of corresponding values
+        :return: (B, o, h, w) output
+        """
+        bx, c, hp, wp = x.size()
+        b, o, nk, l, _ = indices.size()
+        h, w = self.in_size[1:]
+        m = bx // b
+
+        # coordinates of the kernel instances
+        pos = torch.arange(nk, device=d(indices))
+        ys, xs = (pos // w)[None, None, :, None], (pos % w)[None, None, :, None]
+
+        # flat indices into the padded input
+        flat = indices[..., 0] * (hp * wp) + (indices[..., 1] + ys) * wp + (indices[..., 2] + xs)
+        flat = flat.reshape(b, 1, o * nk * l).expand(b, m, o * nk * l)
+
+        selected = x.reshape(b, m, c * hp * wp).gather(2, flat)
+        selected = selected.view(b, m, o, nk, l) * values[:, None, :, :, :]
+
+        return selected.sum(dim=4).view(bx, o, h, w)
+
 FLOOR_MASKS = {}
 def floor_mask(num_cols, cuda=False):
     if num_cols not in FLOOR_MASKS:
@@ -622,7 +1151,24 @@ def floor_mask(num_cols, cuda=False):
         return FLOOR_MASKS[num_cols].cuda()
     return FLOOR_MASKS[num_cols]
 
-def generate_integer_tuples(means, gadditional, ladditional, rng=None, relative_range=None, seed=None, cuda=False, fm=None):
+def neighbors(means, fm):
+    """
+    Computes the integer index tuples at the corners of the hypercube around each continuous index tuple: the
+    floor of each coordinate where the floor mask is True, and the ceiling where it is False.
+
+    The ceiling is computed as floor + 1, except for coordinates that are already integers (where the floor and ceiling
+    are the same). The result is computed with a single broadcast, without masked copies.
+
+    :param means: (..., rank) tensor of continuous index tuples
+    :param fm: (2^rank, rank) floor mask
+    :return: (..., 2^rank, rank) LongTensor of integer index tuples
+    """
+    floors = means.floor()
+    fractional = (means != floors).long() # for integer values, the floor and ceiling are the same
+
+    return floors.long().unsqueeze(-2) + (~ fm).long() * fractional.unsqueeze(-2)
+
+def generate_integer_tuples(means, gadditional, ladditional, rng=None, relative_range=None, seed=None, cuda=False, fm=None, generator=None, sampler=None):
     """
     Takes continuous-valued index tuples, and generates integer-valued index tuples.
 
@@ -642,29 +1188,31 @@ def generate_integer_tuples(means, gadditional, ladditional, rng=None, relative_
     FT = torch.cuda.FloatTensor if cuda else torch.FloatTensor
 
     if seed is not None:
-        torch.manual_seed(seed)
+        if generator is None:
+            torch.manual_seed(seed)
+        else:
+            generator.manual_seed(seed)
 
     """
     Generate neighbor tuples
     """
     if fm is None:
         fm = floor_mask(rank, cuda)
-    fm = fm[None, None, None, :].expand(b, k, c, 2 ** rank, rank)
-
-    neighbor_ints = means.data[:, :, :, None, :].expand(b, k, c, 2 ** rank, rank).contiguous()
 
-    neighbor_ints[fm] = neighbor_ints[fm].floor()
-    neighbor_ints[~fm] = neighbor_ints[~fm].ceil()
-
-    neighbor_ints = neighbor_ints.long()
+    neighbor_ints = neighbors(means.data, fm)
 
     """
     Sample uniformly from all integer tuples
     """
 
-    global_ints = FT(b, k, c, gadditional, rank)
+    if sampler is not None:
+        global_ints, local_ints = sampler.draw((b, k, c, gadditional, rank), (b, k, c, ladditional, rank), d(means))
+    else:
+        global_ints, local_ints = FT(b, k, c, gadditional, rank), FT(b, k, c, ladditional, rank)
+
+        global_ints.uniform_(generator=generator)
+        local_ints.uniform_(generator=generator)
 
-    global_ints.uniform_()
     global_ints *= (1.0 - EPSILON)
 
     rng = FT(rng)
@@ -675,9 +1223,6 @@ def generate_integer_tuples(means, gadditional, ladditional, rng=None, relative_
     """
     Sample uniformly from a small range around the given index tuple
     """
-    local_ints = FT(b, k, c, ladditional, rank)
-
-    local_ints.uniform_()
     local_ints *= (1.0 - EPSILON)
 
     rngxp = rng[None, None, None, :].expand_as(local_ints) # bounds of the tensor
@@ -706,13 +1251,16 @@ def generate_integer_tuples(means, gadditional, ladditional, rng=None, relative_
     return all.view(b, k, -1, rank) # combine all indices sampled within a chunk
 
 
-def ngenerate(means, gadditional, ladditional, rng=None, relative_range=None, seed=None, cuda=False, fm=None, epsilon=EPSILON):
+def ngenerate(means, gadditional, ladditional, rng=None, relative_range=None, seed=None, cuda=False, fm=None, generator=None, sampler=None, epsilon=EPSILON):
     """
 
     Generates random integer index tuples based on continuous parameters.
 
     :param epsilon: The random bumbers are based on uniform samples in (0, 1-epsilon). Note that
       in some cases epsilon needs to be relatively big (e.g. 10-5)
+    :param generator: Optional torch.Generator (on the same device as the means) to draw the random samples from. If
+      None, the global RNG is used. If a seed is given, the generator is reseeded rather than the global RNG.
+    :param sampler: Optional Presampler to take pre-drawn uniform samples from (instead of drawing them here).
 
     """
 
@@ -729,7 +1277,10 @@ def ngenerate(means, gadditional, ladditional, rng=None, relative_range=None, se
     bounds = util.unsqueezen(rng, len(pref) + 1).long() # index bound with unsqueezed dims for broadcasting
 
     if seed is not None:
-        torch.manual_seed(seed)
+        if generator is None:
+            torch.manual_seed(seed)
+        else:
+            generator.manual_seed(seed)
 
     """
     Generate neighbor tuples
@@ -737,40 +1288,37 @@ def ngenerate(means, gadditional, ladditional, rng=None, relative_range=None, se
     if fm is None:
         fm = floor_mask(rank, cuda)
 
-    size = pref + (2**rank, rank)
-    fm = util.unsqueezen(fm, len(size) - 2).expand(size)
-
-    neighbor_ints = means.data.unsqueeze(-2).expand(*size).contiguous()
+    neighbor_ints = neighbors(means.data, fm)
 
-    neighbor_ints[fm] = neighbor_ints[fm].floor()
-    neighbor_ints[~fm] = neighbor_ints[~fm].ceil()
-
-    neighbor_ints = neighbor_ints.long()
-
-    assert (neighbor_ints >= bounds).sum() == 0, 'One of the neighbor indices is outside the tensor bounds'
+    if DEBUG:
+        assert (neighbor_ints >= bounds).sum() == 0, 'One of the neighbor indices is outside the tensor bounds'
 
     """
     Sample uniformly from all integer tuples
     """
     gsize = pref + (gadditional, rank)
-    global_ints = FT(*gsize)
+    lsize = pref + (ladditional, rank)
+
+    if sampler is not None:
+        global_ints, local_ints = sampler.draw(gsize, lsize, d(means))
+    else:
+        global_ints, local_ints = FT(*gsize), FT(*lsize)
+
+        global_ints.uniform_(generator=generator)
+        local_ints.uniform_(generator=generator)
 
-    global_ints.uniform_()
     global_ints *= (1.0 - epsilon)
 
     rngxp = util.unsqueezen(rng, len(gsize) - 1).expand_as(global_ints)
 
     global_ints = torch.floor(global_ints * rngxp).long()
 
-    assert (global_ints >= bounds).sum() == 0, 'One of the global sampled indices is outside the tensor bounds'
+    if DEBUG:
+        assert (global_ints >= bounds).sum() == 0, 'One of the global sampled indices is outside the tensor bounds'
 
     """
     Sample uniformly from a small range around the given index tuple
     """
-    lsize = pref + (ladditional, rank)
-    local_ints = FT(*lsize)
-
-    local_ints.uniform_()
     local_ints *= (1.0 - epsilon)
 
     rngxp = util.unsqueezen(rng, len(lsize) - 1).expand_as(local_ints) # bounds of the tensor
@@ -792,14 +1340,17 @@ def ngenerate(means, gadditional, ladditional, rng=None, relative_range=None, se
     idxs = upper > rngxp
     lower[idxs] = rngxp[idxs] - rrng[idxs]
 
-    cached = local_ints.clone()
+    if DEBUG:
+        cached = local_ints.clone()
+
     local_ints = (local_ints * rrng + lower).long()
 
-    assert (local_ints >= bounds).sum() == 0, f'One of the local sampled indices is outside the tensor bounds (this may mean the epsilon is too small)' \
-        f'\n max sampled  {(cached * rrng).max().item()}, rounded {(cached * rrng).max().long().item()}  max lower limit {lower.max().item()}' \
-        f'\n sum          {((cached * rrng).max() + lower.max()).item()}' \
-        f'\n rounds to    {((cached * rrng).max() + lower.max()).long().item()}'
-        #f'\n {means}\n {local_ints}\n {cached * rrng}'
+    if DEBUG:
+        assert (local_ints >= bounds).sum() == 0, f'One of the local sampled indices is outside the tensor bounds (this may mean the epsilon is too small)' \
+            f'\n max sampled  {(cached * rrng).max().item()}, rounded {(cached * rrng).max().long().item()}  max lower limit {lower.max().item()}' \
+            f'\n sum          {((cached * rrng).max() + lower.max()).item()}' \
+            f'\n rounds to    {((cached * rrng).max() + lower.max()).long().item()}'
+            #f'\n {means}\n {local_ints}\n {cached * rrng}'
 
     all = torch.cat([neighbor_ints, global_ints, local_ints] , dim=-2)
 
@@ -2,7 +2,7 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 
-import util
+import util, tensors
 import numpy as np
 
 """
@@ -23,7 +23,12 @@ class Split(nn.Module):
     the matrix and so on.
 
     """
-    def __init__(self, size, depth, additional=1, sigma_scale=0.1, sigma_floor=0.0):
+    def __init__(self, size, depth, additional=1, sigma_scale=0.1, sigma_floor=0.0, method='gather'):
+        """
+        :param method: How to apply the sampled half-permutations. 'gather' moves the elements directly with a
+            scatter-add (or a gather, for the reverse permutation) weighted by their probabilities. 'sparse' builds the
+            permutation matrices and multiplies by them.
+        """
         super().__init__()
 
         template = torch.LongTensor(range(size)).unsqueeze(1).expand(size, 2)
@@ -34,6 +39,7 @@ class Split(nn.Module):
         self.sigma_scale = sigma_scale
         self.sigma_floor = sigma_floor
         self.additional = additional
+        self.method = method
 
     def duplicates(self, tuples):
         """
@@ -45,37 +51,27 @@ class Split(nn.Module):
         """
         b, k, r = tuples.size()
 
-        # unique = ((tuples.float() + 1) ** primes).prod(dim=2)  # unique identifier for each tuple
-        unique = util.unique(tuples.view(b*k, r)).squeeze().view(b, k)
-
-        sorted, sort_idx = torch.sort(unique, dim=1)
-        _, unsort_idx = torch.sort(sort_idx, dim=1)
-
-        mask = sorted[:, 1:] == sorted[:, :-1]
-        # mask = mask.view(b, k - 1)
-
-        zs = torch.zeros(b, 1, dtype=torch.uint8, device='cuda' if tuples.is_cuda else 'cpu')
-        mask = torch.cat([zs, mask], dim=1)
-
-        return torch.gather(mask, 1, unsort_idx)
+        # -- the tuples are (half) permutations, so every value is in [0, size)
+        return util.duplicates(tuples, rng=(self.size,) * r)
 
     def generate_integer_tuples(self, offset, additional=16):
 
         b, s = offset.size()
 
-        choices = offset.round().byte()[:, None, :]
+        choices = offset.round().bool()[:, None, :]
 
         if additional > 0:
             sampled = util.sample_offsets(b, additional, s, self.depth, cuda=offset.is_cuda)
             # sampled = ~ choices
 
-            choices = torch.cat([choices, sampled], dim=1).byte()
+            choices = torch.cat([choices, sampled.bool()], dim=1)
 
         return self.generate(choices, offset)
 
     def generate(self, choices, offset):
 
         b, n, s = choices.size()
+        choices = choices.bool() # - for a uint8 tensor, ~ is a bitwise not, not a logical one
 
         offset = offset[:, None, :].expand(b, n, s)
 
@@ -110,6 +106,11 @@ class Split(nn.Module):
         indices = indices.detach()
         b, n, s = indices.size()
 
+        if self.method == 'gather':
+            return self.permute(input, indices, probs, reverse), self.permute(keys[:, :, None], indices, probs, reverse)[:, :, 0]
+        if self.method != 'sparse':
+            raise Exception('Method {} not recognized'.format(self.method))
+
         template = self.template[None, None, :, :].expand(b, n, s, 2).contiguous()
         if not reverse: # normal half-permutation
             template[:, :, :, 0] = indices
@@ -120,24 +121,54 @@ class Split(nn.Module):
         indices = indices.contiguous().view(b, -1, 2)
         probs = probs.contiguous().view(b, -1)
 
-        output   = util.batchmm(indices, probs, (s, s), input)
+        output   = tensors.batchmm(indices, probs, (s, s), input)
 
-        keys_out = util.batchmm(indices, probs, (s, s), keys[:, :, None]).squeeze()
+        keys_out = tensors.batchmm(indices, probs, (s, s), keys[:, :, None])[:, :, 0]
 
         return output, keys_out
 
+    def permute(self, input, indices, probs, reverse=False):
+        """
+        Applies a weighted sum of half-permutations to the input: each element j is moved to position indices[:, n, j]
+        with weight probs[:, n, j] (or, in reverse, position j receives the element at indices[:, n, j]).
+
+        :param input: (b, s, z) tensor
+        :param indices: (b, n, s) LongTensor of n candidate permutations
+        :param probs: (b, n, s) tensor of weights
+        :return: (b, s, z) tensor
+        """
+        b, s, z = input.size()
+        n = indices.size(1)
+
+        idx = indices.reshape(b, n * s, 1).expand(b, n * s, z)
+
+        if not reverse:
+            moved = (probs[:, :, :, None] * input[:, None, :, :]).reshape(b, n * s, z)
+            return torch.zeros_like(input, dtype=moved.dtype).scatter_add(1, idx, moved)
+
+        moved = input.gather(1, idx).view(b, n, s, z)
+        return (probs[:, :, :, None] * moved).sum(dim=1)
+
 class SortLayer(nn.Module):
     """
 
     """
-    def __init__(self, size, additional=0, sigma_scale=0.1, sigma_floor=0.0, certainty=10.0):
+    def __init__(self, size, additional=0, sigma_scale=0.1, sigma_floor=0.0, certainty=10.0, method='gather', pivot_method='select', fast_eval=True):
+        """
+        :param fast_eval: In eval mode (without a target), compute the result of the chain of hard splits directly
+            (see hard_sort()), rather than through the splits' sampling machinery. The result is the same, also when
+            keys tie.
+        """
         super().__init__()
 
+        self.pivot_method = pivot_method
+        self.fast_eval = fast_eval
+
         mdepth = int(np.log2(size))
 
         self.layers = nn.ModuleList()
         for d in range(mdepth):
-            self.layers.append(Split(size, d, additional, sigma_scale, sigma_floor))
+            self.layers.append(Split(size, d, additional, sigma_scale, sigma_floor, method=method))
 
         # self.certainty = nn.Parameter(torch.tensor([certainty]))
         self.register_buffer('certainty', torch.tensor([certainty]))
@@ -157,18 +188,14 @@ class SortLayer(nn.Module):
         b, s, z = x.size()
         b, s = keys.size()
 
+        if not train and target is None and self.fast_eval:
+            return self.hard_sort(x, keys)
+
         t = target
 
         for d, split in enumerate(self.layers):
 
-            buckets = keys[:, :, None].view(b, 2**d, -1)
-
-            # compute pivots
-            pivots = buckets.view(b*2**d, -1)
-            pivots = median(pivots, keepdim=True)
-            pivots = pivots.view(b, 2 ** d, -1).expand_as(buckets)
-
-            pivots = pivots.contiguous().view(b, -1).expand_as(keys)
+            pivots = self.pivots(keys, d)
 
             # compute offsets by comparing values to pivots
             if train:
@@ -199,12 +226,73 @@ class SortLayer(nn.Module):
 
         return xs, targets, keys
 
-def median(x, keepdim=False):
+    def pivots(self, keys, d):
+        """
+        Computes the pivot of each key: the median of its bucket at depth d.
+
+        :param keys: (b, s) tensor
+        :return: (b, s) tensor
+        """
+        b, s = keys.size()
+
+        buckets = keys[:, :, None].view(b, 2**d, -1)
+
+        pivots = buckets.view(b*2**d, -1)
+        pivots = median(pivots, keepdim=True, method=self.pivot_method)
+        pivots = pivots.view(b, 2 ** d, -1).expand_as(buckets)
+
+        return pivots.contiguous().view(b, -1).expand_as(keys)
+
+    def hard_sort(self, x, keys):
+        """
+        Computes the output of the chain of splits in eval mode (with hard offsets) directly. At each depth, only the
+        keys are moved, and the half-permutation of the split (util.split() of the rounded offsets) is composed with
+        those of the previous depths. The input is moved once, at the end.
+
+        If keys that are equal to a pivot fall on both sides of it, util.split() clamps the indices, and a split may
+        move several elements to the same position, where they are summed. The composed map does the same, so the
+        result is the same as that of the splits.
+
+        :param x: (b, s, z) input
+        :param keys: (b, s) keys
+        :return: The sorted input and keys
+        """
+        b, s, z = x.size()
+
+        # the current position of each element of the input
+        position = torch.arange(s, device=x.device)[None, :].expand(b, s)
+
+        for d, split in enumerate(self.layers):
+            offset = keys > self.pivots(keys, d)
+
+            indices = util.split(offset[:, None, :], split.depth)[:, 0, :] # - element j moves to indices[:, j]
+
+            keys = torch.zeros_like(keys).scatter_add(1, indices, keys)
+            position = indices.gather(1, position)
+
+        return torch.zeros_like(x).scatter_add(1, position[:, :, None].expand(b, s, z), x), keys
+
+def median(x, keepdim=False, method='select'):
+    """
+    Computes the median of each row (the mean of the two middle values, for rows of even length).
+
+    :param x: (b, s) tensor
+    :param method: 'select' finds the middle values with kthvalue (a selection, rather than a full sort). 'sort'
+        sorts the rows.
+    :return:
+    """
     b, s = x.size()
 
-    y = x.sort(dim=1)[0][:, s//2-1:s//2+1].mean(dim=1, keepdim=keepdim)
+    if method == 'sort':
+        return x.sort(dim=1)[0][:, s//2-1:s//2+1].mean(dim=1, keepdim=keepdim)
+
+    if method != 'select':
+        raise Exception('Method {} not recognized'.format(method))
+
+    lo = x.kthvalue(max(s//2, 1), dim=1, keepdim=keepdim)[0]
+    hi = x.kthvalue(s//2 + 1, dim=1, keepdim=keepdim)[0]
 
-    return y
+    return (lo + hi) / 2
 
 if __name__ == '__main__':
 
@@ -3,6 +3,8 @@ from torch import FloatTensor, LongTensor
 from torch.autograd import Variable
 import torch.nn.functional as F
 
+from collections import OrderedDict
+
 from sparse.util import prod
 import util, sys
 
@@ -12,6 +14,85 @@ from util import d
 Utility functions for manipulation tensors
 """
 
+class ContractionPlan:
+    """
+    Precomputed strides for flattening the index tuples of a tensor of size out_shape + in_shape into index tuples of a
+    matrix of size (prod(out_shape), prod(in_shape)). The first len(out_shape) dimensions are flattened (in row-major
+    order) into the vertical dimension of the matrix and the remaining dimensions into the horizontal dimension.
+
+    The shapes are static during training, so plans are cached (see contraction_plan() and set_plan_cache()).
+    """
+
+    def __init__(self, in_shape, out_shape, device='cpu'):
+
+        in_shape, out_shape = tuple(int(s) for s in in_shape), tuple(int(s) for s in out_shape)
+        outrank, inrank = len(out_shape), len(in_shape)
+
+        self.in_shape, self.out_shape = in_shape, out_shape
+        self.flat_size = (prod(out_shape), prod(in_shape))
+
+        # (rank, 2) matrix of strides: the first column computes the row index, the second the column index
+        strides = [[0, 0] for _ in range(outrank + inrank)]
+        for i in range(outrank):
+            strides[i][0] = prod(out_shape[i+1:])
+        for i in range(inrank):
+            strides[outrank + i][1] = prod(in_shape[i+1:])
+
+        self.strides = torch.tensor(strides, dtype=torch.long, device=device)
+        self.col_strides = {}
+
+    def flatten(self, indices, cols=None):
+        """
+        :param indices: (..., rank) LongTensor of tensor index tuples
+        :param cols: If not None, the indices contain only these columns of the index tuples (and the other columns are
+            taken to be zero).
+        :return: (..., 2) LongTensor of matrix index tuples
+        """
+        if cols is None:
+            return (indices.unsqueeze(-1) * self.strides).sum(dim=-2)
+
+        cols = tuple(cols)
+        if cols not in self.col_strides:
+            self.col_strides[cols] = self.strides[list(cols), :]
+
+        return (indices.unsqueeze(-1) * self.col_strides[cols]).sum(dim=-2)
+
+# LRU cache of contraction plans (see set_plan_cache)
+PLANS = OrderedDict()
+max_plans = 256
+
+def set_plan_cache(size):
+    """
+    Sets the maximum number of cached contraction plans. The least recently used plans are evicted first. Only needed
+    if the shapes vary a lot (each plan is small).
+
+    :param size: The maximum number of plans. 0 disables the cache.
+    """
+    global max_plans
+
+    max_plans = size
+    PLANS.clear()
+
+def contraction_plan(in_shape, out_shape, device='cpu'):
+    """
+    Returns the (cached) ContractionPlan for the given shapes and device.
+    """
+    key = (tuple(int(s) for s in in_shape), tuple(int(s) for s in out_shape), str(device))
+
+    if key in PLANS:
+        PLANS.move_to_end(key)
+        return PLANS[key]
+
+    plan = ContractionPlan(in_shape, out_shape, device)
+
+    if max_plans > 0:
+        PLANS[key] = plan
+
+        while len(PLANS) > max_plans:
+            PLANS.popitem(last=False)
+
+    return plan
+
 def flatten_indices_mat(indices, in_shape, out_shape):
     """
     Turns a n NxK matrix of N index-tuples for a tensor T of rank K into an Nx2 matrix M of index-tuples for a _matrix_
@@ -22,38 +103,23 @@ def flatten_indices_mat(indices, in_shape, out_shape):
     :return: (1) A matrix of size N by 2, (2) the dimensions of M
     """
 
-    batchsize, n, rank = indices.size()
+    plan = contraction_plan(in_shape, out_shape, indices.device)
 
-    inrank = len(in_shape)
-    outrank = len(out_shape)
-
-    result = torch.cuda.LongTensor(batchsize, n, 2) if indices.is_cuda else LongTensor(batchsize, n, 2)
-
-    left = fi_matrix(indices[:, :, 0:outrank], out_shape)   # i index of the weight matrix
-    right = fi_matrix(indices[:, :, outrank:rank], in_shape) # j index
-
-    result = torch.cat([left.unsqueeze(2), right.unsqueeze(2)], dim=2)
-
-    return result, LongTensor((prod(out_shape), prod(in_shape)))
+    return plan.flatten(indices), plan.flat_size
 
 def fi_matrix(indices, shape):
-    batchsize, rows, rank = indices.size()
-
-    prod = torch.LongTensor(rank).fill_(1)
-
-    if indices.is_cuda:
-        prod = prod.cuda()
-
-    for i in range(rank):
-        prod[i] = 1
-        for j in range(i + 1, len(shape)):
-            prod[i] *= shape[j]
+    """
+    Flattens index tuples for a tensor of the given shape into (row-major) linear indices.
 
-    indices = indices * prod.unsqueeze(0).unsqueeze(0).expand_as(indices)
+    :param indices: (..., rank) LongTensor of index tuples
+    :param shape: The shape of the tensor
+    :return: (...) LongTensor of linear indices
+    """
+    strides = torch.tensor([prod(shape[i+1:]) for i in range(len(shape))], dtype=torch.long, device=indices.device)
 
-    return indices.sum(dim=2)
+    return (indices * strides).sum(dim=-1)
 
-def contract(indices, values, size, x, cuda=None):
+def contract(indices, values, size, x, cuda=None, method='sparse', template=None, learn_cols=None):
     """
     Performs a contraction (generalized matrix multiplication) of a sparse tensor with and input x.
 
@@ -64,7 +130,13 @@ def contract(indices, values, size, x, cuda=None):
     :param indices: (b, k, r)-tensor describing indices of b sparse tensors of rank r
     :param values: (b, k)-tes=nsor with the corresponding values
     :param size:
-    :param x:
+    :param x: The input. Its batch dimension may be a multiple m of b, in which case each sparse tensor is applied to
+        m consecutive instances in the batch.
+    :param method: The batchmm method used to compute the resulting matrix multiplication ('sparse' or 'gather').
+    :param template: Optional (h, r) LongTensor of index tuples. If given, the indices only provide the columns
+        learn_cols, and these are added to the template: the first k/h index tuples to the first row of the template,
+        the next k/h to the second, and so on. The template is never expanded to the full (b, k, r) index tensor.
+    :param learn_cols: The columns of the template that the indices are added to.
     :return:
     """
     # translate tensor indices to matrix indices
@@ -77,111 +149,64 @@ def contract(indices, values, size, x, cuda=None):
     in_size = x.size()[1:]
     out_size = size[:-len(in_size)]
 
-    assert len(out_size) + len(in_size) == r
+    if template is None:
+        assert len(out_size) + len(in_size) == r
+    else:
+        assert len(out_size) + len(in_size) == template.size(1) and len(learn_cols) == r
+        assert k % template.size(0) == 0
+
+    bx = x.size(0)
+    assert bx % b == 0, 'Input batch size ({}) should be a multiple of the number of sparse tensors ({}).'.format(bx, b)
+    m = bx // b
 
     # Flatten into a matrix multiplication
-    mindices, flat_size = flatten_indices_mat(indices, x.size()[1:], out_size)
-    x_flat = x.view(b, -1, 1)
+    if template is None:
+        mindices, flat_size = flatten_indices_mat(indices, in_size, out_size)
+    else:
+        # flattening is linear, so we can flatten the template and the learned columns separately
+        plan = contraction_plan(in_size, out_size, indices.device)
+        h = template.size(0)
+
+        mindices = plan.flatten(template)[None, :, None, :] + plan.flatten(indices, learn_cols).view(b, h, k//h, 2)
+        mindices, flat_size = mindices.view(b, k, 2), plan.flat_size
+    x_flat = x.reshape(b, m, -1).transpose(1, 2) # instances that share a tensor become columns of the same matrix
 
     # Prevent segfault
     assert mindices.min() >= 0, 'negative index in flattened indices: {} \n {} \n Original indices {} \n {}'.format(mindices.size(), mindices, indices.size(), indices)
     assert not util.contains_nan(values.data), 'NaN in values:\n {}'.format(values)
 
-    y_flat = batchmm(mindices, values, flat_size, x_flat, cuda)
+    y_flat = batchmm(mindices, values, flat_size, x_flat, cuda, method=method)
 
-    return y_flat.view(b, *out_size)  # reshape y into a tensor
+    return y_flat.transpose(1, 2).reshape(bx, *out_size)  # reshape y into a tensor
 
 
-def sparsemm(use_cuda):
+def sparsemm(use_cuda=None):
     """
-    :param use_cuda:
+    :param use_cuda: Ignored, the multiplication works on any device.
     :return:
     """
-    return SparseMMGPU.apply if use_cuda else SparseMMCPU.apply
-
-
-class SparseMMCPU(torch.autograd.Function):
-
-    """
-    Sparse matrix multiplication with gradients over the value-vector
-
-    Does not work with batch dim.
-    """
-
-    @staticmethod
-    def forward(ctx, indices, values, size, xmatrix):
-
-        # print(type(size), size, list(size), intlist(size))
-        # print(indices.size(), values.size(), torch.Size(intlist(size)))
-
-        matrix = torch.sparse.FloatTensor(indices, values, torch.Size(intlist(size)))
-
-        ctx.indices, ctx.matrix, ctx.xmatrix = indices, matrix, xmatrix
-
-        return torch.mm(matrix, xmatrix)
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        grad_output = grad_output.data
-
-        # -- this will break recursive autograd, but it's the only way to get grad over sparse matrices
-
-        i_ixs = ctx.indices[0,:]
-        j_ixs = ctx.indices[1,:]
-        output_select = grad_output[i_ixs, :]
-        xmatrix_select = ctx.xmatrix[j_ixs, :]
-
-        grad_values = (output_select * xmatrix_select).sum(dim=1)
-
-        grad_xmatrix = torch.mm(ctx.matrix.t(), grad_output)
-        return None, Variable(grad_values), None, Variable(grad_xmatrix)
-
-class SparseMMGPU(torch.autograd.Function):
-
-    """
-    Sparse matrix multiplication with gradients over the value-vector
-
-    Does not work with batch dim.
-    """
-
-    @staticmethod
-    def forward(ctx, indices, values, size, xmatrix):
-
-        # print(type(size), size, list(size), intlist(size))
-
-        matrix = torch.cuda.sparse.FloatTensor(indices, values, torch.Size(intlist(size)))
-
-        ctx.indices, ctx.matrix, ctx.xmatrix = indices, matrix, xmatrix
-
-        return torch.mm(matrix, xmatrix)
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        grad_output = grad_output.data
-
-        # -- this will break recursive autograd, but it's the only way to get grad over sparse matrices
-
-        i_ixs = ctx.indices[0,:]
-        j_ixs = ctx.indices[1,:]
-        output_select = grad_output[i_ixs]
-        xmatrix_select = ctx.xmatrix[j_ixs]
-
-        grad_values = (output_select *  xmatrix_select).sum(dim=1)
-
-        grad_xmatrix = torch.mm(ctx.matrix.t(), grad_output)
-        return None, Variable(grad_values), None, Variable(grad_xmatrix)
+    return util.SparseMM.apply
 
-def batchmm(indices, values, size, xmatrix, cuda=None):
+def batchmm(indices, values, size, xmatrix, cuda=None, method='sparse'):
     """
     Multiply a batch of sparse matrices (indices, values, size) with a batch of dense matrices (xmatrix)
 
-    :param indices:
-    :param values:
-    :param size:
-    :param xmatrix:
-    :return:
+    :param indices: (b, n, 2) LongTensor of matrix index tuples
+    :param values: (b, n) tensor of values
+    :param size: The size of the sparse matrices (height, width)
+    :param xmatrix: (b, width, z) tensor of dense matrices
+    :param method: How to compute the product. 'sparse' assembles all matrices in the batch into one block-diagonal
+        torch sparse tensor and multiplies that. 'gather' selects the rows of xmatrix for each index tuple and
+        scatter-adds the weighted rows into the result. The latter never builds a sparse tensor, and its cost is linear
+        in the number of index tuples.
+    :return: (b, height, z) tensor
     """
 
+    if method == 'gather':
+        return gathermm(indices, values, size, xmatrix)
+    if method != 'sparse':
+        raise Exception('Method {} not recognized'.format(method))
+
     if cuda is None:
         cuda = indices.is_cuda
 
@@ -197,11 +222,11 @@ def batchmm(indices, values, size, xmatrix, cuda=None):
 
     bindices = (m * bmult).view(b*n, r) + indices.view(b*n, r)
 
-    bfsize = Variable(size * b)
+    bfsize = (b * height, b * width)
     bvalues = values.contiguous().view(-1)
 
     b, w, z = xmatrix.size()
-    bxmatrix = xmatrix.view(-1, z)
+    bxmatrix = xmatrix.reshape(-1, z) # - xmatrix may be a non-contiguous view (see contract())
 
     sm = sparsemm(cuda)
 
@@ -209,14 +234,39 @@ def batchmm(indices, values, size, xmatrix, cuda=None):
 
     return result.view(b, height, -1)
 
+def gathermm(indices, values, size, xmatrix):
+    """
+    Batched sparse-dense matrix multiplication by gathering and scatter-adding rows. Computes the same result as
+    batchmm(..., method='sparse'), including the sums over duplicate index tuples, but uses only dense operations, so
+    autograd provides the gradients (also higher order ones) over both the values and xmatrix.
+
+    :param indices: (b, n, 2) LongTensor of matrix index tuples
+    :param values: (b, n) tensor of values
+    :param size: The size of the sparse matrices (height, width)
+    :param xmatrix: (b, width, z) tensor of dense matrices
+    :return: (b, height, z) tensor
+    """
+    b, n, _ = indices.size()
+    height, width = size
+    z = xmatrix.size(-1)
+
+    rows = indices[:, :, 0:1].expand(b, n, z)
+    cols = indices[:, :, 1:2].expand(b, n, z)
+
+    selected = xmatrix.gather(1, cols) * values.contiguous().view(b, n, 1)
+
+    result = torch.zeros(b, height, z, dtype=selected.dtype, device=d(xmatrix))
+
+    return result.scatter_add(1, rows, selected)
+
 def intlist(tensor):
     """
     A slow and stupid way to turn a tensor into an iterable over ints
     :param tensor:
     :return:
     """
-    if type(tensor) is list:
-        return tensor
+    if type(tensor) in (list, tuple, torch.Size):
+        return [int(v) for v in tensor]
 
     tensor = tensor.squeeze()
 
@@ -269,10 +319,16 @@ def logsoftmax(indices, values, size, its=10, p=2, method='iteration', row=True,
     :param values:
     :param size:
     :param row:
+    :param method: How to find the row maxima for the logsumexp trick. 'exact' computes them with a single scatter-based
+        reduction (see logsumexp()). 'pnorm' and 'iteration' approximate them with sparse matrix multiplications, and
+        'naive' does not subtract them at all.
     :return:
     """
     epsilon = 1e-7
 
+    if method == 'exact':
+        return values - logsumexp(indices, values, size, row=row)
+
     if method == 'naive':
         values = values.exp()
         sums = sum(indices, values, size, row=row)
@@ -335,7 +391,121 @@ def itmax(indices, values, size, its=10, p=2, row=True):
 
     return sum(indices, values * weights, size, row=row)
 
-def sum(indices, values, size, row=True):
+def fold(indices, values):
+    """
+    Folds any extra batch dimensions of a batch of sparse matrices into a single one.
+
+    :param indices: (..., k, r) LongTensor of index tuples
+    :param values: (..., k) tensor of values
+    :return: (b, k, r) indices, (b, k) values, and the original batch dimensions (None if there were none)
+    """
+    assert len(indices.size()) == len(values.size()) + 1
+
+    if len(indices.size()) == 2:
+        # add batch dim
+        return indices[None, :, :], values[None, :], None
+
+    bdims = indices.size()[:-2]
+    k, r = indices.size()[-2:]
+    assert bdims == values.size()[:-1]
+    assert values.size()[-1] == k
+
+    return indices.reshape(-1, k, r), values.reshape(-1, k), bdims
+
+def unfold(values, bdims):
+    """
+    Inverse of fold() for a (b, k) tensor of per-entry results.
+    """
+    b, k = values.size()
+
+    if bdims is None:
+        return values.view(k)
+
+    return values.view(*bdims + (k,))
+
+def segments(indices, size, row=True):
+    """
+    Assigns each index tuple in a batch of sparse matrices to a segment: the row (or column) it belongs to, offset so
+    that the rows of different matrices in the batch are different segments.
+
+    :param indices: (b, k, 2) LongTensor of index tuples
+    :param size: The size of the sparse matrices (height, width)
+    :param row: Whether to segment by row or by column
+    :return: (b*k) LongTensor of segment ids, and the total number of segments
+    """
+    b, k, _ = indices.size()
+
+    n = size[0] if row else size[1]
+    offsets = torch.arange(b, device=d(indices))[:, None] * n
+
+    return (indices[:, :, 0 if row else 1] + offsets).view(-1), b * n
+
+def segment_sum(values, ids, nsegments):
+    """
+    Sums the values in each segment.
+
+    :param values: (b, k, ...) tensor of values. Any trailing dimensions are summed separately.
+    :param ids: (b*k) segment ids, as returned by segments()
+    :param nsegments: The number of segments
+    :return: (nsegments, ...) tensor of sums (zero for empty segments)
+    """
+    rest = values.size()[2:]
+    result = torch.zeros((nsegments, ) + rest, dtype=values.dtype, device=d(values))
+
+    return result.index_add(0, ids, values.reshape((-1, ) + rest))
+
+def segment_max(values, ids, nsegments):
+    """
+    Takes the maximum of the values in each segment.
+
+    :param values: (b, k, ...) tensor of values. Any trailing dimensions are reduced separately.
+    :param ids: (b*k) segment ids, as returned by segments()
+    :param nsegments: The number of segments
+    :return: (nsegments, ...) tensor of maxima (-inf for empty segments)
+    """
+    rest = values.size()[2:]
+    result = torch.full((nsegments, ) + rest, float('-inf'), dtype=values.dtype, device=d(values))
+
+    ids = ids.view((-1, ) + (1, ) * len(rest)).expand((ids.size(0), ) + rest)
+
+    return result.scatter_reduce(0, ids, values.reshape((-1, ) + rest), reduce='amax', include_self=False)
+
+def rowmax(indices, values, size, row=True):
+    """
+    Computes the maximum of each row (or column) of a sparse matrix, and redistributes the results back to the
+    non-sparse row/column entries.
+
+    Arguments are interpreted as defining sparse matrix. Any extra dimensions as treated as batch.
+    """
+    indices, values, bdims = fold(indices, values)
+    b, k = values.size()
+
+    ids, n = segments(indices, size, row)
+    maxes = segment_max(values, ids, n)
+
+    return unfold(maxes[ids].view(b, k), bdims)
+
+def logsumexp(indices, values, size, row=True):
+    """
+    Computes the log of the summed exponentials of each row (or column) of a sparse matrix, and redistributes the
+    results back to the non-sparse row/column entries. The row maxima are subtracted before exponentiating, so this is
+    numerically stable.
+
+    Arguments are interpreted as defining sparse matrix. Any extra dimensions as treated as batch.
+    """
+    indices, values, bdims = fold(indices, values)
+    b, k = values.size()
+
+    ids, n = segments(indices, size, row)
+
+    # - the max is a constant for the purposes of the gradient
+    maxes = segment_max(values.detach(), ids, n)[ids].view(b, k)
+
+    sums = segment_sum((values - maxes).exp(), ids, n)[ids].view(b, k)
+
+    return unfold(maxes + sums.log(), bdims)
+
+def sum(indices, values, size, row=True, method='segment'):
     """
     Sum the rows or columns of a sparse matrix, and redistribute the
     results back to the non-sparse row/column entries
@@ -343,34 +513,29 @@ def sum(indices, values, size, row=True):
     Arguments are interpreted as defining sparse matrix. Any extra dimensions
     as treated as batch.
 
+    :param method: 'segment' sums the values directly by scatter-adding them per row. 'mm' multiplies the sparse matrix
+        by a vector of ones.
     :return:
     """
 
-    assert len(indices.size()) == len(values.size()) + 1
+    indices, values, bdims = fold(indices, values)
+    b, k, r = indices.size()
 
-    if len(indices.size()) == 2:
-        # add batch dim
-        indices = indices[None, :, :]
-        values = values[None, :]
-        bdims = None
-    else:
-        # fold up batch dim
-        bdims = indices.size()[:-2]
-        k, r = indices.size()[-2:]
-        assert bdims == values.size()[:-1]
-        assert values.size()[-1] == k
+    if method == 'segment':
+        ids, n = segments(indices, size, row)
+        sums = segment_sum(values, ids, n)[ids]
 
-        indices = indices.view(-1, k, r)
-        values = values.view(-1, k)
+        return unfold(sums.view(b, k), bdims)
 
-    b, k, r = indices.size()
+    if method != 'mm':
+        raise Exception('Method {} not recognized'.format(method))
 
-    if row:
-        ones = torch.ones((size[1], 1), device=d(indices))
-    else:
-        ones = torch.ones((size[0], 1), device=d(indices))
+    if not row:
         # transpose the matrix
-        indices = torch.cat([indices[:, :, 1:2], indices[:, :, 0:1]], dim=1)
+        indices = torch.cat([indices[:, :, 1:2], indices[:, :, 0:1]], dim=2)
+        size = (size[1], size[0])
+
+    ones = torch.ones((size[1], 1), device=d(indices))
 
     s, _ = ones.size()
     ones = ones[None, :, :].expand(b, s, 1).contiguous()
@@ -379,7 +544,4 @@ def sum(indices, values, size, row=True):
     bindex = torch.arange(b, device=d(indices))[:, None].expand(b, indices.size(1))
     sums = sums[bindex, indices[:, :, 0], 0]
 
-    if bdims is None:
-        return sums.view(k)
-
-    return sums.view(*bdims + (k,))
+    return unfold(sums, bdims)
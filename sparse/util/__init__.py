@@ -1,11 +1,11 @@
 from .util import \
-    makedirs, prod, contains_nan, contains_inf, bmult, duplicates, nduplicates, \
-    sparsemult, \
-    xent, unique, \
+    makedirs, prod, contains_nan, contains_inf, bmult, duplicates, nduplicates, radix_keys, row_keys, \
+    sparsemult, SparseMM, \
+    xent, unique, nunique, \
     Bias, ChunkSampler, Flatten, Reshape, Debug, Lambda, \
     od, prod, inv, logit, \
     wrapmod, interpolation_grid, unsqueezen, \
-    sample_offsets, split, \
+    sample_offsets, split, shuffle_rows, random_permutations, set_shuffle_cache, \
     CConv2d, \
     tic, toc, d, here, flip, coordinates, schedule
 
@@ -167,79 +167,59 @@ def sample(collection, k, required):
 #     print(sample(range(100), 6, [0, 1, 2]))
 #     print('.')
 
-def sparsemult(use_cuda):
-    return SparseMultGPU.apply if use_cuda else SparseMultCPU.apply
-
-class SparseMultCPU(torch.autograd.Function):
-
+def sparsemult(use_cuda=None):
     """
-    Sparse matrix multiplication with gradients over the value-vector
+    Returns a function that multiplies a sparse matrix (indices, values, size) by a vector. The result is a column
+    vector.
 
-    Does not work with batch dim.
+    :param use_cuda: Ignored, the multiplication works on any device.
+    :return:
     """
+    return lambda indices, values, size, vector : SparseMM.apply(indices, values, size, vector.unsqueeze(1))
 
-    @staticmethod
-    def forward(ctx, indices, values, size, vector):
-
-        # print(type(size), size, list(size), intlist(size))
-        # print(indices.size(), values.size(), torch.Size(intlist(size)))
-
-        matrix = torch.sparse.FloatTensor(indices, values, torch.Size(intlist(size)))
-
-        ctx.indices, ctx.matrix, ctx.vector = indices, matrix, vector
-
-        return torch.mm(matrix, vector.unsqueeze(1))
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        grad_output = grad_output.data
-
-        # -- this will break recursive autograd, but it's the only way to get grad over sparse matrices
-
-        i_ixs = ctx.indices[0,:]
-        j_ixs = ctx.indices[1,:]
-        output_select = grad_output.view(-1)[i_ixs]
-        vector_select = ctx.vector.view(-1)[j_ixs]
-
-        grad_values = output_select *  vector_select
-
-        grad_vector = torch.mm(ctx.matrix.t(), grad_output).t()
-        return None, Variable(grad_values), None, Variable(grad_vector)
-
-class SparseMultGPU(torch.autograd.Function):
-
+class SparseMM(torch.autograd.Function):
     """
-    Sparse matrix multiplication with gradients over the value-vector
+    Sparse matrix multiplication with gradients over the value-vector and the dense matrix. Works on any device.
+
+    Only the indices, values and dense matrix are stored for the backward pass. The gradient over the dense matrix is
+    computed by another application of this function (with the transposed indices), and the gradient over the values by
+    differentiable operations, so higher order derivatives are supported.
 
     Does not work with batch dim.
     """
 
     @staticmethod
-    def forward(ctx, indices, values, size, vector):
+    def forward(ctx, indices, values, size, xmatrix):
+        """
+        :param indices: (2, n) LongTensor of index tuples
+        :param values: (n,) vector of values
+        :param size: The size of the sparse matrix (height, width)
+        :param xmatrix: (width, z) dense matrix
+        :return: (height, z) dense matrix
+        """
 
-        # print(type(size), size, list(size), intlist(size))
+        size = tuple(intlist(size))
+        matrix = torch.sparse_coo_tensor(indices, values, size)
 
-        matrix = torch.cuda.sparse.FloatTensor(indices, values, torch.Size(intlist(size)))
+        ctx.save_for_backward(indices, values, xmatrix)
+        ctx.size = size
 
-        ctx.indices, ctx.matrix, ctx.vector = indices, matrix, vector
-
-        return torch.mm(matrix, vector.unsqueeze(1))
+        return torch.mm(matrix, xmatrix)
 
     @staticmethod
     def backward(ctx, grad_output):
-        grad_output = grad_output.data
 
-        # -- this will break recursive autograd, but it's the only way to get grad over sparse matrices
+        indices, values, xmatrix = ctx.saved_tensors
+        grad_values = grad_xmatrix = None
 
-        i_ixs = ctx.indices[0,:]
-        j_ixs = ctx.indices[1,:]
-        output_select = grad_output.view(-1)[i_ixs]
-        vector_select = ctx.vector.view(-1)[j_ixs]
+        if ctx.needs_input_grad[1]:
+            grad_values = (grad_output[indices[0, :]] * xmatrix[indices[1, :]]).sum(dim=1)
 
-        grad_values = output_select *  vector_select
+        if ctx.needs_input_grad[3]:
+            height, width = ctx.size
+            grad_xmatrix = SparseMM.apply(indices.flip(0), values, (width, height), grad_output)
 
-        grad_vector = torch.mm(ctx.matrix.t(), grad_output).t()
-        return None, Variable(grad_values), None, Variable(grad_vector)
+        return None, grad_values, None, grad_xmatrix
 
 def nvidia_smi():
     command = 'nvidia-smi'
@@ -502,8 +482,8 @@ def intlist(tensor):
     :param tensor:
     :return:
     """
-    if type(tensor) is list:
-        return tensor
+    if type(tensor) in (list, tuple, torch.Size):
+        return [int(v) for v in tensor]
 
     tensor = tensor.squeeze()
 
@@ -605,41 +585,158 @@ def normalize(indices, values, size, row=True, cuda=None, epsilon=0.00000001):
 #     print(normalize(tind, tv, (5, 5)))
 #     print(normalize(tind, tv, (5, 5), row=False))
 
-def duplicates(tuples):
+# largest key allowed for the mixed-radix encoding of integer tuples (with some room to spare in int64)
+MAXKEY = 2 ** 62
+
+def radix_keys(tuples, rng=None):
+    """
+    Maps integer tuples to single integers, by interpreting them as mixed-radix numbers (ie. the linear index of the
+    tuple in a row-major tensor). The mapping is exact: two tuples get the same key if and only if they are equal.
+
+    :param tuples: A (..., r)-tensor of integer tuples
+    :param rng: The bounds of the tuples (every value in column i should be in [0, rng[i]) ). If None, the bounds are
+        taken from the data (this requires a sync between host and device).
+    :return: A (...)-LongTensor of keys, or None if the keys don't fit in a 64 bit integer.
+    """
+    r = tuples.size(-1)
+
+    if rng is None:
+        flat = tuples.reshape(-1, r)
+        if flat.size(0) == 0:
+            return flat.sum(dim=1).view(tuples.size()[:-1])
+
+        lower = flat.min(dim=0)[0]
+        tuples = tuples - lower
+        rng = (flat.max(dim=0)[0] - lower + 1).tolist()
+
+    rng = [int(v) for v in rng]
+    assert len(rng) == r, f'Bounds {rng} do not match rank {r} of the tuples.'
+
+    if prod(rng) >= MAXKEY:
+        return None
+
+    strides = [prod(rng[i+1:]) for i in range(r)]
+    strides = torch.tensor(strides, dtype=torch.long, device=d(tuples))
+
+    return (tuples * strides).sum(dim=-1)
+
+def dense_ranks(keys):
+    """
+    Replaces the keys in each row by their dense rank within the row: equal keys get equal ranks, and the ranks of
+    a row of k keys are in [0, k).
+
+    :param keys: A (batch, k)-LongTensor
+    :return: A (batch, k)-LongTensor
+    """
+    b, k = keys.size()
+
+    sorted, sort_idx = torch.sort(keys, dim=1)
+
+    new = torch.ones_like(sorted)
+    new[:, 0] = 0
+    new[:, 1:] = (sorted[:, 1:] != sorted[:, :-1]).long()
+
+    return torch.zeros_like(sorted).scatter_(1, sort_idx, new.cumsum(dim=1))
+
+def row_keys(tuples, rng=None):
+    """
+    Maps integer tuples to single integers, such that two tuples in the same batch row get the same key if and only if
+    they are equal. Unlike radix_keys, this does not overflow for long tuples: the columns are encoded in chunks that
+    fit a 64 bit integer, and the keys of the chunks so far are reduced to their dense ranks within the row (which are
+    smaller than k) before the next chunk is added.
+
+    :param tuples: A (batch, k, r)-tensor of integer tuples
+    :param rng: The bounds of the tuples (see radix_keys). If None, the bounds are taken from the data.
+    :return: A (batch, k)-LongTensor of keys, or None if a single column does not fit in a 64 bit integer (next to
+        the ranks).
+    """
+    b, k, r = tuples.size()
+
+    if rng is None:
+        flat = tuples.reshape(-1, r)
+        if flat.size(0) == 0:
+            return flat.sum(dim=1).view(b, k)
+
+        lower = flat.min(dim=0)[0]
+        tuples = tuples - lower
+        rng = (flat.max(dim=0)[0] - lower + 1).tolist()
+
+    rng = [int(v) for v in rng]
+    bound = MAXKEY // max(k, 1) # - room for the ranks of the preceding chunks
+
+    keys, fr = None, 0
+    while fr < r:
+        # the largest chunk of columns that fits
+        to, size = fr + 1, rng[fr]
+        while to < r and size * rng[to] < bound:
+            size *= rng[to]
+            to += 1
+
+        if size >= bound:
+            return None
+
+        chunk = radix_keys(tuples[:, :, fr:to], rng[fr:to])
+        keys = chunk if keys is None else dense_ranks(keys) * size + chunk
+
+        fr = to
+
+    return keys
+
+def duplicates(tuples, rng=None):
     """
     Takes a tensor of integer tuples, and for each tuple that occurs multiple times marks all but one of the occurences
-    as duplicate.
+    as duplicate. The first occurrence (in the order of the input) is never marked.
+
+    The tuples are mapped to exact integer keys by a mixed-radix encoding (see radix_keys), and the duplicates are found
+    with a single sort of the keys. If the keys would overflow (as they do for long tuples, like the permutations in
+    sort.Split), the keys are computed in chunks of columns (see row_keys). Only if a single column is too big for that,
+    we fall back to torch.unique to compute the keys.
 
     :param tuples: A (batch, k, r)-tensor of containing a batch of k r-dimensional integer tuples
-    :return: A size (batch, k) byte tensor. When used as a mask, this masks out all duplicates.
+    :param rng: The bounds of the tuples (every value in column i should be in [0, rng[i]) ). If None, the bounds are
+        taken from the data.
+    :return: A size (batch, k) bool tensor. When used as a mask, this masks out all duplicates.
     """
     dv = 'cuda' if tuples.is_cuda else 'cpu'
 
     b, k, r = tuples.size()
 
-    unique = nunique(tuples)
+    keys = radix_keys(tuples, rng)
 
-    sorted, sort_idx = torch.sort(unique, dim=1)
-    _, unsort_idx = torch.sort(sort_idx, dim=1)
+    if keys is None:
+        keys = row_keys(tuples, rng)
 
-    mask = sorted[:, 1:] == sorted[:, :-1]
+    if keys is None:
+        # add the batch index as a column, so that tuples are only equal within a batch row
+        bindex = torch.arange(b, device=dv)[:, None, None].expand(b, k, 1)
+        flat = torch.cat([bindex, tuples], dim=2).view(b*k, r+1)
+
+        _, keys = torch.unique(flat, dim=0, return_inverse=True)
+        keys = keys.view(b, k)
 
-    mask = torch.cat([torch.zeros(b, 1, dtype=torch.bool, device=dv), mask], dim=1) # changed type unit to bool
+    # stable, so that the first occurrence of each tuple ends up first
+    sorted, sort_idx = torch.sort(keys, dim=1, stable=True)
+
+    mask = sorted[:, 1:] == sorted[:, :-1]
+    mask = torch.cat([torch.zeros(b, 1, dtype=torch.bool, device=dv), mask], dim=1)
 
-    return torch.gather(mask, 1, unsort_idx)
+    # move the mask back to the original order
+    return torch.zeros_like(mask).scatter_(1, sort_idx, mask)
 
-def nduplicates(tuples):
+def nduplicates(tuples, rng=None):
     """
     Takes a tensor of integer tuples, and for each tuple that occurs multiple times marks all
     but one of the occurrences as duplicate.
 
     :param tuples: A (..., k, r)-tensor of containing a batch of k r-dimensional integer tuples
-    :return: A size (..., k) byte tensor. When used as a mask, this masks out all duplicates.
+    :param rng: The bounds of the tuples (every value in column i should be in [0, rng[i]) ). If None, the bounds are
+        taken from the data.
+    :return: A size (..., k) bool tensor. When used as a mask, this masks out all duplicates.
     """
     init, k, r = tuples.size()[:-2], tuples.size()[-2], tuples.size()[-1]
 
-    tuples = tuples.view(-1, k, r)
-    mask = duplicates(tuples)
+    tuples = tuples.reshape(-1, k, r)
+    mask = duplicates(tuples, rng)
 
     return mask.view(*init, k)
 
@@ -777,32 +874,71 @@ def sample_offsets(batch, num, size, depth, cuda=False):
     return ordered.contiguous().view(batch, num, -1)
 
 
-shufflecache = {}
-cache_size = 500_000
+def random_permutations(r, c, device='cpu', generator=None):
+    """
+    Draws a batch of independent, uniformly random permutations (as the argsort of uniform noise).
 
-def shuffle_rows(x):
+    :param r: Number of permutations.
+    :param c: Length of each permutation.
+    :return: An (r, c) LongTensor, each row of which is a permutation of range(c).
+    """
+    return torch.rand(r, c, device=device, generator=generator).argsort(dim=1)
 
-    r, c = x.size()
+# Optional LRU cache of pools of precomputed permutations for shuffle_rows (see set_shuffle_cache)
+shufflecache = OrderedDict()
+shuffle_cache_bytes = 0
+shuffle_pool_size = 4096
+
+def set_shuffle_cache(max_bytes, pool_size=4096):
+    """
+    Configures the permutation cache of shuffle_rows(). With the cache enabled, the rows are shuffled with permutations
+    sampled from a fixed pool (per row length and device) rather than fresh ones, which is cheaper for long rows, but
+    less random.
+
+    :param max_bytes: The maximum total size of the cached pools. The least recently used pools are evicted first. 0
+        disables the cache.
+    :param pool_size: The number of permutations in each pool.
+    """
+    global shuffle_cache_bytes, shuffle_pool_size
 
-    if c not in shufflecache:
-        cached = torch.zeros(cache_size, c, dtype=torch.long, device='cpu')
-        for i in range(cache_size):
-            cached[i, :] = torch.randperm(c)
-        shufflecache[c] = cached
+    shuffle_cache_bytes, shuffle_pool_size = max_bytes, pool_size
+    shufflecache.clear()
 
-    cache = shufflecache[c]
-    rows = random.sample(range(cache_size), k=r)
-    sample = cache[rows, :]
+def permutation_pool(c, device):
+    """
+    Returns the cached pool of permutations of range(c) on the given device, creating it (and evicting the least
+    recently used pools) if necessary.
+    """
+    key = (c, str(device))
 
-    if x.is_cuda:
-        sample = sample.cuda()
+    if key in shufflecache:
+        shufflecache.move_to_end(key)
+        return shufflecache[key]
 
-    out = x.gather(dim=1, index=sample)
+    pool = random_permutations(shuffle_pool_size, c, device=device)
+    shufflecache[key] = pool
 
-    if x.is_cuda:
-        out = out.cuda()
+    while len(shufflecache) > 1 and sum(p.numel() * p.element_size() for p in shufflecache.values()) > shuffle_cache_bytes:
+        shufflecache.popitem(last=False)
+
+    return pool
+
+def shuffle_rows(x):
+    """
+    Shuffles each row of a matrix by an independent random permutation.
+
+    :param x: An (r, c) tensor.
+    :return: The shuffled tensor.
+    """
+    r, c = x.size()
+
+    if shuffle_cache_bytes > 0 and c * shuffle_pool_size * 8 <= shuffle_cache_bytes:
+        pool = permutation_pool(c, x.device)
+        perms = pool[torch.randint(pool.size(0), size=(r, ), device=x.device)]
+    else:
+        perms = random_permutations(r, c, device=x.device)
 
-    return out
+    return x.gather(dim=1, index=perms)
 
 # def bunique(tuples):
 #     """
@@ -852,7 +988,7 @@ def unique(tuples):
     if s == 2:
         k1, k2 = tuples[:, 0], tuples[:, 1]
 
-        res = ((k1 + k2) * (k1 + k2 + 1)) / 2 + k2
+        res = ((k1 + k2) * (k1 + k2 + 1)) // 2 + k2
 
         return res[:, None]
 
@@ -5,3 +5,6 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../sparse')))
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../sparse/util')))
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../experiments')))
+
+import sparse
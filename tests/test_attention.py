@@ -0,0 +1,195 @@
+import _context
+
+import unittest
+import torch
+
+import attention, tensors
+
+class TestAttention(unittest.TestCase):
+
+    def test_sddmm(self):
+
+        b, h, t, e, n = 2, 3, 7, 4, 20
+
+        queries = torch.randn(b, h, t, e)
+        keys = torch.randn(b, h, t + 2, e)
+        indices = torch.stack([torch.randint(t, size=(b, n)), torch.randint(t + 2, size=(b, n))], dim=-1)
+        # - duplicate index tuples
+        indices[:, 1, :] = indices[:, 0, :]
+
+        results, grads = [], []
+        for tile in [None, 1, 3, n]:
+            q, k = queries.clone().requires_grad_(), keys.clone().requires_grad_()
+
+            if tile is None: # reference: gather everything and bmm
+                xind = indices[:, None, :, :].expand(b, h, n, 2)
+                ar = torch.arange(b)[:, None, None].expand(b, h, n)
+                ah = torch.arange(h)[None, :, None].expand(b, h, n)
+
+                dot = (q[ar, ah, xind[..., 0], :] * k[ar, ah, xind[..., 1], :]).sum(dim=-1)
+            else:
+                dot = attention.sddmm(q, k, indices, tile=tile)
+
+            dot.pow(2).sum().backward()
+
+            results.append(dot)
+            grads.append((q.grad, k.grad))
+
+        self.assertEqual((b, h, n), results[1].size())
+
+        for result, (gq, gk) in zip(results[1:], grads[1:]):
+            self.assertTrue(torch.allclose(results[0], result, atol=1e-5))
+            self.assertTrue(torch.allclose(grads[0][0], gq, atol=1e-5))
+            self.assertTrue(torch.allclose(grads[0][1], gk, atol=1e-5))
+
+    def test_spmm_normalize(self):
+
+        b, h, t, e, n = 2, 3, 7, 4, 20
+        size = (t, t + 2)
+
+        indices = torch.stack([torch.randint(t, size=(b, n)), torch.randint(t + 2, size=(b, n))], dim=-1)
+        indices[:, 1, :] = indices[:, 0, :]
+        # - reference: the index tuples copied for each head
+        xindices = indices[:, None, :, :].expand(b, h, n, 2).reshape(b*h, n, 2)
+
+        dot = torch.randn(b, h, n)
+        values = torch.randn(b, h, t + 2, e)
+
+        for method in ['softmax', 'softplus', 'relu']:
+            weights = attention.normalize(indices, dot, size, method=method)
+
+            if method == 'softmax':
+                expected = tensors.logsoftmax(xindices, dot.view(b*h, n), size, method='exact').exp()
+
+                # - the same numbers as with the iteratively approximated maxima, and as 'exact'
+                approx = tensors.logsoftmax(xindices, dot.view(b*h, n), size, method='iteration').exp()
+                self.assertTrue(torch.allclose(approx.view(b, h, n), weights, atol=1e-5))
+                self.assertTrue(torch.equal(attention.normalize(indices, dot, size, method='exact'), weights))
+            else:
+                expected = tensors.simple_normalize(xindices, dot.view(b*h, n), size, method=method)
+
+            self.assertTrue(torch.allclose(expected.view(b, h, n), weights, atol=1e-5))
+
+            # masked index tuples are left out of their rows entirely
+            mask = torch.zeros(b, n, dtype=torch.bool)
+            mask[:, 1] = True
+            mask[:, 5:8] = True
+
+            keep = torch.nonzero(~ mask[0])[:, 0]
+            masked = attention.normalize(indices, dot, size, method=method, mask=mask)
+            reference = attention.normalize(indices[:, keep], dot[:, :, keep], size, method=method)
+
+            self.assertTrue(torch.allclose(reference, masked[:, :, keep], atol=1e-5))
+            self.assertTrue((masked[:, :, ~ mask[0]] >= 0).all() and (masked[:, :, mask[0]] == 0).all())
+
+        results, grads = [], []
+        for tile in [None, 3]:
+            w, v = weights.clone().requires_grad_(), values.clone().requires_grad_()
+
+            if tile is None:
+                result = tensors.batchmm(xindices, w.view(b*h, n), (t, t + 2), v.view(b*h, t + 2, e)).view(b, h, t, e)
+            else:
+                result = attention.spmm(indices, w, v, t, tile=tile)
+
+            result.pow(2).sum().backward()
+
+            results.append(result)
+            grads.append((w.grad, v.grad))
+
+        self.assertTrue(torch.allclose(results[0], results[1], atol=1e-5))
+        self.assertTrue(torch.allclose(grads[0][0], grads[1][0], atol=1e-5))
+        self.assertTrue(torch.allclose(grads[0][1], grads[1][1], atol=1e-5))
+
+    def test_variants(self):
+
+        b, t, e = 2, 32, 16
+        x = torch.randn(b, t, e)
+
+        variants = [
+            attention.MSparseSelfAttention(e, k=2, gadditional=1, radditional=1, region=4, heads=2),
+            attention.ASH2DSelfAttention(e, k=2, gadditional=1, radditional=1, region=4, heads=2),
+            attention.ASH1DSelfAttention(e, k=2, gadditional=1, radditional=1, region=4, heads=2),
+            attention.StridedSparseSelfAttention(e, k=2, gadditional=1, radditional=1, region=4, heads=2, stride=4)
+        ]
+
+        for layer in variants:
+            y = layer(x)
+            self.assertEqual((b, t, e), y.size())
+
+            y.sum().backward()
+            self.assertIsNotNone(layer.toqueries.weight.grad)
+
+            # the sampled index tuples never point forward
+            indices, _, _ = layer.sample(x)
+            if layer.rank == 1:
+                self.assertTrue((indices[:, :, 1] <= indices[:, :, 0]).all())
+
+            # in eval mode, duplicate index tuples are masked out
+            layer.eval()
+            indices, _, mask = layer.sample(x)
+            layer.train()
+
+            r = indices.size(1) // layer.k
+            dups = attention.util.nduplicates(indices.view(b, r, layer.k, 2)).view(b, -1)
+            self.assertTrue((mask | ~ dups).all())
+
+            # the input-dependent rank 2 layers also mask the index tuples that point to an earlier row
+            if layer.rank == 2 and not layer.static:
+                earlier = indices[:, :, 0] < torch.arange(t).repeat_interleave(layer.k)[None, :]
+                self.assertTrue(torch.equal(dups | earlier, mask))
+            else:
+                self.assertTrue(torch.equal(dups, mask))
+
+    def test_causal(self):
+
+        b, t, e = 2, 32, 16
+        x = torch.randn(b, t, e)
+
+        # change the inputs from position 20 on
+        y = x.clone()
+        y[:, 20:, :] = torch.randn(b, t - 20, e)
+
+        variants = [
+            attention.MSparseSelfAttention(e, k=2, gadditional=2, radditional=2, region=4, heads=2),
+            attention.ASH2DSelfAttention(e, k=2, gadditional=2, radditional=2, region=4, heads=2),
+            attention.ASH1DSelfAttention(e, k=2, gadditional=2, radditional=2, region=4, heads=2),
+            attention.StridedSparseSelfAttention(e, k=2, gadditional=2, radditional=2, region=4, heads=2, stride=4)
+        ]
+
+        for layer in variants:
+            for train in [True, False]:
+                layer.train(train)
+
+                with torch.no_grad():
+                    layer.rng.seed(0)
+                    first = layer(x)
+                    layer.rng.seed(0)
+                    second = layer(y)
+
+                # the outputs before position 20 do not change, also in training
+                self.assertTrue(torch.allclose(first[:, :20], second[:, :20], atol=1e-5), type(layer).__name__)
+
+    def test_step(self):
+
+        b, t, e = 2, 16, 8
+        x = torch.randn(b, t, e)
+
+        variants = [
+            attention.MSparseSelfAttention(e, k=3, gadditional=1, radditional=1, region=4, heads=2),
+            attention.ASH2DSelfAttention(e, k=3, gadditional=1, radditional=1, region=4, heads=2),
+            attention.ASH1DSelfAttention(e, k=3, gadditional=1, radditional=1, region=4, heads=2),
+            attention.StridedSparseSelfAttention(e, k=3, gadditional=1, radditional=1, region=4, heads=2, stride=4)
+        ]
+
+        for layer in variants:
+            layer.eval()
+
+            with torch.no_grad():
+                cache = layer.init_cache(b, t, 'cpu')
+                steps = torch.stack([layer.step(x[:, i, :], cache) for i in range(t)], dim=1)
+                expected = layer(x)
+
+            self.assertTrue(torch.allclose(expected, steps, atol=1e-5), type(layer).__name__)
+
+if __name__ == '__main__':
+    unittest.main()
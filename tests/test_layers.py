@@ -34,6 +34,21 @@ class TestLayers(unittest.TestCase):
 
         self.assertEquals((3, 7, 5), density.size())
 
+    def test_densities_methods(self):
+
+        points = torch.randint(32, size=(2, 6, 9, 3)).float()
+        means  = torch.rand(2, 6, 4, 3) * 32
+        sigmas = torch.rand(2, 6, 4, 3) * 4 + 1.0
+
+        expected = layers.densities(points, means, sigmas, method='bmm')
+
+        for method in ['direct', 'expanded']:
+            for chunk in [None, 1, 4]:
+                density = layers.densities(points, means, sigmas, method=method, chunk=chunk)
+
+                self.assertEqual((2, 6, 9, 4), density.size())
+                self.assertTrue(torch.allclose(expected, density, atol=1e-4), f'{method}, {chunk}')
+
     def test_ngenerate(self):
 
         means  = torch.randn(6, 2, 3)
@@ -71,6 +86,241 @@ class TestLayers(unittest.TestCase):
         for i in range(indices_new.view(-1, 3).size(0)):
             print(indices_new.view(-1, 3)[i])
 
+    def test_neighbors(self):
+
+        means = torch.rand(4, 5, 3) * 16
+        means[0, 0, :] = torch.tensor([2.0, 3.0, 4.5]) # integer coordinates
+
+        fm = layers.floor_mask(3)
+
+        # reference: the masked floor/ceil of the expanded means
+        expected = means[:, :, None, :].expand(4, 5, 8, 3).contiguous()
+        xfm = fm[None, None, :, :].expand(4, 5, 8, 3)
+        expected[xfm] = expected[xfm].floor()
+        expected[~xfm] = expected[~xfm].ceil()
+
+        actual = layers.neighbors(means, fm)
+
+        self.assertEqual(torch.long, actual.dtype)
+        self.assertEqual((expected.long() != actual).sum().item(), 0)
+
+    def test_freeze(self):
+
+        x = torch.randn(5, 8, 6)
+
+        layer = layers.NASLayer((8, 6), (4, 3), k=32, has_bias=True)
+        layer.bias.data.normal_()
+        layer.eval()
+
+        expected = layer(x)
+
+        for dense in [True, False]:
+            layer.freeze(x, dense=dense)
+
+            self.assertEqual(dense, layer.frozen_weight.layout == torch.strided)
+            self.assertTrue(torch.allclose(expected, layer(x), atol=1e-5))
+
+        # the frozen weight is only used in eval mode
+        layer.train()
+        self.assertEqual((5, 4, 3), layer(x).size())
+
+        layer.unfreeze()
+        self.assertIsNone(layer.frozen_weight)
+
+        # frozen_forward() directly, against the (unfrozen) eval forward
+        layer.eval()
+        expected = layer(x)
+
+        layer.freeze(x)
+        self.assertTrue(torch.allclose(expected, layer.frozen_forward(x), atol=1e-5))
+
+        # a layer whose hypernetwork depends on the input can't be frozen
+        class Dependent(layers.NASLayer):
+            def hyper(self, input, **kwargs):
+                means, sigmas, values, bias = super().hyper(input, **kwargs)
+                return means, sigmas, values * input.mean(), bias
+
+        layer = Dependent((8, 6), (4, 3), k=32, has_bias=True)
+        with self.assertRaises(AssertionError):
+            layer.freeze(x)
+
+    def test_template(self):
+
+        x = torch.randn(5, 8, 6)
+
+        # each row of the template fixes the output index, the input index is learned
+        template = torch.tensor([[0, 0, 0, 0], [1, 2, 0, 0], [2, 1, 0, 0], [3, 2, 0, 0]])
+        layer = layers.NASLayer((8, 6), (4, 3), k=32, template=template, learn_cols=(2, 3), region=(2, 2))
+        layer.eval()
+
+        expected = layer(x)
+
+        # the stored template is not changed ...
+        self.assertTrue(torch.equal(template, layer.temp_indices))
+
+        # ... and the values in its learned columns are ignored
+        template[:, 2:] = torch.randint(0, 6, (4, 2))
+        layer.temp_indices.copy_(template)
+
+        self.assertTrue(torch.allclose(expected, layer(x), atol=1e-5))
+
+    def test_sample_groups(self):
+
+        x = torch.randn(6, 8, 6)
+
+        layer = layers.NASLayer((8, 6), (4, 3), k=32, gadditional=2, radditional=2, region=(2, 2, 2, 2), sample_groups=1)
+
+        # all instances share one sample, so equal inputs give equal outputs
+        x[3] = x[0]
+        y = layer(x)
+
+        self.assertEqual((6, 4, 3), y.size())
+        self.assertTrue(torch.allclose(y[0], y[3], atol=1e-6))
+
+        y.sum().backward()
+        self.assertIsNotNone(layer.pmeans.grad)
+
+        # groups that do not divide the batch
+        layer.sample_groups = 4
+        self.assertEqual((6, 4, 3), layer(x).size())
+
+        c = layers.Convolution((4, 3, 3), 4, k=2, rprop=.5, gadditional=2, radditional=2, sample_groups=2)
+        self.assertEqual((6, 4, 3, 3), c(torch.randn(6, 4, 3, 3)).size())
+
+    def test_sample_rng(self):
+
+        means = torch.rand(2, 3, 4, 2) * 8
+        sample = lambda rng : layers.ngenerate(means, 2, 2, rng=(8, 8), relative_range=(2, 2), generator=rng.generator())
+
+        a, b = layers.SampleRNG(seed=0), layers.SampleRNG(seed=0)
+
+        # independent of the global RNG
+        torch.manual_seed(1)
+        first = sample(a)
+        torch.manual_seed(2)
+        self.assertTrue(torch.equal(first, sample(b)))
+
+        # the state is stored in the state dict
+        state = a.state_dict()
+        expected = sample(a)
+
+        c = layers.SampleRNG(seed=1)
+        c.load_state_dict(state)
+        self.assertTrue(torch.equal(expected, sample(c)))
+
+        # creating a generator does not change the global random stream
+        torch.manual_seed(3)
+        expected = torch.rand(4)
+
+        torch.manual_seed(3)
+        layers.SampleRNG()
+        self.assertTrue(torch.equal(expected, torch.rand(4)))
+
+    def test_old_checkpoint(self):
+
+        layer = layers.NASLayer((8, 6), (4, 3), k=32, gadditional=2, radditional=2, region=(2, 2, 2, 2))
+
+        # checkpoints from before the per-layer generator have no state for it
+        state = {k : v for k, v in layer.state_dict().items() if not k.startswith('rng.')}
+        self.assertEqual(len(state) + 1, len(layer.state_dict()))
+
+        other = layers.NASLayer((8, 6), (4, 3), k=32, gadditional=2, radditional=2, region=(2, 2, 2, 2))
+        other.load_state_dict(state) # strict
+
+    def test_presample(self):
+
+        x = torch.randn(3, 8, 6)
+
+        outputs = []
+        for presample in [None, 2]:
+            torch.manual_seed(1)
+            layer = layers.NASLayer((8, 6), (4, 3), k=32, gadditional=2, radditional=2, region=(2, 2, 2, 2), presample=presample)
+
+            outputs.append([layer(x) for _ in range(3)])
+
+            if presample is not None:
+                layer.presampler.close()
+
+        # the presampler draws the same random numbers, in the same order
+        for plain, presampled in zip(*outputs):
+            self.assertTrue(torch.allclose(plain, presampled, atol=1e-6))
+
+        # a seeded sample does not depend on the presampler, even while its thread is drawing
+        outputs = []
+        for presample in [None, 2]:
+            torch.manual_seed(1)
+            layer = layers.NASLayer((8, 6), (4, 3), k=32, gadditional=2, radditional=2, region=(2, 2, 2, 2), presample=presample)
+
+            layer(x) # starts the producer thread
+            outputs.append([layer(x, seed=0), layer(x)])
+
+            if presample is not None:
+                layer.presampler.close()
+
+        for plain, presampled in zip(*outputs):
+            self.assertTrue(torch.allclose(plain, presampled, atol=1e-6))
+
+    def test_checkpoint_sampling(self):
+
+        x = torch.randn(3, 8, 6)
+
+        grads = []
+        for cp in [False, True]:
+            torch.manual_seed(1)
+            layer = layers.NASLayer((8, 6), (4, 3), k=32, gadditional=2, radditional=2, region=(2, 2, 2, 2), checkpoint_sampling=cp)
+
+            torch.manual_seed(2)
+            layer(x).pow(2).sum().backward()
+
+            grads.append([p.grad for p in layer.parameters()])
+
+        for plain, checkpointed in zip(*grads):
+            self.assertTrue(torch.allclose(plain, checkpointed, atol=1e-5))
+
+    def test_accumulate(self):
+
+        x = torch.randn(3, 8, 6)
+
+        layer = layers.NASLayer((8, 6), (4, 3), k=32, gadditional=2, radditional=2, region=(2, 2, 2, 2), has_bias=True)
+        loss = lambda y : (y - 1.0).pow(2).mean()
+
+        # a single pass is equivalent to a regular forward/backward
+        loss(layer(x, seed=0)).backward()
+        expected = [p.grad.clone() for p in layer.parameters()]
+
+        layer.zero_grad()
+        l = layer.accumulate(x, loss, subbatch=32, seed=0)
+
+        self.assertEqual((), l.size())
+        for e, p in zip(expected, layer.parameters()):
+            self.assertTrue(torch.allclose(e, p.grad, atol=1e-5))
+
+        # multiple passes
+        layer.zero_grad()
+        layer.accumulate(x, loss, subbatch=5)
+
+        for p in layer.parameters():
+            self.assertIsNotNone(p.grad)
+
+    def test_conv_methods(self):
+
+        x = torch.randn(4, 4, 5, 5)
+
+        c = layers.Convolution((4, 5, 5), 3, k=4, rprop=.5, gadditional=2, radditional=2, sample_groups=2)
+
+        for train in [True, False]:
+            c.train(train)
+
+            outputs = []
+            for method in ['contract', 'gather']:
+                c.method = method
+
+                torch.manual_seed(0)
+                outputs.append(c(x))
+
+            self.assertEqual((4, 3, 5, 5), outputs[1].size())
+            self.assertTrue(torch.allclose(outputs[0], outputs[1], atol=1e-5))
+
     def test_conv(self):
 
         x = torch.ones(1, 4, 3, 3)
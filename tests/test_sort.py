@@ -0,0 +1,92 @@
+import _context
+
+import unittest
+import torch
+
+import sort
+
+class TestSort(unittest.TestCase):
+
+    def test_split_methods(self):
+
+        b, s, z = 3, 16, 4
+
+        x = torch.randn(b, s, z)
+        keys = torch.randn(b, s)
+        offset = torch.rand(b, s)
+
+        split = sort.Split(s, depth=1, additional=3)
+
+        for reverse in [False, True]:
+            results = []
+            for method in ['sparse', 'gather']:
+                split.method = method
+
+                o = offset.clone().requires_grad_()
+
+                torch.manual_seed(0)
+                output, keys_out = split(x, keys, o, reverse=reverse)
+                (output.pow(2).sum() + keys_out.pow(2).sum()).backward()
+
+                results.append((output, keys_out, o.grad))
+
+            self.assertEqual((b, s, z), results[1][0].size())
+            self.assertEqual((b, s), results[1][1].size())
+
+            for sparse, gather in zip(*results):
+                self.assertTrue(torch.allclose(sparse, gather, atol=1e-5))
+
+    def test_eval(self):
+
+        b, s, z = 3, 32, 2
+
+        x = torch.randn(b, s, z)
+        keys = torch.randn(b, s)
+
+        layer = sort.SortLayer(s)
+
+        fast = layer(x, keys, train=False)
+
+        layer.fast_eval = False
+        slow = layer(x, keys, train=False)
+
+        self.assertTrue(torch.allclose(fast[0], slow[0]))
+        self.assertTrue(torch.allclose(fast[1], slow[1]))
+        self.assertTrue((fast[1][:, 1:] >= fast[1][:, :-1]).all())
+
+    def test_eval_ties(self):
+
+        b, s, z = 5, 32, 3
+
+        # small integers, so that the sums of colliding elements are exact
+        x = torch.randint(8, size=(b, s, z)).float()
+
+        for keys in [torch.randint(3, size=(b, s)).float(), torch.tensor([[1.0, 1.0, 1.0, 0.0] * 8] * b)]:
+            layer = sort.SortLayer(s)
+            self.assertTrue(layer.fast_eval)
+
+            fast = layer(x, keys, train=False)
+
+            layer.fast_eval = False
+            slow = layer(x, keys, train=False)
+
+            self.assertTrue(torch.equal(fast[0], slow[0]))
+            self.assertTrue(torch.equal(fast[1], slow[1]))
+
+        # with ties across a pivot, the splits (and so the fast path) need not sort the keys
+        layer = sort.SortLayer(4)
+        keys = torch.tensor([[1.0, 1.0, 1.0, 0.0]])
+        _, out = layer(torch.arange(4.0)[None, :, None], keys, train=False)
+
+        self.assertTrue(torch.equal(torch.tensor([[1.0, 1.0, 0.0, 1.0]]), out))
+
+    def test_median(self):
+
+        for s in [1, 2, 5, 16]:
+            x = torch.randn(7, s)
+
+            self.assertTrue(torch.allclose(sort.median(x, method='sort'), sort.median(x)))
+            self.assertEqual((7, 1), sort.median(x, keepdim=True).size())
+
+if __name__ == '__main__':
+    unittest.main()
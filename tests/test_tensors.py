@@ -44,6 +44,173 @@ class TestTensors(unittest.TestCase):
         print('res', tensors.logsoftmax(indices, values, size, method='naive').exp())
         print('res', tensors.logsoftmax(indices, values, size, method='iteration').exp())
 
+    def test_log_softmax_exact(self):
+
+        size = (5, 7)
+
+        samples = [sample(nindices=12, size=size) for _ in range(3)]
+        indices, values = [s[0][None, :, :] for s in samples], [s[1][None, :] for s in samples]
+        indices, values = torch.cat(indices, dim=0), torch.cat(values, dim=0)
+
+        values = (values * 100).requires_grad_()
+
+        probs = tensors.logsoftmax(indices, values, size, method='exact').exp()
+
+        # every row sums to one
+        sums = tensors.sum(indices, probs, size)
+        self.assertTrue(torch.allclose(sums, torch.ones_like(sums), atol=1e-5))
+
+        probs.pow(2).sum().backward()
+        self.assertFalse(torch.isnan(values.grad).any())
+
+    def test_segment_reductions(self):
+
+        size = (5, 7)
+
+        samples = [sample(nindices=12, size=size) for _ in range(3)]
+        indices, values = [s[0][None, :, :] for s in samples], [s[1][None, :] for s in samples]
+        indices, values = torch.cat(indices, dim=0), torch.cat(values, dim=0)
+        indices[:, 1, :] = indices[:, 0, :]
+
+        for row in [True, False]:
+            dim = 0 if row else 1
+
+            sums = tensors.sum(indices, values, size, row=row)
+            mmsums = tensors.sum(indices, values, size, row=row, method='mm')
+            maxes = tensors.rowmax(indices, values, size, row=row)
+            lse = tensors.logsumexp(indices, values, size, row=row)
+
+            self.assertTrue(torch.allclose(sums, mmsums, atol=1e-5))
+
+            for bi in range(3):
+                for i in range(12):
+                    seg = indices[bi, :, dim] == indices[bi, i, dim]
+
+                    self.assertAlmostEqual(values[bi, seg].sum().item(), sums[bi, i].item(), places=5)
+                    self.assertAlmostEqual(values[bi, seg].max().item(), maxes[bi, i].item(), places=5)
+                    self.assertAlmostEqual(values[bi, seg].logsumexp(dim=0).item(), lse[bi, i].item(), places=5)
+
+        # extra batch dimensions, and large values
+        lse = tensors.logsumexp(indices[None, :, :, :], values[None, :, :] * 1000, size)
+        self.assertEqual((1, 3, 12), lse.size())
+        self.assertFalse(torch.isinf(lse).any() or torch.isnan(lse).any())
+
+    def test_batchmm_gather(self):
+
+        size = (5, 7)
+
+        samples = [sample(nindices=12, size=size) for _ in range(3)]
+        indices, values = [s[0][None, :, :] for s in samples], [s[1][None, :] for s in samples]
+        indices, values = torch.cat(indices, dim=0), torch.cat(values, dim=0)
+        # - duplicate index tuples should be summed
+        indices[:, 1, :] = indices[:, 0, :]
+
+        x = torch.randn(3, 7, 4)
+
+        results, grads = [], []
+        for method in ['sparse', 'gather']:
+            v, xm = values.clone().requires_grad_(), x.clone().requires_grad_()
+
+            result = tensors.batchmm(indices, v, size, xm, method=method)
+            result.pow(2).sum().backward()
+
+            results.append(result)
+            grads.append((v.grad, xm.grad))
+
+        self.assertEqual((3, 5, 4), results[1].size())
+        self.assertTrue(torch.allclose(results[0], results[1], atol=1e-5))
+        self.assertTrue(torch.allclose(grads[0][0], grads[1][0], atol=1e-5))
+        self.assertTrue(torch.allclose(grads[0][1], grads[1][1], atol=1e-5))
+
+    def test_contract_shared(self):
+
+        size = (5, 7)
+
+        samples = [sample(nindices=12, size=size) for _ in range(2)]
+        indices, values = [s[0][None, :, :] for s in samples], [s[1][None, :] for s in samples]
+        indices, values = torch.cat(indices, dim=0), torch.cat(values, dim=0)
+
+        x = torch.randn(6, 7)
+
+        for method in ['sparse', 'gather']:
+            # three instances per sparse tensor
+            y = tensors.contract(indices, values, size, x, method=method)
+            self.assertEqual((6, 5), y.size())
+
+            expected = tensors.contract(indices[:, None].expand(2, 3, 12, 2).reshape(6, 12, 2), values[:, None].expand(2, 3, 12).reshape(6, 12), size, x, method=method)
+            self.assertTrue(torch.allclose(expected, y, atol=1e-5), method)
+
+    def test_contract_template(self):
+
+        size = (3, 4, 5, 6)
+
+        # template rows fix the first and third column, the learned indices fill in the other two
+        template = torch.stack([torch.randint(3, size=(4,)), torch.zeros(4, dtype=torch.long), torch.randint(5, size=(4,)), torch.zeros(4, dtype=torch.long)], dim=1)
+        learned = torch.stack([torch.randint(4, size=(2, 4 * 6)), torch.randint(6, size=(2, 4 * 6))], dim=-1)
+        values = torch.randn(2, 4 * 6)
+
+        x = torch.randn(2, 5, 6)
+
+        full = template[None, :, None, :].expand(2, 4, 6, 4).contiguous()
+        full[:, :, :, [1, 3]] = learned.view(2, 4, 6, 2)
+        full = full.view(2, 4 * 6, 4)
+
+        expected = tensors.contract(full, values, size, x)
+        y = tensors.contract(learned, values, size, x, template=template, learn_cols=(1, 3))
+
+        self.assertEqual((2, 3, 4), y.size())
+        self.assertTrue(torch.allclose(expected, y, atol=1e-5))
+
+    def test_flatten_indices_mat(self):
+
+        in_shape, out_shape = (3, 4), (5, 2, 6)
+        indices = torch.stack([torch.randint(s, size=(2, 16)) for s in out_shape + in_shape], dim=-1)
+
+        mindices, flat_size = tensors.flatten_indices_mat(indices, in_shape, out_shape)
+
+        self.assertEqual((2, 16, 2), mindices.size())
+        self.assertEqual((60, 12), flat_size)
+
+        # compare to flattening dense tensors
+        rows = torch.arange(60).view(*out_shape)
+        cols = torch.arange(12).view(*in_shape)
+
+        for i in range(16):
+            tup = indices[0, i].tolist()
+            self.assertEqual(rows[tuple(tup[:3])].item(), mindices[0, i, 0].item())
+            self.assertEqual(cols[tuple(tup[3:])].item(), mindices[0, i, 1].item())
+
+        # the plan is cached
+        self.assertIs(tensors.contraction_plan(in_shape, out_shape), tensors.contraction_plan(torch.Size(in_shape), list(out_shape)))
+
+        # ... in a bounded LRU cache
+        tensors.set_plan_cache(4)
+
+        plan = tensors.contraction_plan(in_shape, out_shape)
+        for i in range(1, 4):
+            tensors.contraction_plan((i, ), out_shape)
+        self.assertIs(plan, tensors.contraction_plan(in_shape, out_shape)) # - now the most recently used
+
+        for i in range(4, 16):
+            tensors.contraction_plan((i, ), out_shape)
+        self.assertEqual(4, len(tensors.PLANS))
+        self.assertIsNot(plan, tensors.contraction_plan(in_shape, out_shape))
+
+        tensors.set_plan_cache(256)
+
+    def test_sparsemm_double_backward(self):
+
+        size = (5, 7)
+        indices, values = sample(nindices=12, size=size)
+
+        values = values.double().requires_grad_()
+        x = torch.randn(7, 3, dtype=torch.double, requires_grad=True)
+
+        fn = lambda v, xm : tensors.sparsemm()(indices.t(), v, size, xm)
+
+        self.assertTrue(torch.autograd.gradcheck(fn, (values, x)))
+        self.assertTrue(torch.autograd.gradgradcheck(fn, (values, x)))
+
     def test(self):
 
         a = Variable(torch.randn(1), requires_grad=True)
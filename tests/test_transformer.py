@@ -0,0 +1,41 @@
+import _context
+
+import unittest
+import torch
+
+try:
+    import transformer
+except ImportError: # - the experiments need tensorboard and matplotlib
+    transformer = None
+
+@unittest.skipIf(transformer is None, 'The experiment dependencies are not installed')
+class TestTransformer(unittest.TestCase):
+
+    def test_character_bits(self):
+
+        context, n = 16, 40
+
+        torch.manual_seed(0)
+        data = torch.randint(256, size=(n, ))
+
+        for kwargs in [{'type' : 'sparse', 'oned' : False}, {'type' : 'sparse', 'oned' : True}, {'type' : 'dense'}]:
+            model = transformer.GTransformer(emb=16, heads=2, depth=2, seq_length=context, num_tokens=256, k=2,
+                                             gadditional=2, radditional=2, region=4, **kwargs)
+            # - left in training mode, as during training
+
+            with torch.no_grad():
+                bits = transformer.character_bits(model, data, context, batch_size=4, min_context=4)
+
+                # perturbing the later characters does not change the scores of the earlier ones
+                perturbed = data.clone()
+                perturbed[25:] = torch.randint(256, size=(n - 25, ))
+
+                other = transformer.character_bits(model, perturbed, context, batch_size=4, min_context=4)
+
+            self.assertTrue(torch.allclose(bits[:25], other[:25], atol=1e-5), kwargs)
+            self.assertTrue(model.training)
+
+            self.assertTrue(torch.allclose(bits.sum() / n, transformer.evaluate(model, data, context, 4, min_context=4)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -54,6 +54,85 @@ class TestLayers(unittest.TestCase):
 
         self.assertEqual([0, 0, 1, 0, 0, 0, 1, 0], list(util.duplicates(tuples).view(-1)))
 
+    def test_duplicates_bounds(self):
+
+        tuples = torch.tensor([[
+                [3, 1],
+                [3, 2],
+                [3, 1],
+                [0, 3],
+                [0, 2],
+                [3, 0],
+                [0, 3],
+                [0, 0]]])
+
+        # known bounds
+        self.assertEqual([0, 0, 1, 0, 0, 0, 1, 0], list(util.duplicates(tuples, rng=(4, 4)).view(-1)))
+
+        # bounds too big for the mixed-radix keys (the keys are computed per chunk of columns)
+        self.assertIsNone(util.radix_keys(tuples, rng=(2 ** 40, 2 ** 40)))
+        self.assertIsNotNone(util.row_keys(tuples, rng=(2 ** 40, 2 ** 40)))
+        self.assertEqual([0, 0, 1, 0, 0, 0, 1, 0], list(util.duplicates(tuples, rng=(2 ** 40, 2 ** 40)).view(-1)))
+
+        # a single column too big for the chunks (falls back to torch.unique)
+        self.assertIsNone(util.row_keys(tuples, rng=(2 ** 62, 4)))
+        self.assertEqual([0, 0, 1, 0, 0, 0, 1, 0], list(util.duplicates(tuples, rng=(2 ** 62, 4)).view(-1)))
+
+        # rank 6 tuples, with equal tuples in different batch rows
+        tuples = torch.randint(3, size=(4, 512, 6))
+        tuples[1] = tuples[0]
+
+        dups = util.duplicates(tuples, rng=(3,) * 6)
+        for row in range(4):
+            seen = set()
+            for i in range(512):
+                tup = tuple(tuples[row, i].tolist())
+                self.assertEqual(tup in seen, bool(dups[row, i]))
+                seen.add(tup)
+
+    def test_duplicates_permutations(self):
+
+        # the shapes of sort.Split: candidate permutations of a sequence of s elements
+        b, n, s = 3, 9, 64
+
+        tuples = util.random_permutations(b * n, s).view(b, n, s)
+        tuples[:, 3] = tuples[:, 0]
+        tuples[:, 7] = tuples[:, 5]
+        tuples[2, 8] = tuples[2, 3]
+
+        rng = (s, ) * s
+        self.assertIsNone(util.radix_keys(tuples, rng=rng))
+        self.assertIsNotNone(util.row_keys(tuples, rng=rng))
+
+        dups = util.duplicates(tuples, rng=rng)
+        for row in range(b):
+            seen = set()
+            for i in range(n):
+                tup = tuple(tuples[row, i].tolist())
+                self.assertEqual(tup in seen, bool(dups[row, i]))
+                seen.add(tup)
+
+        self.assertEqual(7, int(dups.sum()))
+
+    def test_shuffle_rows(self):
+
+        x = torch.arange(64)[None, :].expand(100, 64).contiguous()
+
+        for cache in [0, 2 ** 20]:
+            util.set_shuffle_cache(cache, pool_size=16)
+
+            shuffled = util.shuffle_rows(x)
+
+            # every row is a permutation
+            self.assertTrue(torch.equal(shuffled.sort(dim=1)[0], x))
+            self.assertFalse(torch.equal(shuffled, x))
+
+        util.set_shuffle_cache(0)
+
+        offsets = util.sample_offsets(3, 4, 16, 2)
+        self.assertEqual((3, 4, 16), offsets.size())
+        self.assertTrue((offsets.view(3, 4, 4, 4).sum(dim=-1) == 2).all())
+
     def test_nduplicates(self):
 
         # some tuples